@@ -1,230 +1,488 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-import json
 from datetime import datetime
-from .models import Message, ChatRoom, User
-from .utils.message_status import update_message_status_to_delivered, mark_messages_as_seen, update_user_presence, get_online_users_in_room
+from .models import ChatRoom
+from .protocol import JSON, negotiate, decode_frame, frame_event, msgpack_frame
+from .utils.message_store import create_message
+from .utils.channel_groups import get_room_group_name, get_user_group_name
+from .utils.write_behind import get_write_behind
+from .utils.typing_indicators import TypingState, get_room_typing_aggregator
+from .utils.message_status import mark_messages_as_seen, aget_read_watermarks
+from .utils.message_history import aget_message_page
+from .utils.db_executor import run_in_db_executor
+from .utils.presence import get_presence_tracker, get_room_roster
+from .utils.inbox_notifications import get_inbox_notifier
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    # This method is called when a WebSocket connection is established.
-    async def connect(self):
-        # Extract the room name from the URL route parameters.
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        # Create a unique group name for the room (used for broadcasting messages).
-        self.room_group_name = f'chat_{self.room_id}'
-        
-        # Get the user from the scope (requires authentication middleware)
-        self.user = self.scope.get('user')
-        
-        # Only allow authenticated users
-        if not self.user or not self.user.is_authenticated:
-            await self.close()
-            return
+# Number of latest messages sent in the snapshot frame on connect
+SNAPSHOT_MESSAGES = 50
+# Rooms one multiplexed socket can be subscribed to at the same time
+MAX_SUBSCRIPTIONS = 100
+
+class RoomSubscription:
+    """State of one chat room on one socket"""
+
+    def __init__(self, room_id, is_group, participant_ids, on_typing):
+        self.room_id = room_id
+        self.group_name = get_room_group_name(room_id)
+        self.is_group = is_group
+        self.participant_ids = participant_ids
+        self.typing_state = TypingState(on_typing)
+        # Whether the user has the room open, as opposed to only receiving its frames
+        self.is_open = False
+
+class RoomSocketMixin:
+    """
+    Chat room logic shared by the per-room and the multiplexed consumers. The subscribed rooms
+    are kept in self.rooms (room_id -> RoomSubscription), every frame sent to the client carries
+    its room_id. Frames are encoded with the protocol negotiated on connect (see protocol.py).
+
+    A subscribed room only receives the room's frames. Opening it is what the user sees: presence,
+    user_joined, marking its messages as seen and the snapshot frame.
+    """
+    protocol = JSON
+
+    # Subscribe to a room the user was checked to be a participant of
+    async def join_room(self, room):
+        subscription = RoomSubscription(
+            room['room_id'], room['is_group'], room['participant_ids'],
+            lambda is_typing: self.typing_changed(subscription, is_typing)
+        )
+        self.rooms[subscription.room_id] = subscription
 
         # Add the current WebSocket connection to the room group.
         await self.channel_layer.group_add(
-            self.room_group_name,  # Group name
-            self.channel_name      # Channel name (unique for each WebSocket connection)
+            subscription.group_name,  # Group name
+            self.channel_name         # Channel name (unique for each WebSocket connection)
         )
-        # Accept the WebSocket connection.
-        await self.accept()
-        
-        # Notify room that user joined
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
+        return subscription
+
+    # The user opened the room, opening it again only refreshes it
+    async def open_room(self, subscription):
+        if not subscription.is_open:
+            subscription.is_open = True
+
+            # Notify room that user joined
+            await self.broadcast(subscription, 'user_joined', {
                 'type': 'user_joined',
+                'room_id': subscription.room_id,
                 'username': self.user.username,
                 'timestamp': datetime.now().isoformat()
-            }
-        )
+            })
+
+            # Update user presence when they join
+            await get_presence_tracker().join(subscription.room_id, self.user.id, self.user.username, self.channel_name)
 
-        # Update user presence when they connect
-        await self.update_user_presence_db(True)
-        
         # Mark messages as seen when user opens the room
-        seen_message_ids = await self.mark_room_messages_as_seen()
-        if seen_message_ids:
-            # Notify other users that messages were seen
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'messages_seen',
-                    'seen_message_ids': seen_message_ids,
-                    'seen_by': self.user.username
-                }
-            )
+        await self.mark_seen(subscription)
+
+        # Send everything needed to render the room in one frame, so opening a room
+        # needs no extra HTTP round trips
+        snapshot = await self.load_snapshot(subscription.room_id)
+        snapshot['online_users'] = await get_room_roster(subscription.room_id)
+        await self.send_frame(snapshot)
+
+    # The user closed the room, its frames keep coming while it is subscribed
+    async def close_room(self, subscription):
+        if not subscription.is_open:
+            return
+        subscription.is_open = False
+        subscription.typing_state.stop()
+        await get_presence_tracker().leave(subscription.room_id, self.user.id, self.user.username, self.channel_name)
+
+        # Notify room that user left
+        await self.broadcast(subscription, 'user_left', {
+            'type': 'user_left',
+            'room_id': subscription.room_id,
+            'username': self.user.username,
+            'timestamp': datetime.now().isoformat()
+        })
+
+    # Leave a room, on unsubscribe or when the socket closes
+    async def leave_room(self, subscription):
+        self.rooms.pop(subscription.room_id, None)
+        await self.close_room(subscription)
+        subscription.typing_state.stop()
 
-    # This method is called when the WebSocket connection is closed.
-    async def disconnect(self, close_code):
-        # Update user presence when they disconnect
-        if hasattr(self, 'user') and self.user.is_authenticated:
-            await self.update_user_presence_db(False)
-            
-            # Notify room that user left
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_left',
-                    'username': self.user.username,
-                    'timestamp': datetime.now().isoformat()
-                }
-            )
-        
         # Remove the WebSocket connection from the room group.
         await self.channel_layer.group_discard(
-            self.room_group_name,  # Group name
-            self.channel_name      # Channel name
+            subscription.group_name,  # Group name
+            self.channel_name         # Channel name
         )
 
-    # This method is called when a message is received from the WebSocket.
-    async def receive(self, text_data):
+    # Handle a frame sent by the client for one of its rooms
+    async def handle_room_frame(self, subscription, data):
+        message_type = data.get('type', 'message')
+
+        if message_type == 'message':
+            message = data.get('message', '')
+            if not isinstance(message, str):
+                await self.send_error('Invalid message format', subscription.room_id)
+                return
+
+            message = message.strip()
+            if not message:
+                return
+
+            # Save message to database, it is stored directly as 'Delivered'
+            saved_message = await self.save_message(subscription, message)
+
+            if saved_message:
+                # Sending the message ends the typing indicator
+                subscription.typing_state.stop()
+
+                # Acknowledge to the sender. In write-behind mode message_id is not known yet, the
+                # room gets a messages_stored frame with it once the message is inserted
+                await self.send_frame({
+                    'type': 'message_ack',
+                    'room_id': subscription.room_id,
+                    'message_id': saved_message.id,
+                    'message_uid': str(saved_message.uid),
+                    'timestamp': saved_message.timestamp.isoformat()
+                })
+
+                # Broadcast the message to all WebSocket connections in the room group
+                await self.broadcast(subscription, 'chat_message', {
+                    'type': 'message',
+                    'room_id': subscription.room_id,
+                    'message': message,
+                    'message_id': saved_message.id,
+                    'message_uid': str(saved_message.uid),
+                    'username': self.user.username,
+                    'user_id': self.user.id,
+                    'timestamp': saved_message.timestamp.isoformat(),
+                    'status': saved_message.status
+                })
+            else:
+                await self.send_error('Message could not be sent', subscription.room_id)
+
+        elif message_type == 'mark_seen':
+            # Handle explicit mark as seen requests
+            await self.mark_seen(subscription)
+
+        elif message_type == 'heartbeat' and subscription.is_open:
+            # Keep the user's presence alive
+            await get_presence_tracker().heartbeat(subscription.room_id, self.user.id, self.user.username, self.channel_name)
+
+        elif message_type == 'typing':
+            # Handle typing indicators, only start/stop edges reach the room (see typing_changed)
+            subscription.typing_state.update(bool(data.get('is_typing', False)))
+
+    # Mark the room's messages as seen and tell the room about the new watermark
+    async def mark_seen(self, subscription):
+        last_seen_message_id = await self.mark_room_messages_as_seen(subscription.room_id)
+        if last_seen_message_id:
+            await self.broadcast(subscription, 'messages_seen', {
+                'type': 'messages_seen',
+                'room_id': subscription.room_id,
+                'last_seen_message_id': last_seen_message_id,
+                'user_id': self.user.id,
+                'seen_by': self.user.username
+            }, echo=True)
+
+    # Negotiate the wire protocol and accept the WebSocket connection
+    async def accept_socket(self):
+        self.protocol, subprotocol = negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol)
+
+    # Send a frame to this socket only
+    async def send_frame(self, frame):
+        if self.protocol.binary:
+            await self.send(bytes_data=self.protocol.encode(frame))
+        else:
+            await self.send(text_data=self.protocol.encode(frame))
+
+    async def send_error(self, message, room_id=None):
+        frame = {'type': 'error', 'message': message}
+        if room_id is not None:
+            frame['room_id'] = room_id
+        await self.send_frame(frame)
+
+    # Decode a frame sent by the client, None if it is malformed
+    async def parse_frame(self, text_data, bytes_data):
         try:
-            # Parse the JSON data received from the WebSocket.
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type', 'message')
-            
-            if message_type == 'message':
-                message = text_data_json.get('message', '').strip()
-                
-                if not message:
-                    return
-                
-                # Save message to database with 'Pending' status
-                saved_message = await self.save_message(message)
-                
-                if saved_message:
-                    # Update status to 'Delivered' after successful save
-                    await self.update_message_to_delivered(saved_message.id)
-                    
-                    # Broadcast the message to all WebSocket connections in the room group
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'chat_message',
-                            'message': message,
-                            'username': self.user.username,
-                            'user_id': self.user.id,
-                            'message_id': saved_message.id,
-                            'timestamp': datetime.now().isoformat(),
-                            'status': 'Delivered'
-                        }
-                    )
-            
-            elif message_type == 'mark_seen':
-                # Handle explicit mark as seen requests
-                seen_message_ids = await self.mark_room_messages_as_seen()
-                if seen_message_ids:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'messages_seen',
-                            'seen_message_ids': seen_message_ids,
-                            'seen_by': self.user.username
-                        }
-                    )
-            
-            elif message_type == 'typing':
-                # Handle typing indicators
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'username': self.user.username,
-                        'is_typing': text_data_json.get('is_typing', False)
-                    }
-                )
-                
-        except json.JSONDecodeError:
-            # Handle invalid JSON
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Invalid message format'
-            }))
+            return decode_frame(text_data, bytes_data)
+        except ValueError:
+            await self.send_error('Invalid message format')
+            return None
+
+    # Handle room membership changes, refresh the cached participants
+    async def participants_changed(self, event):
+        subscription = self.rooms.get(event['room_id'])
+        if subscription is None:
+            return
+        subscription.participant_ids = set(event['participant_ids'])
+        if self.user.id not in subscription.participant_ids:
+            # The user was removed from the room
+            await self.room_access_revoked(subscription)
+
+    # The user was removed from a subscribed room, the socket stays open for the other rooms
+    async def room_access_revoked(self, subscription):
+        await self.leave_room(subscription)
+        await self.send_frame({'type': 'unsubscribed', 'room_id': subscription.room_id})
+
+    # Send a frame to every socket of the room. It is encoded once here and the encoded frame is
+    # forwarded as is by each receiving consumer (converted once per process for MessagePack
+    # sockets), instead of being re-serialized per socket. Unless echo is set, the socket that sent it is skipped.
+    async def broadcast(self, subscription, event_type, frame, echo=False):
+        await self.channel_layer.group_send(
+            subscription.group_name,
+            frame_event(event_type, frame, None if echo else self.channel_name)
+        )
+
+    # Called by the room's typing state on start/stop edges, the room aggregator
+    # merges the edges of all its sockets into one typing frame per interval
+    def typing_changed(self, subscription, is_typing):
+        room_id, room_group_name = subscription.room_id, subscription.group_name
+        channel_layer = self.channel_layer
+
+        async def send_typing_frame(frame):
+            await channel_layer.group_send(
+                room_group_name,
+                frame_event('typing_indicator', dict(frame, room_id=room_id))
+            )
+
+        get_room_typing_aggregator(room_group_name, send_typing_frame).add(self.user.username, is_typing)
+
+    # Forward a pre-encoded frame from a room group to this socket
+    async def forward_frame(self, event):
+        if event['sender_channel'] != self.channel_name:
+            if self.protocol.binary:
+                await self.send(bytes_data=msgpack_frame(event['text']))
+            else:
+                await self.send(text_data=event['text'])
 
     # This method is called when a message is sent to the room group.
     async def chat_message(self, event):
-        # Don't send the message back to the sender
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'message',
-                'message': event['message'],
-                'username': event['username'],
-                'user_id': event['user_id'],
-                'timestamp': event['timestamp']
-            }))
+        await self.forward_frame(event)
 
     # Handle user joined notifications
     async def user_joined(self, event):
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'user_joined',
-                'username': event['username'],
-                'timestamp': event['timestamp']
-            }))
+        await self.forward_frame(event)
 
     # Handle user left notifications
     async def user_left(self, event):
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'user_left',
-                'username': event['username'],
-                'timestamp': event['timestamp']
-            }))
+        await self.forward_frame(event)
 
     # Handle typing indicators
     async def typing_indicator(self, event):
-        if event['username'] != self.user.username:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
-
-    # Handle messages seen notifications
+        await self.forward_frame(event)
+
+    # Handle messages seen notifications, every message up to the watermark was seen by the user
     async def messages_seen(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'messages_seen',
-            'seen_message_ids': event['seen_message_ids'],
-            'seen_by': event['seen_by']
-        }))
-
-    # Update message status to delivered
-    @database_sync_to_async
-    def update_message_to_delivered(self, message_id):
-        return update_message_status_to_delivered(message_id)
-
-    # Mark messages as seen
-    @database_sync_to_async
-    def mark_room_messages_as_seen(self):
-        return mark_messages_as_seen(self.room_id, self.user.id)
-
-    # Update user presence
-    @database_sync_to_async
-    def update_user_presence_db(self, is_online):
-        return update_user_presence(self.user.id, self.room_id, is_online)
+        await self.forward_frame(event)
+
+    # Write-behind batch committed, maps the uids of the room's messages to their database ids
+    async def messages_stored(self, event):
+        await self.forward_frame(event)
+
+    # Latest messages and read watermarks of the room, through the async ORM
+    async def load_snapshot(self, room_id):
+        messages_data, next_cursor, has_more = await aget_message_page(room_id, limit=SNAPSHOT_MESSAGES)
+        return {
+            'type': 'snapshot',
+            'room_id': room_id,
+            'messages': messages_data,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'read_watermarks': await aget_read_watermarks(room_id)
+        }
+
+    # Mark messages as seen, it locks the user's inbox row in a transaction so it runs on the db executor
+    async def mark_room_messages_as_seen(self, room_id):
+        return await run_in_db_executor(mark_messages_as_seen, room_id, self.user.id)
+
+    # Load the metadata and participant ids of the given rooms in one query
+    async def load_rooms(self, room_ids):
+        rooms = {}
+        async for user_id, room_id, is_group in ChatRoom.participants.through.objects.filter(
+            chatroom_id__in=room_ids
+        ).values_list('user_id', 'chatroom_id', 'chatroom__is_group'):
+            room = rooms.setdefault(room_id, {'room_id': room_id, 'is_group': is_group, 'participant_ids': set()})
+            room['participant_ids'].add(user_id)
+        return rooms
 
     # Save message to database
-    @database_sync_to_async
-    def save_message(self, message_content):
+    async def save_message(self, subscription, message_content):
+        # Membership comes from the subscription cache, no query on the send path
+        if self.user.id not in subscription.participant_ids:
+            return None
+
+        write_behind = get_write_behind()
+        if write_behind is not None:
+            # Acknowledged now, inserted with the next micro-batch
+            return write_behind.submit(subscription.room_id, self.user.id, message_content)
+        return await self.persist_message(subscription.room_id, message_content)
+
+    # The message and the chat list are written in one transaction, which the async ORM has not
+    async def persist_message(self, room_id, message_content):
         try:
-            # Get the chat room by ID
-            room = ChatRoom.objects.get(id=self.room_id)
-            
-            # Verify user is a participant
-            if not room.participants.filter(id=self.user.id).exists():
-                return None
-            
-            message = Message.objects.create(
+            return await run_in_db_executor(
+                create_message,
+                room_id=room_id,
                 sender=self.user,
-                room=room,
-                content=message_content,
-                status='Pending'
+                content=message_content
             )
-            return message
-        except ChatRoom.DoesNotExist:
-            # Handle case where room doesn't exist
-            return None
         except Exception as e:
             # Handle other potential errors
             return None
+
+class ChatConsumer(RoomSocketMixin, AsyncWebsocketConsumer):
+    """One socket per chat room, the room comes from the URL"""
+
+    # This method is called when a WebSocket connection is established.
+    async def connect(self):
+        self.rooms = {}
+
+        # Get the user from the scope (requires authentication middleware)
+        self.user = self.scope.get('user')
+
+        # Only allow authenticated users
+        if not self.user or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        # Load the room once for the life of the connection, it is refreshed by
+        # participants_changed events instead of being re-checked on every message
+        try:
+            room_id = int(self.scope['url_route']['kwargs']['room_id'])
+        except ValueError:
+            await self.close()
+            return
+        room = (await self.load_rooms([room_id])).get(room_id)
+        if room is None or self.user.id not in room['participant_ids']:
+            await self.close()
+            return
+
+        # Accept the WebSocket connection.
+        await self.accept_socket()
+        await self.open_room(await self.join_room(room))
+
+    # This method is called when the WebSocket connection is closed.
+    async def disconnect(self, close_code):
+        for subscription in list(getattr(self, 'rooms', {}).values()):
+            await self.leave_room(subscription)
+
+    # This method is called when a message is received from the WebSocket.
+    async def receive(self, text_data=None, bytes_data=None):
+        # Parse the frame received from the WebSocket.
+        frame = await self.parse_frame(text_data, bytes_data)
+        if frame is None:
+            return
+
+        for subscription in list(self.rooms.values()):
+            await self.handle_room_frame(subscription, frame)
+
+    # The socket only serves this room
+    async def room_access_revoked(self, subscription):
+        await self.close()
+
+class MultiplexChatConsumer(RoomSocketMixin, AsyncWebsocketConsumer):
+    """
+    One socket for all the rooms of a user. The client subscribes to rooms with
+    {"type": "subscribe", "room_ids": [...]} and leaves them with {"type": "unsubscribe", ...},
+    room frames carry a room_id in both directions. Subscribing only receives the room's frames,
+    the room the user looks at is opened with {"type": "open", "room_id": ...} (and closed with
+    {"type": "close", ...}), which marks it as seen and sends its snapshot. The socket also listens on the user's own
+    group, which tells it about rooms the user was added to or removed from and pushes chat list
+    updates of every room, subscribed or not.
+    """
+
+    async def connect(self):
+        self.rooms = {}
+
+        # Get the user from the scope (requires authentication middleware)
+        self.user = self.scope.get('user')
+
+        # Only allow authenticated users
+        if not self.user or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.user_group_name = get_user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        # Chat list updates of this process are sent on the loop the personal groups listen on
+        get_inbox_notifier()
+        await self.accept_socket()
+
+    async def disconnect(self, close_code):
+        for subscription in list(self.rooms.values()):
+            await self.leave_room(subscription)
+        if hasattr(self, 'user_group_name'):
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        frame = await self.parse_frame(text_data, bytes_data)
+        if frame is None:
+            return
+
+        message_type = frame.get('type', 'message')
+        if message_type in ('subscribe', 'unsubscribe'):
+            room_ids = frame.get('room_ids')
+            if room_ids is None:
+                room_ids = [frame.get('room_id')]
+            try:
+                room_ids = [int(room_id) for room_id in room_ids]
+            except (TypeError, ValueError):
+                await self.send_error('Invalid room id')
+                return
+            if message_type == 'subscribe':
+                await self.subscribe(room_ids)
+            else:
+                await self.unsubscribe(room_ids)
+            return
+
+        if message_type == 'heartbeat' and frame.get('room_id') is None:
+            # One heartbeat keeps the presence of every subscribed room alive
+            for subscription in list(self.rooms.values()):
+                await self.handle_room_frame(subscription, frame)
+            return
+
+        try:
+            room_id = int(frame.get('room_id'))
+        except (TypeError, ValueError):
+            await self.send_error('Invalid room id')
+            return
+        subscription = self.rooms.get(room_id)
+        if subscription is None:
+            await self.send_error('Not subscribed to this room', room_id)
+            return
+
+        if message_type == 'open':
+            await self.open_room(subscription)
+        elif message_type == 'close':
+            await self.close_room(subscription)
+        else:
+            await self.handle_room_frame(subscription, frame)
+
+    async def subscribe(self, room_ids):
+        room_ids = [room_id for room_id in dict.fromkeys(room_ids) if room_id not in self.rooms]
+        if len(self.rooms) + len(room_ids) > MAX_SUBSCRIPTIONS:
+            await self.send_error(f'At most {MAX_SUBSCRIPTIONS} rooms can be subscribed at once')
+            return
+
+        # One query for all the requested rooms
+        rooms = await self.load_rooms(room_ids) if room_ids else {}
+        for room_id in room_ids:
+            room = rooms.get(room_id)
+            if room is None or self.user.id not in room['participant_ids']:
+                await self.send_error('Room not found or access denied', room_id)
+                continue
+            await self.join_room(room)
+
+    async def unsubscribe(self, room_ids):
+        for room_id in room_ids:
+            subscription = self.rooms.get(room_id)
+            if subscription is not None:
+                await self.leave_room(subscription)
+                await self.send_frame({'type': 'unsubscribed', 'room_id': room_id})
+
+    # The user was added to a room, the client may subscribe to it
+    async def room_added(self, event):
+        await self.forward_frame(event)
+
+    # The user was removed from a room
+    async def room_removed(self, event):
+        await self.forward_frame(event)
+
+    # A room of the user's chat list changed, see utils/inbox_notifications.py
+    async def inbox_update(self, event):
+        await self.forward_frame(event)
@@ -0,0 +1,125 @@
+import asyncio
+import statistics
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from chat.models import User, ChatRoom, Friendship
+from chat.utils.message_store import create_message
+
+PREFIX = 'async_views_bench'
+
+
+def session_cookie(user):
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'.encode()
+
+
+async def call(application, path, cookie):
+    """One GET through the ASGI application, as a server would pass it, returns the status"""
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'https', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(b'host', b'127.0.0.1'), (b'cookie', cookie)],
+        'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 443),
+    }
+    requested = False
+    response = {}
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # the client stays connected until the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+
+    await application(scope, receive, send)
+    return response['status']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync views with their async variants under many concurrent clients, "
+        "both served by Django's ASGI handler in this process"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--requests', type=int, default=5, help='requests per client')
+        parser.add_argument('--friends', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=100)
+
+    def handle(self, *args, **options):
+        users = self.setup(options)
+        try:
+            asyncio.run(self.run(users, options))
+        finally:
+            close_old_connections()
+            User.objects.filter(username__startswith=PREFIX).delete()
+
+    def setup(self, options):
+        User.objects.filter(username__startswith=PREFIX).delete()
+        users = User.objects.bulk_create([User(username=f'{PREFIX}_{i}') for i in range(options['friends'] + 1)])
+        Friendship.objects.bulk_create([
+            Friendship(requester=users[0], addressee=friend, status='accepted') for friend in users[1:]
+        ])
+        room, _ = ChatRoom.get_or_create_direct_chat(users[0], users[1])
+        for i in range(options['messages']):
+            create_message(room.id, users[i % 2], f'message {i}')
+        self.room_id = room.id
+        return users
+
+    async def run(self, users, options):
+        application = get_asgi_application()
+        cookie = await sync_to_async(session_cookie)(users[0])
+        endpoints = {
+            'get-messages': f'get-messages/{self.room_id}/?limit=50',
+            'get-friends': 'get-friends/',
+        }
+        # warm up connections and caches
+        for path in endpoints.values():
+            for variant in ('sync', 'async'):
+                assert await call(application, f'/{variant}/{path}', cookie) == 200
+
+        self.stdout.write(
+            f"{options['clients']} concurrent clients x {options['requests']} requests, "
+            f"database: {settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]}"
+        )
+        self.stdout.write(f"{'endpoint':<14} {'views':<6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for name, path in endpoints.items():
+            for variant in ('sync', 'async'):
+                latencies, errors = [], 0
+
+                async def client():
+                    nonlocal errors
+                    for _ in range(options['requests']):
+                        started = time.perf_counter()
+                        if await call(application, f'/{variant}/{path}', cookie) != 200:
+                            errors += 1
+                        latencies.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                await asyncio.gather(*(client() for _ in range(options['clients'])))
+                elapsed = time.perf_counter() - started
+
+                latencies.sort()
+                self.stdout.write(
+                    f"{name:<14} {variant:<6} {len(latencies) / elapsed:>8.0f} {statistics.median(latencies):>8.1f} "
+                    f"{latencies[int(len(latencies) * 0.95) - 1]:>8.1f} {latencies[int(len(latencies) * 0.99) - 1]:>8.1f} "
+                    f"{errors:>7}"
+                )
@@ -0,0 +1,142 @@
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+def make_layer(layer_settings):
+    """Build a channel layer from a CHANNEL_LAYERS entry"""
+    backend = import_string(layer_settings['BACKEND'])
+    return backend(**layer_settings.get('CONFIG', {}))
+
+
+def run_worker(layer_settings, group, sockets, messages, timeout, ready, start, results):
+    """One ASGI worker: holds `sockets` channels in the room group and counts what they receive"""
+
+    async def main():
+        layer = make_layer(layer_settings)
+        channels = [await layer.new_channel() for _ in range(sockets)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        ready.put(True)
+        # wait until the sender starts, without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, start.wait)
+
+        async def drain(channel):
+            received = 0
+            try:
+                while received < messages:
+                    await asyncio.wait_for(layer.receive(channel), timeout)
+                    received += 1
+            except asyncio.TimeoutError:
+                pass
+            return received
+
+        counts = await asyncio.gather(*(drain(channel) for channel in channels))
+        finished_at = time.time()
+        for channel in channels:
+            await layer.group_discard(group, channel)
+        results.put((sum(counts), finished_at))
+
+    asyncio.run(main())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = "Measure chat fan-out throughput of the configured channel layer across several worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+        parser.add_argument('--sockets', type=int, default=50, help='sockets per worker in the room')
+        parser.add_argument('--messages', type=int, default=200, help='group_send calls per run')
+        parser.add_argument('--timeout', type=float, default=5.0)
+        parser.add_argument(
+            '--stand-in', action='store_true',
+            help='run against a local Redis-protocol stand-in server (needs fakeredis and lupa)'
+        )
+
+    def handle(self, *args, **options):
+        layer_settings = dict(settings.CHANNEL_LAYERS['default'])
+        layer_settings['CONFIG'] = dict(layer_settings.get('CONFIG', {}))
+        server = None
+
+        if options['stand_in']:
+            try:
+                from fakeredis import TcpFakeServer
+            except ImportError:
+                raise CommandError('--stand-in needs the fakeredis package (with lupa for Lua scripts)')
+            import threading
+
+            port = free_port()
+            server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            layer_settings['BACKEND'] = 'channels_redis.core.RedisChannelLayer'
+            layer_settings['CONFIG']['hosts'] = [f'redis://127.0.0.1:{port}/0']
+            layer_settings['CONFIG'].pop('capacity', None)
+
+        if 'InMemory' in layer_settings['BACKEND']:
+            raise CommandError(
+                'The in-memory channel layer cannot deliver across processes; '
+                'set CHANNEL_LAYER_BACKEND=redis or pass --stand-in'
+            )
+
+        # every socket must be able to hold the whole run, otherwise sends are dropped
+        layer_settings['CONFIG']['capacity'] = max(
+            layer_settings['CONFIG'].get('capacity', 100), options['messages']
+        )
+
+        self.stdout.write(f"backend: {layer_settings['BACKEND']}")
+        self.stdout.write(f"{'workers':>8} {'sockets':>8} {'delivered':>10} {'seconds':>8} {'deliveries/s':>13}")
+
+        try:
+            for workers in options['workers']:
+                self.run(layer_settings, workers, options)
+        finally:
+            if server is not None:
+                server.shutdown()
+
+    def run(self, layer_settings, workers, options):
+        context = multiprocessing.get_context('spawn')
+        ready, results, start = context.Queue(), context.Queue(), context.Event()
+        group = f'bench_{time.time_ns()}'
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(layer_settings, group, options['sockets'], options['messages'],
+                      options['timeout'], ready, start, results),
+            )
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get()
+
+        async def send_all():
+            layer = make_layer(layer_settings)
+            started_at = time.time()
+            start.set()
+            for i in range(options['messages']):
+                await layer.group_send(group, {'type': 'chat_message', 'message': f'message {i}'})
+            return started_at
+
+        started_at = asyncio.run(send_all())
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        delivered = sum(count for count, _ in outcomes)
+        elapsed = max(finished_at for _, finished_at in outcomes) - started_at
+        sockets = workers * options['sockets']
+        self.stdout.write(
+            f"{workers:>8} {sockets:>8} {delivered:>10} {elapsed:>8.3f} {delivered / elapsed:>13.0f}"
+        )
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import statistics
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from chat.consumers import ChatConsumer, SNAPSHOT_MESSAGES
+from chat.models import User, ChatRoom
+from chat.utils import presence
+from chat.utils.message_history import get_message_page
+from chat.utils.message_status import mark_messages_as_seen, get_read_watermarks
+from chat.utils.message_store import create_message
+
+PREFIX = 'consumer_loop_bench'
+
+
+class BenchSocket:
+    """Consumer whose socket only counts the acknowledgements it sends"""
+
+    def __init__(self):
+        super().__init__()
+        self.acks = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data and '"message_ack"' in text_data:
+            self.acks += 1
+
+    async def accept(self, subprotocol=None, headers=None):
+        pass
+
+
+class AsyncOrmSocket(BenchSocket, ChatConsumer):
+    pass
+
+
+class SyncToAsyncSocket(BenchSocket, ChatConsumer):
+    """The consumer's data access as it was, every call a database_sync_to_async hop"""
+
+    @database_sync_to_async
+    def load_snapshot(self, room_id):
+        messages_data, next_cursor, has_more = get_message_page(room_id, limit=SNAPSHOT_MESSAGES)
+        return {
+            'type': 'snapshot', 'room_id': room_id, 'messages': messages_data, 'next_cursor': next_cursor,
+            'has_more': has_more, 'read_watermarks': get_read_watermarks(room_id)
+        }
+
+    @database_sync_to_async
+    def mark_room_messages_as_seen(self, room_id):
+        return mark_messages_as_seen(room_id, self.user.id)
+
+    @database_sync_to_async
+    def load_rooms(self, room_ids):
+        rooms = {}
+        for user_id, room_id, is_group in ChatRoom.participants.through.objects.filter(
+            chatroom_id__in=room_ids
+        ).values_list('user_id', 'chatroom_id', 'chatroom__is_group'):
+            room = rooms.setdefault(room_id, {'room_id': room_id, 'is_group': is_group, 'participant_ids': set()})
+            room['participant_ids'].add(user_id)
+        return rooms
+
+    @database_sync_to_async
+    def persist_message(self, room_id, message_content):
+        try:
+            return create_message(room_id=room_id, sender=self.user, content=message_content)
+        except Exception:
+            return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare event-loop time per message of the chat consumer with database_sync_to_async "
+        "hops and with the async ORM / db executor, many sockets sending at the same time"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20, help='messages sent by each socket')
+        parser.add_argument('--seen-every', type=int, default=5, help='a mark_seen frame after every N messages')
+
+    def handle(self, *args, **options):
+        rooms = self.setup(options['rooms'])
+        try:
+            self.stdout.write(
+                f"{options['rooms'] * 2} sockets x {options['messages']} messages, "
+                f"database: {settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]}, "
+                f"db executor threads: {settings.CHAT_DB_EXECUTOR['MAX_WORKERS']}"
+            )
+            self.stdout.write(
+                f"{'consumer':<14} {'messages/s':>10} {'loop CPU us/msg':>16} {'p50 ms':>8} {'p99 ms':>8} "
+                f"{'max loop lag ms':>16} {'acked':>7}"
+            )
+            for name, socket_class in (('sync_to_async', SyncToAsyncSocket), ('async ORM', AsyncOrmSocket)):
+                # a warm-up pass, then the measured one
+                asyncio.run(self.run(socket_class, rooms, options))
+                self.report(name, *asyncio.run(self.run(socket_class, rooms, options)))
+        finally:
+            close_old_connections()
+            User.objects.filter(username__startswith=PREFIX).delete()
+
+    def setup(self, room_count):
+        User.objects.filter(username__startswith=PREFIX).delete()
+        users = User.objects.bulk_create([User(username=f'{PREFIX}_{i}') for i in range(room_count * 2)])
+        rooms = []
+        for i in range(room_count):
+            room, _ = ChatRoom.get_or_create_direct_chat(users[2 * i], users[2 * i + 1])
+            rooms.append((room.id, users[2 * i], users[2 * i + 1]))
+        return rooms
+
+    def report(self, name, count, elapsed, loop_cpu, latencies, max_lag, acked):
+        latencies.sort()
+        self.stdout.write(
+            f"{name:<14} {count / elapsed:>10.0f} {loop_cpu / count * 1e6:>16.0f} "
+            f"{statistics.median(latencies):>8.2f} {latencies[int(len(latencies) * 0.99) - 1]:>8.2f} "
+            f"{max_lag * 1000:>16.1f} {acked:>7}"
+        )
+
+    async def run(self, socket_class, rooms, options):
+        layer = InMemoryChannelLayer()
+        previous_tracker = presence._tracker
+        presence._tracker = presence.PresenceTracker(presence.InMemoryPresenceStore(), ttl=60, persist_interval=3600)
+
+        sockets = []
+        for room_id, *users in rooms:
+            for user in users:
+                socket = socket_class()
+                socket.scope = {'type': 'websocket', 'user': user, 'url_route': {'kwargs': {'room_id': str(room_id)}}}
+                socket.channel_layer = layer
+                socket.channel_name = await layer.new_channel()
+                await socket.connect()
+                sockets.append(socket)
+
+        # How late a 1 ms timer fires tells how long the loop was held by a single step
+        max_lag = 0
+        measuring = True
+
+        async def watch_lag():
+            nonlocal max_lag
+            while measuring:
+                expected = time.perf_counter() + 0.001
+                await asyncio.sleep(0.001)
+                max_lag = max(max_lag, time.perf_counter() - expected)
+
+        latencies = []
+
+        async def client(socket):
+            for i in range(options['messages']):
+                started = time.perf_counter()
+                await socket.receive(json.dumps({'type': 'message', 'message': f'message {i}'}))
+                latencies.append((time.perf_counter() - started) * 1000)
+                if (i + 1) % options['seen_every'] == 0:
+                    await socket.receive(json.dumps({'type': 'mark_seen'}))
+
+        watcher = asyncio.ensure_future(watch_lag())
+        # thread_time() counts the CPU time of the event loop thread only, not of the executor threads
+        cpu_started, started = time.thread_time(), time.perf_counter()
+        await asyncio.gather(*(client(socket) for socket in sockets))
+        elapsed, loop_cpu = time.perf_counter() - started, time.thread_time() - cpu_started
+        measuring = False
+        await watcher
+
+        for socket in sockets:
+            await socket.disconnect(1000)
+        if presence._tracker.task is not None:
+            presence._tracker.task.cancel()
+        presence._tracker = previous_tracker
+
+        count = len(sockets) * options['messages']
+        return count, elapsed, loop_cpu, latencies, max_lag, sum(socket.acks for socket in sockets)
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from chat.consumers import ChatConsumer
+
+
+class Socket(ChatConsumer):
+    """ChatConsumer whose socket only counts the frames sent to it"""
+
+    def __init__(self, channel_name, username):
+        super().__init__()
+        self.channel_name = channel_name
+        self.username = username
+        self.sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent += 1
+
+    # The previous handler: compare usernames and json.dumps the event for every socket
+    async def legacy_chat_message(self, event):
+        if event['username'] != self.username:
+            await self.send(text_data=json.dumps({
+                'type': 'message',
+                'message': event['message'],
+                'username': event['username'],
+                'user_id': event['user_id'],
+                'timestamp': event['timestamp']
+            }))
+
+
+class Command(BaseCommand):
+    help = "Measure the cost of delivering one chat message to rooms with many open sockets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--messages', type=int, default=200)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'sockets':>8} {'legacy us/msg':>14} {'pre-encoded us/msg':>19} {'speedup':>8}")
+        for sockets in options['sockets']:
+            legacy, current = asyncio.run(self.run(sockets, options['messages']))
+            self.stdout.write(f"{sockets:>8} {legacy:>14.1f} {current:>19.1f} {legacy / current:>7.1f}x")
+
+    async def run(self, sockets, messages):
+        consumers = [Socket(f'channel.{i}', f'user{i}') for i in range(sockets)]
+        frame = {
+            'type': 'message',
+            'message': 'Hello everyone, this is a fairly typical chat message ' * 2,
+            'message_id': 123456,
+            'message_uid': '0b5a8f6e-4c1b-4a55-9d0e-6d2f6b8f7a10',
+            'username': 'user0',
+            'user_id': 1,
+            'timestamp': '2025-07-04T12:00:00.000000+00:00',
+            'status': 'Delivered'
+        }
+        legacy_event = dict(frame, type='chat_message')
+
+        started = time.perf_counter()
+        for _ in range(messages):
+            for consumer in consumers:
+                await consumer.legacy_chat_message(legacy_event)
+        legacy = (time.perf_counter() - started) / messages * 1e6
+
+        started = time.perf_counter()
+        for _ in range(messages):
+            # what ChatConsumer.broadcast puts on the channel layer
+            event = {'type': 'chat_message', 'text': json.dumps(frame), 'sender_channel': 'channel.0'}
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        current = (time.perf_counter() - started) / messages * 1e6
+
+        return legacy, current
@@ -0,0 +1,97 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from chat.models import User, Friendship
+from chat.utils.friend_lists import get_friend_page, get_friend_request_page, MAX_FRIENDS_PAGE_SIZE
+
+
+def legacy_friends(user):
+    # What get_friends did before: the users of every friendship loaded one by one
+    friends_list = []
+    for friendship in Friendship.objects.filter(
+        Q(requester=user) | Q(addressee=user),
+        status__in=['accepted', 'Blocked']
+    ):
+        friend = friendship.addressee if friendship.requester == user else friendship.requester
+        friends_list.append({
+            'id': friend.id,
+            'name': friend.username,
+            'email': friend.email,
+            'photo_path': getattr(friend, 'user_photo_path', ''),
+            'friendship_id': friendship.id,
+            'status': friendship.status
+        })
+    return friends_list
+
+
+def legacy_requests(user):
+    return [{
+        'id': req.id,
+        'username': req.requester.username,
+        'user_photo_path': getattr(req.requester, 'user_photo_path', ''),
+        'created_at': req.created_at,
+        'friendship_id': req.id
+    } for req in Friendship.objects.filter(addressee=user, status='pending')]
+
+
+def every_page(get_page, user_id, limit):
+    rows, before_id = [], None
+    while True:
+        page, _, has_more = get_page(user_id, before_id=before_id, limit=limit)
+        rows += page
+        if not has_more:
+            return rows
+        before_id = page[-1]['friendship_id']
+
+
+class Command(BaseCommand):
+    help = "Compare the paginated friend list and friend request queries with the per-row lookups they replaced"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--friends', type=int, default=5000)
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def measure(self, function):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            rows = function()
+            elapsed = (time.perf_counter() - started) * 1000
+        return len(rows), len(queries), elapsed
+
+    def run(self, options):
+        user = User.objects.create(username='friend_list_bench')
+        others = User.objects.bulk_create([
+            User(username=f'friend_list_bench_{i}') for i in range(options['friends'] + options['requests'])
+        ])
+        Friendship.objects.bulk_create(
+            [
+                Friendship(requester=user, addressee=other, status='accepted') if i % 2
+                else Friendship(requester=other, addressee=user, status='accepted')
+                for i, other in enumerate(others[:options['friends']])
+            ]
+            + [Friendship(requester=other, addressee=user, status='pending') for other in others[options['friends']:]]
+        )
+        self.stdout.write(
+            f"database: {connection.vendor}, {options['friends']} friends, {options['requests']} pending requests"
+        )
+
+        cases = [
+            ('friends, old', lambda: legacy_friends(user)),
+            ('friends, first page', lambda: get_friend_page(user.id)[0]),
+            ('friends, every page', lambda: every_page(get_friend_page, user.id, MAX_FRIENDS_PAGE_SIZE)),
+            ('requests, old', lambda: legacy_requests(user)),
+            ('requests, first page', lambda: get_friend_request_page(user.id)[0]),
+            ('requests, every page', lambda: every_page(get_friend_request_page, user.id, MAX_FRIENDS_PAGE_SIZE)),
+        ]
+        self.stdout.write(f"{'listing':<22} {'rows':>6} {'queries':>8} {'ms':>9}")
+        for name, function in cases:
+            rows, queries, elapsed = self.measure(function)
+            self.stdout.write(f"{name:<22} {rows:>6} {queries:>8} {elapsed:>9.1f}")
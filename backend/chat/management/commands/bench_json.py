@@ -0,0 +1,86 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from chat.utils import fast_json
+
+
+def history_rows(count):
+    """Rows as get_message_page reads them from the database"""
+    started = timezone.now()
+    return [
+        {
+            'id': 1000000 + i,
+            'content': f'Message number {i} of a fairly ordinary conversation between two friends',
+            'sender_id': 20871 if i % 2 else 20872,
+            'sender__username': 'nour_hassan' if i % 2 else 'omar_k',
+            'timestamp': started + timedelta(seconds=i),
+            'status': 'Seen'
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_response(rows):
+    # Timestamps formatted one by one in Python, then the stdlib encoder
+    messages_data = [{
+        'id': row['id'],
+        'content': row['content'],
+        'sender_id': row['sender_id'],
+        'sender_username': row['sender__username'],
+        'timestamp': row['timestamp'].isoformat(),
+        'status': row['status']
+    } for row in rows]
+    return JsonResponse({'success': True, 'messages': messages_data, 'read_watermarks': {20871: 1, 20872: 2}})
+
+
+def fast_response(rows, dumps_bytes):
+    # What get_messages does now: datetimes are left to the encoder, FastJsonResponse with the given backend
+    messages_data = [{
+        'id': row['id'],
+        'content': row['content'],
+        'sender_id': row['sender_id'],
+        'sender_username': row['sender__username'],
+        'timestamp': row['timestamp'],
+        'status': row['status']
+    } for row in rows]
+    return HttpResponse(
+        dumps_bytes({'success': True, 'messages': messages_data, 'read_watermarks': {20871: 1, 20872: 2}}),
+        content_type='application/json'
+    )
+
+
+def best_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+class Command(BaseCommand):
+    help = "Compare JsonResponse with FastJsonResponse on a message history payload"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = history_rows(options['messages'])
+        repeat = options['repeat']
+
+        legacy = best_ms(lambda: legacy_response(rows), repeat)
+        self.stdout.write(f"backend detected: {fast_json.BACKEND}")
+        self.stdout.write(f"{options['messages']} messages, {len(legacy_response(rows).content) / 1024:.0f} KiB")
+        self.stdout.write(f"{'path':<34} {'ms':>8} {'speedup':>8}")
+        self.stdout.write(f"{'JsonResponse + isoformat()':<34} {legacy:>8.2f} {1:>7.1f}x")
+
+        backends = [('stdlib', fast_json.stdlib_dumps_bytes)]
+        if fast_json.orjson is not None:
+            backends.append(('orjson', fast_json.orjson_dumps_bytes))
+        for name, dumps_bytes in backends:
+            elapsed = best_ms(lambda: fast_response(rows, dumps_bytes), repeat)
+            self.stdout.write(f"{'FastJsonResponse (' + name + ')':<34} {elapsed:>8.2f} {legacy / elapsed:>7.1f}x")
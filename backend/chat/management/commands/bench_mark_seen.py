@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from chat.models import User, ChatRoom, Message
+from chat.utils.message_status import mark_messages_as_seen
+
+
+class Command(BaseCommand):
+    help = "Show that mark_messages_as_seen runs a constant number of queries as the unseen backlog grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backlog', type=int, nargs='+', default=[10, 100, 1000, 10000])
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'backlog':>8} {'queries':>8} {'ms':>10}")
+        for backlog in options['backlog']:
+            # Everything created here is rolled back
+            with transaction.atomic():
+                queries, elapsed = self.run(backlog)
+                transaction.set_rollback(True)
+            self.stdout.write(f"{backlog:>8} {queries:>8} {elapsed * 1000:>10.2f}")
+
+    def run(self, backlog):
+        sender = User.objects.create(username=f'bench_sender_{time.time_ns()}')
+        reader = User.objects.create(username=f'bench_reader_{time.time_ns()}')
+        room = ChatRoom.objects.create(is_group=False)
+        room.participants.add(sender, reader)
+        messages = Message.objects.bulk_create(
+            [Message(room=room, sender=sender, content=f'message {i}', status='Delivered') for i in range(backlog)],
+            batch_size=1000
+        )
+        room.last_message = messages[-1]
+        room.save(update_fields=['last_message'])
+
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            last_seen_message_id = mark_messages_as_seen(room.id, reader.id)
+            elapsed = time.perf_counter() - started
+
+        assert last_seen_message_id == messages[-1].id
+        return len(context.captured_queries), elapsed
@@ -0,0 +1,75 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from chat.models import User, ChatRoom, Message
+from chat.utils.message_store import create_message, update_chat_list
+
+
+class QueryCounter:
+    """Database execute wrapper counting every statement sent, savepoints included"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def legacy_persist(room_id, user, content):
+    """The previous ChatConsumer path: load room, check membership, insert Pending, re-fetch, save Delivered"""
+    room = ChatRoom.objects.get(id=room_id)
+    if not room.participants.filter(id=user.id).exists():
+        return None
+    with transaction.atomic():
+        message = Message.objects.create(sender=user, room=room, content=content, status='Pending', timestamp=timezone.now())
+        update_chat_list(room_id, message, {user.id: 1})
+    # second thread-pool hop in the consumer
+    message = Message.objects.get(id=message.id)
+    message.status = 'Delivered'
+    message.delivered_at = timezone.now()
+    message.save()
+    return message
+
+
+def current_persist(room_id, user, content):
+    """The ChatConsumer.save_message path, membership is cached on the connection"""
+    return create_message(room_id=room_id, sender=user, content=content)
+
+
+class Command(BaseCommand):
+    help = "Measure per-message persistence latency and statements of the chat send path, old and new"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'path':>8} {'queries/msg':>12} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for name, persist in (('legacy', legacy_persist), ('current', current_persist)):
+            # Everything created here is rolled back
+            with transaction.atomic():
+                self.run(name, persist, options['messages'])
+                transaction.set_rollback(True)
+
+    def run(self, name, persist, count):
+        sender = User.objects.create(username=f'bench_sender_{time.time_ns()}')
+        reader = User.objects.create(username=f'bench_reader_{time.time_ns()}')
+        room = ChatRoom.objects.create(is_group=False)
+        room.participants.add(sender, reader)
+
+        latencies = []
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            for i in range(count):
+                started = time.perf_counter()
+                persist(room.id, sender, f'message {i}')
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        latencies.sort()
+        self.stdout.write(
+            f"{name:>8} {counter.count / count:>12.1f} {statistics.mean(latencies):>8.3f} "
+            f"{latencies[len(latencies) // 2]:>8.3f} {latencies[int(len(latencies) * 0.99)]:>8.3f}"
+        )
@@ -0,0 +1,106 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from chat.models import User, ChatRoom, Message
+from chat.utils.message_search import create_search_index, search_user_messages
+
+
+def vocabulary(size):
+    """Pronounceable made-up words, ranked by frequency"""
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'bi', 'de', 'fa', 'go', 'hu', 'ji', 'po', 'ze']
+    words = set()
+    rng = random.Random(7)
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+class Command(BaseCommand):
+    help = "Measure message search latency on a synthetic corpus, against an icontains scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000_000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--vocabulary', type=int, default=50000)
+        parser.add_argument('--searches', type=int, default=20, help='searches per query kind')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        rng = random.Random(42)
+        create_search_index(connection)
+        self.stdout.write(f"database: {connection.vendor}")
+
+        users = User.objects.bulk_create([
+            User(username=f'search_bench_{i}') for i in range(options['users'])
+        ])
+        # a ring of direct chats, every user is in two rooms
+        rooms = ChatRoom.objects.bulk_create([ChatRoom(is_group=False) for _ in users])
+        Through = ChatRoom.participants.through
+        Through.objects.bulk_create(
+            [Through(chatroom_id=room.id, user_id=users[i].id) for i, room in enumerate(rooms)]
+            + [Through(chatroom_id=room.id, user_id=users[(i + 1) % len(users)].id) for i, room in enumerate(rooms)]
+        )
+
+        # Zipf-like word frequencies
+        words = vocabulary(options['vocabulary'])
+        cum_weights = []
+        total = 0.0
+        for rank in range(1, len(words) + 1):
+            total += 1 / rank
+            cum_weights.append(total)
+
+        started_at = timezone.now()
+        inserted = 0
+        insert_started = time.perf_counter()
+        while inserted < options['messages']:
+            batch = []
+            for i in range(min(options['batch_size'], options['messages'] - inserted)):
+                room_index = rng.randrange(len(rooms))
+                batch.append(Message(
+                    room_id=rooms[room_index].id,
+                    sender_id=users[(room_index + rng.randint(0, 1)) % len(users)].id,
+                    content=' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(5, 20))),
+                    timestamp=started_at + timedelta(milliseconds=inserted + i),
+                    status='Seen'
+                ))
+            Message.objects.bulk_create(batch)
+            inserted += len(batch)
+            self.stdout.write(f"\rinserted {inserted}", ending='')
+        insert_elapsed = time.perf_counter() - insert_started
+        self.stdout.write(f"\n{inserted} messages inserted with the index maintained: {inserted / insert_elapsed:.0f} messages/s")
+
+        kinds = {
+            'common word': [words[rng.randrange(0, 10)] for _ in range(options['searches'])],
+            'mid word': [words[rng.randrange(100, 1000)] for _ in range(options['searches'])],
+            'rare word': [words[rng.randrange(10000, len(words))] for _ in range(options['searches'])],
+            'two words': [f'{words[rng.randrange(0, 50)]} {words[rng.randrange(50, 500)]}' for _ in range(options['searches'])],
+        }
+        self.stdout.write(f"{'query':<12} {'index p50 ms':>13} {'index p95 ms':>13} {'icontains p50 ms':>17}")
+        for kind, queries in kinds.items():
+            indexed, scanned = [], []
+            for query in queries:
+                user = users[rng.randrange(len(users))]
+                started = time.perf_counter()
+                search_user_messages(user.id, query)
+                indexed.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                list(Message.objects.filter(
+                    room__participants__id=user.id, content__icontains=query
+                ).order_by('-id').values_list('id', flat=True)[:21])
+                scanned.append((time.perf_counter() - started) * 1000)
+            indexed.sort()
+            self.stdout.write(
+                f"{kind:<12} {statistics.median(indexed):>13.2f} {indexed[int(len(indexed) * 0.95) - 1]:>13.2f} "
+                f"{statistics.median(scanned):>17.2f}"
+            )
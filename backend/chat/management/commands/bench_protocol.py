@@ -0,0 +1,92 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from chat.protocol import JSON, MSGPACK
+
+
+def sample_frames():
+    """One frame of each kind a chat socket receives most, with realistic values"""
+    timestamp = '2025-07-04T12:00:00.123456+00:00'
+    message = {
+        'type': 'message',
+        'room_id': 1842,
+        'message': 'Are we still meeting at the library tomorrow afternoon?',
+        'message_id': 3904512,
+        'message_uid': '0b5a8f6e-4c1b-4a55-9d0e-6d2f6b8f7a10',
+        'username': 'nour_hassan',
+        'user_id': 20871,
+        'timestamp': timestamp,
+        'status': 'Delivered'
+    }
+    return {
+        'message': message,
+        'message_ack': {
+            'type': 'message_ack', 'room_id': 1842, 'message_id': 3904512,
+            'message_uid': '0b5a8f6e-4c1b-4a55-9d0e-6d2f6b8f7a10', 'timestamp': timestamp
+        },
+        'typing': {'type': 'typing', 'room_id': 1842, 'started': ['nour_hassan'], 'stopped': []},
+        'messages_seen': {
+            'type': 'messages_seen', 'room_id': 1842, 'last_seen_message_id': 3904512,
+            'user_id': 20871, 'seen_by': 'nour_hassan'
+        },
+        'inbox_update': {
+            'type': 'inbox_update',
+            'rooms': [{
+                'room_id': 1842, 'unread_count': 3, 'last_message_at': timestamp,
+                'last_message': message['message'], 'last_sender': 'nour_hassan'
+            }]
+        },
+        'snapshot (50 messages)': {
+            'type': 'snapshot',
+            'room_id': 1842,
+            'messages': [
+                {
+                    'id': 3904462 + i,
+                    'content': message['message'],
+                    'sender_id': 20871 if i % 2 else 20872,
+                    'sender_username': 'nour_hassan' if i % 2 else 'omar_k',
+                    'timestamp': timestamp,
+                    'status': 'Seen'
+                }
+                for i in range(50)
+            ],
+            'next_cursor': 'eyJiZWZvcmVfaWQiOiAzOTA0NDYyfQ',
+            'has_more': True,
+            'read_watermarks': {20871: 3904511, 20872: 3904500},
+            'online_users': ['nour_hassan', 'omar_k']
+        },
+    }
+
+
+def per_call_us(function, argument, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+class Command(BaseCommand):
+    help = "Compare bytes per frame and encode/decode CPU of the JSON and MessagePack chat protocols"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if MSGPACK is None:
+            raise CommandError('The binary protocol needs the msgpack package')
+
+        iterations = options['iterations']
+        self.stdout.write(
+            f"{'frame':<24} {'json B':>7} {'msgpack B':>10} {'saved':>6} "
+            f"{'json enc us':>12} {'mp enc us':>10} {'json dec us':>12} {'mp dec us':>10}"
+        )
+        for name, frame in sample_frames().items():
+            text, binary = JSON.encode(frame), MSGPACK.encode(frame)
+            # snapshots are much bigger, keep the run time comparable
+            runs = max(iterations // 50, 100) if name.startswith('snapshot') else iterations
+            json_bytes = len(text.encode())
+            self.stdout.write(
+                f"{name:<24} {json_bytes:>7} {len(binary):>10} {1 - len(binary) / json_bytes:>6.0%} "
+                f"{per_call_us(JSON.encode, frame, runs):>12.2f} {per_call_us(MSGPACK.encode, frame, runs):>10.2f} "
+                f"{per_call_us(JSON.decode, text, runs):>12.2f} {per_call_us(MSGPACK.decode, binary, runs):>10.2f}"
+            )
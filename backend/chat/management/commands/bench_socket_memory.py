@@ -0,0 +1,121 @@
+import asyncio
+import gc
+import json
+import tracemalloc
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from chat.consumers import ChatConsumer, MultiplexChatConsumer
+from chat.models import User
+from chat.utils import presence
+
+
+class BenchSocket:
+    """Consumer whose database calls are answered from memory and whose socket only counts frames"""
+
+    def __init__(self, rooms):
+        super().__init__()
+        self.bench_rooms = rooms
+        self.sent = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent += 1
+
+    async def accept(self, subprotocol=None, headers=None):
+        pass
+
+    async def load_rooms(self, room_ids):
+        return {room_id: dict(self.bench_rooms[room_id]) for room_id in room_ids if room_id in self.bench_rooms}
+
+    async def load_snapshot(self, room_id):
+        return {'type': 'snapshot', 'room_id': room_id, 'messages': [], 'next_cursor': None,
+                'has_more': False, 'read_watermarks': {}}
+
+    async def mark_room_messages_as_seen(self, room_id):
+        return None
+
+
+class PerRoomSocket(BenchSocket, ChatConsumer):
+    pass
+
+
+class MultiplexSocket(BenchSocket, MultiplexChatConsumer):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare the server-side memory of one socket per room with one multiplexed socket per user"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--rooms', type=int, default=30, help='open rooms per user')
+
+    def handle(self, *args, **options):
+        users, rooms_per_user = options['users'], options['rooms']
+        # user u has rooms u, u+1, ... u+rooms-1 (mod users), so every room has `rooms` participants
+        memberships = {u: [(u + k) % users for k in range(rooms_per_user)] for u in range(users)}
+        rooms = {room_id: {'room_id': room_id, 'is_group': rooms_per_user > 2, 'participant_ids': set()}
+                 for room_id in range(users)}
+        for u, room_ids in memberships.items():
+            for room_id in room_ids:
+                rooms[room_id]['participant_ids'].add(u)
+
+        self.stdout.write(f"{users} users with {rooms_per_user} open rooms each")
+        self.stdout.write(
+            f"{'consumer':>10} {'sockets/user':>13} {'groups/user':>12} {'auth passes/user':>17} {'KiB/user':>9}"
+        )
+        for name in ('per-room', 'multiplex'):
+            sockets, memberships_count, used = asyncio.run(self.run(name, memberships, rooms))
+            self.stdout.write(
+                f"{name:>10} {sockets / users:>13.0f} {memberships_count / users:>12.0f} "
+                f"{sockets / users:>17.0f} {used / users / 1024:>9.1f}"
+            )
+
+    async def run(self, name, memberships, rooms):
+        layer = InMemoryChannelLayer()
+        # A fresh in-memory presence tracker, so the run measures the presence entries it creates
+        previous_tracker = presence._tracker
+        presence._tracker = presence.PresenceTracker(presence.InMemoryPresenceStore(), ttl=60, persist_interval=30)
+        user_objects = {u: User(id=u, username=f'user{u}') for u in memberships}
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+
+        consumers = []
+        for u, room_ids in memberships.items():
+            if name == 'per-room':
+                for room_id in room_ids:
+                    consumers.append(await self.open(
+                        PerRoomSocket(rooms), layer, user_objects[u], {'room_id': str(room_id)}
+                    ))
+            else:
+                consumer = await self.open(MultiplexSocket(rooms), layer, user_objects[u], {})
+                await consumer.receive(json.dumps({'type': 'subscribe', 'room_ids': room_ids}))
+                consumers.append(consumer)
+
+        # Live servers drain the join notifications, so queued events are not counted
+        for consumer in consumers:
+            queue = layer.channels.get(consumer.channel_name)
+            while queue is not None and not queue.empty():
+                queue.get_nowait()
+
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+        group_memberships = sum(len(channels) for channels in layer.groups.values())
+        for consumer in consumers:
+            await consumer.disconnect(1000)
+        if presence._tracker.task is not None:
+            presence._tracker.task.cancel()
+        presence._tracker = previous_tracker
+        return len(consumers), group_memberships, used
+
+    async def open(self, consumer, layer, user, route_kwargs):
+        consumer.scope = {'type': 'websocket', 'user': user, 'url_route': {'kwargs': route_kwargs}}
+        consumer.channel_layer = layer
+        consumer.channel_name = await layer.new_channel()
+        await consumer.connect()
+        return consumer
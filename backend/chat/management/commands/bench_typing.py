@@ -0,0 +1,54 @@
+import asyncio
+import random
+
+from django.core.management.base import BaseCommand
+from chat.utils.typing_indicators import TypingState, RoomTypingAggregator, typing_stats
+
+
+class Command(BaseCommand):
+    help = "Simulate fast typists in one room and report the channel-layer traffic saved by typing coalescing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--typists', type=int, nargs='+', default=[1, 10, 50])
+        parser.add_argument('--seconds', type=float, default=3.0)
+        parser.add_argument('--keystroke', type=float, default=0.05, help='seconds between typing frames')
+        # Timings are scaled down from the production defaults so a run stays short
+        parser.add_argument('--debounce', type=float, default=0.2)
+        parser.add_argument('--timeout', type=float, default=1.0)
+        parser.add_argument('--interval', type=float, default=0.1)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'typists':>8} {'frames':>8} {'edges':>8} {'events':>8} {'reduction':>10}")
+        for typists in options['typists']:
+            typing_stats.clear()
+            asyncio.run(self.run(typists, options))
+            frames, edges, events = typing_stats['frames'], typing_stats['edges'], typing_stats['events']
+            # Without coalescing every frame was one group_send
+            self.stdout.write(f"{typists:>8} {frames:>8} {edges:>8} {events:>8} {frames / max(events, 1):>9.1f}x")
+
+    async def run(self, typists, options):
+        async def send(frame):
+            pass
+
+        aggregator = RoomTypingAggregator(send, interval=options['interval'])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + options['seconds']
+
+        async def typist(name):
+            state = TypingState(
+                lambda is_typing: aggregator.add(name, is_typing),
+                debounce=options['debounce'],
+                timeout=options['timeout']
+            )
+            while loop.time() < deadline:
+                # a burst of keystrokes, a short hesitation or a long pause
+                for _ in range(random.randint(5, 40)):
+                    state.update(True)
+                    await asyncio.sleep(options['keystroke'] * random.uniform(0.5, 1.5))
+                if random.random() < 0.3:
+                    state.update(False)
+                await asyncio.sleep(random.choice([options['keystroke'] * 2, options['debounce'] * 3]))
+            state.stop()
+
+        await asyncio.gather(*(typist(f'user{i}') for i in range(typists)))
+        await asyncio.sleep(options['interval'] * 2)
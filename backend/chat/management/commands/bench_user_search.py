@@ -0,0 +1,100 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from chat.models import User, Friendship
+from chat.utils.user_search import create_user_search_index, parse_user_search_args, search_users
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'bi', 'de', 'fa', 'go', 'hu', 'ji', 'po', 'ze', 'nour', 'omar']
+
+
+def legacy_search(user, name):
+    # What search_user did before: every match, every friendship with lazy user access, emails included
+    users = User.objects.filter(username__icontains=name).exclude(id=user.id)
+    friendship_status = {}
+    for friendship in Friendship.objects.filter(Q(requester=user) | Q(addressee=user)):
+        friend_id = friendship.addressee.id if friendship.requester == user else friendship.requester.id
+        friendship_status[friend_id] = friendship.status
+    return [
+        {'id': u.id, 'name': u.username, 'email': u.email, 'friendship_status': friendship_status.get(u.id, 'none')}
+        for u in users
+    ]
+
+
+class Command(BaseCommand):
+    help = "Measure username search latency on a synthetic user table, against the unbounded icontains search"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--friends', type=int, default=500, help='friendships of the searching user')
+        parser.add_argument('--searches', type=int, default=20, help='searches per query kind')
+        parser.add_argument('--legacy-searches', type=int, default=3, help='runs of the old search per query kind')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        rng = random.Random(42)
+        create_user_search_index(connection)
+        self.stdout.write(f"database: {connection.vendor}")
+
+        inserted = 0
+        insert_started = time.perf_counter()
+        while inserted < options['users']:
+            batch = [
+                User(username=''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + f'_{inserted + i}')
+                for i in range(min(options['batch_size'], options['users'] - inserted))
+            ]
+            User.objects.bulk_create(batch)
+            inserted += len(batch)
+            self.stdout.write(f"\rinserted {inserted}", ending='')
+        self.stdout.write(f"\n{inserted} users inserted in {time.perf_counter() - insert_started:.1f}s")
+
+        searcher = User.objects.create(username='user_search_bench')
+        others = rng.sample(range(searcher.id - inserted, searcher.id), min(options['friends'], inserted))
+        Friendship.objects.bulk_create([
+            Friendship(requester=searcher, addressee_id=other, status=rng.choice(['accepted', 'accepted', 'pending']))
+            for other in others
+        ])
+
+        kinds = {
+            '1-char prefix': lambda: rng.choice(SYLLABLES)[0],
+            'syllable': lambda: rng.choice(SYLLABLES),
+            'two syllables': lambda: rng.choice(SYLLABLES) + rng.choice(SYLLABLES),
+            'exact name': lambda: User.objects.filter(id=searcher.id - rng.randint(1, inserted)).values_list('username', flat=True).first(),
+            'no match': lambda: 'qqq',
+        }
+        self.stdout.write(
+            f"{'query':<14} {'page 1 p50 ms':>14} {'page 1 p95 ms':>14} {'page 2 p50 ms':>14} {'old p50 ms':>11} {'old rows':>9}"
+        )
+        for kind, make_query in kinds.items():
+            queries = [make_query() for _ in range(options['searches'])]
+            first_pages, second_pages = [], []
+            for query in queries:
+                started = time.perf_counter()
+                _, next_cursor, has_more = search_users(searcher.id, query)
+                first_pages.append((time.perf_counter() - started) * 1000)
+                if has_more:
+                    started = time.perf_counter()
+                    search_users(searcher.id, **parse_user_search_args({'name': query, 'cursor': next_cursor}))
+                    second_pages.append((time.perf_counter() - started) * 1000)
+
+            legacy, rows = [], 0
+            for query in queries[:options['legacy_searches']]:
+                started = time.perf_counter()
+                rows = len(legacy_search(searcher, query))
+                legacy.append((time.perf_counter() - started) * 1000)
+
+            first_pages.sort()
+            self.stdout.write(
+                f"{kind:<14} {statistics.median(first_pages):>14.2f} {first_pages[int(len(first_pages) * 0.95) - 1]:>14.2f} "
+                f"{statistics.median(second_pages) if second_pages else 0:>14.2f} "
+                f"{statistics.median(legacy) if legacy else 0:>11.2f} {rows:>9}"
+            )
+
@@ -0,0 +1,82 @@
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.models import User
+from chat.utils.username_index import UsernameIndex
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'bi', 'de', 'fa', 'go', 'hu', 'ji', 'po', 'ze', 'nour', 'omar']
+
+
+class Command(BaseCommand):
+    help = "Measure the build time, memory and query latency of the username autocomplete index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--queries', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        rng = random.Random(42)
+        inserted = 0
+        while inserted < options['users']:
+            User.objects.bulk_create([
+                User(username=''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + f'_{inserted + i}')
+                for i in range(min(options['batch_size'], options['users'] - inserted))
+            ])
+            inserted += min(options['batch_size'], options['users'] - inserted)
+            self.stdout.write(f"\rinserted {inserted}", ending='')
+        self.stdout.write('')
+
+        index = UsernameIndex(max_users=options['users'] + 1, max_age=600)
+        started = time.perf_counter()
+        index.build()
+        self.stdout.write(f"build from the database: {time.perf_counter() - started:.2f}s for {len(index.ids)} users")
+
+        # Again under tracemalloc, which slows the build down but sees every allocation
+        tracemalloc.start()
+        index = UsernameIndex(max_users=options['users'] + 1, max_age=600)
+        index.build()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            f"memory: {retained / 2**20:.1f} MiB retained ({retained / len(index.ids):.0f} B/user), "
+            f"{peak / 2**20:.1f} MiB peak while building"
+        )
+
+        self.stdout.write(f"{'prefix':<10} {'p50 us':>8} {'p99 us':>8}")
+        for length in (1, 2, 4, 8):
+            timings = []
+            for _ in range(options['queries']):
+                prefix = index.usernames[rng.randrange(len(index.usernames))][:length]
+                started = time.perf_counter()
+                index.search(prefix, 10)
+                timings.append((time.perf_counter() - started) * 1e6)
+            timings.sort()
+            self.stdout.write(
+                f"{str(length) + ' chars':<10} {statistics.median(timings):>8.1f} {timings[int(len(timings) * 0.99) - 1]:>8.1f}"
+            )
+
+        timings = {'new user': [], 'unchanged save': [], 'rename': []}
+        for i in range(100):
+            user_id = index.ids[rng.randrange(len(index.ids))]
+            started = time.perf_counter()
+            index.put(10**9 + i, f'new_user_{i}', created=True)
+            timings['new user'].append((time.perf_counter() - started) * 1e6)
+            position = index.ids.index(user_id)
+            started = time.perf_counter()
+            index.put(user_id, index.usernames[position])
+            timings['unchanged save'].append((time.perf_counter() - started) * 1e6)
+            started = time.perf_counter()
+            index.put(user_id, f'renamed_{i}')
+            timings['rename'].append((time.perf_counter() - started) * 1e6)
+        for kind, values in timings.items():
+            self.stdout.write(f"{kind + ' p50 us':<20} {statistics.median(values):>8.1f}")
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from chat.models import User, ChatRoom, Message
+from chat.utils.message_store import create_message
+from chat.utils.write_behind import flush_messages
+
+
+class Command(BaseCommand):
+    help = "Compare insert throughput of per-message saves and write-behind micro-batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10, 50, 200])
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        self.stdout.write(f"{'mode':>16} {'seconds':>8} {'messages/s':>11}")
+        self.report('per-message', count, self.run(count, None))
+        for batch_size in options['batch_sizes']:
+            self.report(f'batched x{batch_size}', count, self.run(count, batch_size))
+
+    def report(self, name, count, elapsed):
+        self.stdout.write(f"{name:>16} {elapsed:>8.3f} {count / elapsed:>11.0f}")
+
+    def run(self, count, batch_size):
+        # Everything created here is rolled back
+        with transaction.atomic():
+            sender = User.objects.create(username=f'bench_sender_{time.time_ns()}')
+            reader = User.objects.create(username=f'bench_reader_{time.time_ns()}')
+            room = ChatRoom.objects.create(is_group=False)
+            room.participants.add(sender, reader)
+
+            started = time.perf_counter()
+            if batch_size is None:
+                for i in range(count):
+                    create_message(room_id=room.id, sender=sender, content=f'message {i}')
+            else:
+                for start in range(0, count, batch_size):
+                    now = timezone.now()
+                    flush_messages([
+                        Message(room_id=room.id, sender_id=sender.id, content=f'message {i}',
+                                timestamp=now, status='Delivered', delivered_at=now)
+                        for i in range(start, min(start + batch_size, count))
+                    ])
+            elapsed = time.perf_counter() - started
+
+            transaction.set_rollback(True)
+        return elapsed
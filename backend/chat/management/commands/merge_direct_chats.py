@@ -0,0 +1,83 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from chat.models import ChatRoom, Message, InboxEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Set ChatRoom.direct_key on the direct chats created before it existed, merging the duplicate "
+        "direct chats of a pair of users into the oldest one. Run once after upgrading."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report what would change')
+
+    def handle(self, *args, **options):
+        # The participants of every direct chat, in one pass over the through table
+        participants = defaultdict(list)
+        memberships = ChatRoom.participants.through.objects.filter(
+            chatroom__is_group=False
+        ).values_list('chatroom_id', 'user_id')
+        for room_id, user_id in memberships.iterator():
+            participants[room_id].append(user_id)
+
+        rooms_by_key = defaultdict(list)
+        skipped = 0
+        for room_id, user_ids in participants.items():
+            if len(user_ids) != 2:
+                # A direct chat someone left, or a self chat: no pair to key it by
+                skipped += 1
+                continue
+            rooms_by_key[ChatRoom.direct_key_for(*user_ids)].append(room_id)
+
+        keyed = dict(ChatRoom.objects.filter(direct_key__isnull=False).values_list('direct_key', 'id'))
+        keys_set = merged = 0
+        for key, room_ids in rooms_by_key.items():
+            # A room that already has the key stays, otherwise the oldest one
+            keeper_id = keyed.get(key) or min(room_ids)
+            duplicate_ids = [room_id for room_id in room_ids if room_id != keeper_id]
+            if not duplicate_ids and keyed.get(key) == keeper_id:
+                continue
+            if not options['dry_run']:
+                self.merge(key, keeper_id, duplicate_ids)
+            keys_set += 1
+            merged += len(duplicate_ids)
+
+        prefix = 'Would set' if options['dry_run'] else 'Set'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} the direct key of {keys_set} direct chats, merging {merged} duplicate rooms into them"
+        ))
+        if skipped:
+            self.stdout.write(f"Skipped {skipped} direct chats that do not have exactly two participants")
+
+    @transaction.atomic
+    def merge(self, key, keeper_id, duplicate_ids):
+        if duplicate_ids:
+            # Keep the highest read watermark of each user over the merged rooms
+            watermarks = dict(
+                InboxEntry.objects.filter(room_id__in=[keeper_id, *duplicate_ids])
+                .values('user_id').annotate(watermark=Max('last_seen_message_id'))
+                .values_list('user_id', 'watermark')
+            )
+            Message.objects.filter(room_id__in=duplicate_ids).update(room_id=keeper_id)
+            # Their inbox rows, presence rows and memberships go with them
+            ChatRoom.objects.filter(id__in=duplicate_ids).delete()
+
+            latest = Message.objects.filter(room_id=keeper_id).order_by('-id').values('id', 'timestamp').first()
+            ChatRoom.objects.filter(id=keeper_id).update(
+                last_message_id=latest and latest['id'],
+                last_message_at=latest and latest['timestamp']
+            )
+            for entry in InboxEntry.objects.filter(room_id=keeper_id):
+                entry.last_seen_message_id = watermarks.get(entry.user_id, entry.last_seen_message_id)
+                entry.unread_count = Message.objects.filter(
+                    room_id=keeper_id, id__gt=entry.last_seen_message_id
+                ).exclude(sender_id=entry.user_id).count()
+                if latest:
+                    entry.last_activity_at = max(entry.last_activity_at, latest['timestamp'])
+                entry.save(update_fields=['last_seen_message_id', 'unread_count', 'last_activity_at'])
+
+        ChatRoom.objects.filter(id=keeper_id).update(direct_key=key)
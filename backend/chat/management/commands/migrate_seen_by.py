@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from chat.models import InboxEntry, Message
+
+LEGACY_TABLE = 'chat_message_seen_by'
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert the legacy Message.seen_by many-to-many table into per-participant read watermarks "
+        "(InboxEntry.last_seen_message_id), run rebuild_chat_list first so every participant has an inbox row. "
+        "The table is dropped by the later change that removes the deprecated field."
+    )
+
+    def handle(self, *args, **options):
+        if LEGACY_TABLE not in connection.introspection.table_names():
+            self.stdout.write(f"No {LEGACY_TABLE} table, nothing to migrate")
+            return
+
+        quote = connection.ops.quote_name
+        # The highest message a user marked as seen in a room becomes that user's watermark
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT s.user_id, m.room_id, MAX(s.message_id) "
+                f"FROM {quote(LEGACY_TABLE)} s JOIN {quote(Message._meta.db_table)} m ON m.id = s.message_id "
+                f"GROUP BY s.user_id, m.room_id"
+            )
+            watermarks = {(user_id, room_id): message_id for user_id, room_id, message_id in cursor.fetchall()}
+
+        entries = list(InboxEntry.objects.filter(
+            user_id__in={user_id for user_id, _ in watermarks},
+            room_id__in={room_id for _, room_id in watermarks}
+        ))
+        changed = []
+        for entry in entries:
+            watermark = watermarks.get((entry.user_id, entry.room_id))
+            if watermark and watermark > entry.last_seen_message_id:
+                entry.last_seen_message_id = watermark
+                changed.append(entry)
+
+        with transaction.atomic():
+            InboxEntry.objects.bulk_update(changed, ['last_seen_message_id'], batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(f"Set {len(changed)} read watermarks from {LEGACY_TABLE}"))
+        self.stdout.write("Run rebuild_chat_list again to recompute unread counts from the watermarks")
+        self.stdout.write("Message.seen_by can be removed once this has run on every database")
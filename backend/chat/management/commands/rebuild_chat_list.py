@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from chat.models import ChatRoom, Message, InboxEntry
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized chat list data (last messages and inbox rows) from the messages table"
+
+    def handle(self, *args, **options):
+        latest = Message.objects.filter(room=OuterRef('pk')).order_by('-id')
+        updated = ChatRoom.objects.update(
+            last_message=Subquery(latest.values('id')[:1]),
+            last_message_at=Subquery(latest.values('timestamp')[:1])
+        )
+        self.stdout.write(self.style.SUCCESS(f"Updated the last message of {updated} chat rooms"))
+
+        # Every participant gets an inbox row
+        memberships = ChatRoom.participants.through.objects.values_list('user_id', 'chatroom_id')
+        InboxEntry.objects.bulk_create(
+            [InboxEntry(user_id=user_id, room_id=room_id) for user_id, room_id in memberships.iterator()],
+            ignore_conflicts=True,
+            batch_size=1000
+        )
+
+        # Unread = messages from other users after the inbox owner's read watermark
+        unread = Message.objects.filter(
+            room_id=OuterRef('room_id'),
+            id__gt=OuterRef('last_seen_message_id')
+        ).exclude(
+            sender_id=OuterRef('user_id')
+        ).order_by().values('room_id').annotate(count=Count('id')).values('count')
+        room_activity = ChatRoom.objects.filter(id=OuterRef('room_id')).values('last_message_at')[:1]
+        room_created = ChatRoom.objects.filter(id=OuterRef('room_id')).values('created_at')[:1]
+
+        updated = InboxEntry.objects.update(
+            unread_count=Coalesce(Subquery(unread), Value(0)),
+            last_activity_at=Coalesce(Subquery(room_activity), Subquery(room_created))
+        )
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {updated} inbox entries"))
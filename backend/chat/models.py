@@ -1,7 +1,11 @@
-from django.db import models
+import uuid
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Now
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.utils import timezone
 
 class User(AbstractUser):
     """
@@ -48,7 +52,11 @@ class Friendship(models.Model):
     
     @classmethod
     def are_friends(cls, user1, user2):
-        """Check if two users are friends"""
+        """Check if two users are friends, from the cached friend ids of user1 when they are shared"""
+        from .utils.friend_graph import get_friend_ids
+        friend_ids = get_friend_ids(getattr(user1, 'pk', user1))
+        if friend_ids is not None:
+            return getattr(user2, 'pk', user2) in friend_ids
         return cls.objects.filter(
             models.Q(requester=user1, addressee=user2, status='accepted') |
             models.Q(requester=user2, addressee=user1, status='accepted')
@@ -56,25 +64,27 @@ class Friendship(models.Model):
     
     @classmethod
     def get_friends(cls, user):
-        """Get all friends of a user"""
+        """Get all friends of a user, in one query"""
+        from .utils.friend_graph import get_friend_ids
+        friend_ids = get_friend_ids(getattr(user, 'pk', user))
+        if friend_ids is not None:
+            if not friend_ids:
+                return []
+            return list(User.objects.filter(id__in=friend_ids).order_by('username'))
+
         friendships = cls.objects.filter(
-            models.Q(requester=user, status='accepted') |
-            models.Q(addressee=user, status='accepted')
+            models.Q(requester=user) | models.Q(addressee=user),
+            status='accepted'
         )
-        
-        friends = []
-        for friendship in friendships:
-            if friendship.requester == user:
-                friends.append(friendship.addressee)
-            else:
-                friends.append(friendship.requester)
-        
-        return friends
+        return list(User.objects.filter(
+            models.Q(id__in=friendships.values('requester_id')) |
+            models.Q(id__in=friendships.values('addressee_id'))
+        ).exclude(id=getattr(user, 'pk', user)).order_by('username'))
     
     @classmethod
     def get_pending_requests(cls, user):
         """Get pending friend requests for a user"""
-        return cls.objects.filter(addressee=user, status='pending')
+        return cls.objects.filter(addressee=user, status='pending').select_related('requester')
     
     @classmethod
     def get_sent_requests(cls, user):
@@ -89,6 +99,12 @@ class ChatRoom(models.Model):
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='chat_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
     is_group = models.BooleanField(default=False) # To distinguish group chats
+    # Denormalized pointer to the newest message, kept up to date by utils.message_store
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # "<lower user id>:<higher user id>" for direct chats, NULL for groups. Its unique index makes a
+    # direct chat a single lookup and stops concurrent requests from creating the same one twice.
+    direct_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
 
     def __str__(self):
         if self.is_group and self.name:
@@ -97,24 +113,56 @@ class ChatRoom(models.Model):
             return f"Direct Chat {self.id}"
         return f"ChatRoom {self.id}"
 
+    @staticmethod
+    def direct_key_for(user1, user2):
+        """The direct_key of the direct chat between two users (or user ids)"""
+        ids = sorted((getattr(user1, 'pk', user1), getattr(user2, 'pk', user2)))
+        return f"{ids[0]}:{ids[1]}"
+
     @classmethod
     def get_or_create_direct_chat(cls, user1, user2):
         """Get existing direct chat or create new one between two users"""
-        # Check if chat room already exists
-        existing_room = cls.objects.filter(
+        key = cls.direct_key_for(user1, user2)
+        existing_room = cls.objects.filter(direct_key=key).first()
+        if existing_room:
+            return existing_room, False
+
+        # Direct chats created before direct_key existed have none until merge_direct_chats has
+        # run, the oldest one of the pair (the one that command keeps) gets the key now
+        legacy_room = cls.objects.filter(
             participants=user1,
-            is_group=False
+            is_group=False,
+            direct_key__isnull=True
         ).filter(
             participants=user2
-        ).first()
+        ).order_by('id').first()
+        if legacy_room:
+            try:
+                with transaction.atomic():
+                    cls.objects.filter(id=legacy_room.id).update(direct_key=key)
+            except IntegrityError:
+                # Another request keyed or created the pair's room first
+                return cls.objects.get(direct_key=key), False
+            legacy_room.direct_key = key
+            return legacy_room, False
+
+        try:
+            with transaction.atomic():
+                chat_room = cls.objects.create(is_group=False, direct_key=key)
+                chat_room.participants.add(user1, user2)
+        except IntegrityError:
+            # Another request created it first
+            return cls.objects.get(direct_key=key), False
+        return chat_room, True
 
+    @classmethod
+    async def aget_or_create_direct_chat(cls, user1, user2):
+        """get_or_create_direct_chat() with the key lookup through the async ORM"""
+        existing_room = await cls.objects.filter(direct_key=cls.direct_key_for(user1, user2)).afirst()
         if existing_room:
             return existing_room, False
-
-        # Create new chat room
-        chat_room = cls.objects.create(is_group=False)
-        chat_room.participants.add(user1, user2)
-        return chat_room, True
+        # Keying a legacy room or creating the room needs a transaction, which the async ORM has not
+        return await sync_to_async(cls.get_or_create_direct_chat)(user1, user2)
 
     class Meta:
         ordering = ['-created_at']
@@ -130,13 +178,20 @@ class Message(models.Model):
         ('Seen', 'Seen')
     )
 
+    # Server-assigned id known before the row is inserted (write-behind mode), also makes batch inserts idempotent
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, null=True, editable=False)
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_messages')
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set by the database and returned by the INSERT, so saving a message is a single round trip
+    timestamp = models.DateTimeField(db_default=Now())
     status = models.CharField(max_length=10, choices=STATUS, default='Pending')
     delivered_at = models.DateTimeField(null=True, blank=True)
+    # When the first participant saw the message, per-reader state lives in InboxEntry.last_seen_message_id
     seen_at = models.DateTimeField(null=True, blank=True)
+    # Deprecated: no longer read or written. Kept so the migration that adds
+    # InboxEntry.last_seen_message_id leaves its table in place for the migrate_seen_by command,
+    # remove it once that has run.
     seen_by = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='seen_messages', blank=True)
 
     def __str__(self):
@@ -144,15 +199,44 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # keyset pagination of a room's history walks this index
+            models.Index(fields=['room', 'id'], name='message_room_id_idx'),
+        ]
 
 class RoomPresence(models.Model):
     """
-    Tracks which users are currently active in which rooms
+    Last known presence of users in rooms, persisted periodically from the presence store
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     is_online = models.BooleanField(default=True)
-    last_seen = models.DateTimeField(auto_now=True)
+    # Written in batches from the presence store, see utils/presence.py
+    last_seen = models.DateTimeField(default=timezone.now)
     
     class Meta:
-        unique_together = ('user', 'room')
\ No newline at end of file
+        unique_together = ('user', 'room')
+
+class InboxEntry(models.Model):
+    """
+    One row per (user, room) holding what the chat list needs: unread count and last activity.
+    Kept up to date incrementally when messages are saved and seen, so the inbox is a single
+    range scan over (user, last_activity_at).
+
+    It also holds the user's read watermark: every message of the room with an id up to
+    last_seen_message_id has been seen by the user.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='inbox_entries')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='inbox_entries')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    last_seen_message_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'room')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='inbox_user_activity_idx'),
+        ]
+
+    def __str__(self):
+        return f"Inbox of {self.user_id} for room {self.room_id} ({self.unread_count} unread)"
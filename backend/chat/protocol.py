@@ -0,0 +1,179 @@
+"""
+Wire protocols of the chat WebSocket.
+
+Both encodings carry the same frames. JSON text frames are the default. A client that offers the
+"imhotep.msgpack.v1" subprotocol gets binary MessagePack frames in which field names and frame
+types are replaced by the short codes of FIELD_CODES and TYPE_CODES; names that are not in the
+schema are sent as they are. msgpack is optional, without it only JSON is offered.
+"""
+import datetime
+import functools
+
+from .utils import fast_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Field name -> short code of the binary protocol, codes must stay unique and never be reused
+FIELD_CODES = {
+    'type': 't',
+    'room_id': 'r',
+    'room_ids': 'rs',
+    'message': 'm',
+    'message_id': 'i',
+    'message_uid': 'u',
+    'username': 'n',
+    'user_id': 'ui',
+    'timestamp': 'ts',
+    'status': 'st',
+    'is_typing': 'it',
+    'started': 'sa',
+    'stopped': 'so',
+    'last_seen_message_id': 'ls',
+    'seen_by': 'sb',
+    'messages': 'ms',
+    'next_cursor': 'nc',
+    'has_more': 'hm',
+    'read_watermarks': 'rw',
+    'online_users': 'ou',
+    'id': 'id',
+    'content': 'c',
+    'sender_id': 'si',
+    'sender_username': 'sn',
+    'rooms': 'rm',
+    'unread_count': 'uc',
+    'last_message_at': 'la',
+    'last_message': 'lm',
+    'last_sender': 'lsn',
+    'message_ids': 'mid',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Frame type -> code of the binary protocol
+TYPE_CODES = {
+    'message': 1,
+    'message_ack': 2,
+    'user_joined': 3,
+    'user_left': 4,
+    'typing': 5,
+    'messages_seen': 6,
+    'snapshot': 7,
+    'error': 8,
+    'subscribe': 9,
+    'unsubscribe': 10,
+    'unsubscribed': 11,
+    'room_added': 12,
+    'room_removed': 13,
+    'inbox_update': 14,
+    'mark_seen': 15,
+    'heartbeat': 16,
+    'open': 17,
+    'close': 18,
+    'messages_stored': 19,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+def _compact(value):
+    if isinstance(value, dict):
+        return {
+            FIELD_CODES.get(key, key): TYPE_CODES.get(item, item) if key == 'type' else _compact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    return value
+
+def _expand(value):
+    if isinstance(value, dict):
+        expanded = {}
+        for key, item in value.items():
+            if not isinstance(key, (str, int)):
+                raise ValueError('Invalid frame field')
+            name = FIELD_NAMES.get(key, key)
+            if name == 'type':
+                if not isinstance(item, (str, int)):
+                    raise ValueError('Invalid frame type')
+                expanded[name] = TYPE_NAMES.get(item, item)
+            else:
+                expanded[name] = _expand(item)
+        return expanded
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+def _msgpack_default(value):
+    # Same text as in the JSON frames
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+class JsonProtocol:
+    """Text frames, the default"""
+    name = 'imhotep.json.v1'
+    binary = False
+
+    def encode(self, frame):
+        return fast_json.dumps(frame)
+
+    def decode(self, data):
+        return fast_json.loads(data)
+
+class MsgpackProtocol:
+    """Binary MessagePack frames with short field codes"""
+    name = 'imhotep.msgpack.v1'
+    binary = True
+
+    def encode(self, frame):
+        return msgpack.packb(_compact(frame), default=_msgpack_default)
+
+    def decode(self, data):
+        # Valid MessagePack can still be no frame, e.g. an array used as a map key raises TypeError
+        try:
+            return _expand(msgpack.unpackb(data, strict_map_key=False))
+        except (TypeError, ValueError, msgpack.ExtraData) as e:
+            raise ValueError(f'Invalid frame: {e}')
+
+JSON = JsonProtocol()
+MSGPACK = MsgpackProtocol() if msgpack is not None else None
+
+def negotiate(subprotocols):
+    """
+    Pick the protocol of a socket from the subprotocols the client offered, in its order of
+    preference. Returns (protocol, subprotocol to accept), the subprotocol is None when the client
+    offered none of ours and gets the default JSON frames.
+    """
+    for subprotocol in subprotocols:
+        if subprotocol == JSON.name:
+            return JSON, subprotocol
+        if MSGPACK is not None and subprotocol == MSGPACK.name:
+            return MSGPACK, subprotocol
+    return JSON, None
+
+def decode_frame(text_data=None, bytes_data=None):
+    """Decode a frame sent by a client, text frames are JSON and binary frames MessagePack"""
+    if bytes_data is not None:
+        if MSGPACK is None:
+            raise ValueError('Binary frames are not supported')
+        frame = MSGPACK.decode(bytes_data)
+    else:
+        frame = JSON.decode(text_data)
+    if not isinstance(frame, dict):
+        raise ValueError('A frame must be an object')
+    return frame
+
+def frame_event(event_type, frame, sender_channel=None):
+    """
+    Channel layer event carrying a frame encoded once as JSON, JSON sockets forward it as is and
+    MessagePack sockets convert it with msgpack_frame()
+    """
+    return {'type': event_type, 'text': JSON.encode(frame), 'sender_channel': sender_channel}
+
+@functools.lru_cache(maxsize=256)
+def msgpack_frame(text):
+    """
+    The MessagePack encoding of a JSON encoded frame. Cached, so a broadcast is converted once per
+    process however many MessagePack sockets of the room it reaches, and never if none does.
+    """
+    return MSGPACK.encode(JSON.decode(text))
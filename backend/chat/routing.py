@@ -2,5 +2,6 @@ from django.urls import re_path
 from . import consumers 
 
 websocket_urlpatterns = [
+    re_path(r'ws/chat/$', consumers.MultiplexChatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<room_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
 ]
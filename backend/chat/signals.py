@@ -0,0 +1,73 @@
+from django.db import connections
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from .models import ChatRoom, Friendship, InboxEntry, User
+from .utils.friend_graph import invalidate_friend_ids
+from .utils.channel_groups import notify_participants_changed, notify_membership_changed
+from .utils.message_search import create_search_index
+from .utils.user_search import create_user_search_index
+from .utils.username_index import notify_username_saved, notify_user_deleted
+
+@receiver(post_migrate)
+def create_search_indexes(sender, using, **kwargs):
+    """The app has no migration files, so the vendor-specific search indexes are created after migrate"""
+    if sender.name == 'chat':
+        create_search_index(connections[using])
+        create_user_search_index(connections[using])
+
+@receiver(post_save, sender=User)
+def update_username_index(sender, instance, created, update_fields, **kwargs):
+    """Keep the username autocomplete index in step with new and renamed users"""
+    # Logins save last_login only
+    if update_fields is None or 'username' in update_fields:
+        notify_username_saved(instance.id, instance.username, created)
+
+@receiver(post_delete, sender=User)
+def remove_from_username_index(sender, instance, **kwargs):
+    notify_user_deleted(instance.id)
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def invalidate_friend_graph(sender, instance, **kwargs):
+    """A friendship was created, accepted, blocked or removed: both friend sets change"""
+    invalidate_friend_ids(instance.requester_id, instance.addressee_id)
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def sync_inbox_entries(sender, instance, action, reverse, pk_set, **kwargs):
+    """Create or remove inbox rows when users join or leave a chat room, and refresh open sockets"""
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            # user.chat_rooms.add(...): instance is the user, pk_set holds room ids
+            pairs = [(instance.id, room_id) for room_id in pk_set]
+        else:
+            pairs = [(user_id, instance.id) for user_id in pk_set]
+
+    if action == 'post_add':
+        InboxEntry.objects.bulk_create(
+            [InboxEntry(user_id=user_id, room_id=room_id) for user_id, room_id in pairs],
+            ignore_conflicts=True
+        )
+
+    elif action == 'post_remove':
+        if reverse:
+            InboxEntry.objects.filter(user_id=instance.id, room_id__in=pk_set).delete()
+        else:
+            InboxEntry.objects.filter(room_id=instance.id, user_id__in=pk_set).delete()
+
+    elif action == 'pre_clear':
+        # pk_set is not given for clear, remember which memberships go away before the rows do
+        if reverse:
+            instance._cleared_pairs = [(instance.id, room_id) for room_id in instance.chat_rooms.values_list('id', flat=True)]
+        else:
+            instance._cleared_pairs = [(user_id, instance.id) for user_id in instance.participants.values_list('id', flat=True)]
+
+    elif action == 'post_clear':
+        if reverse:
+            InboxEntry.objects.filter(user_id=instance.id).delete()
+        else:
+            InboxEntry.objects.filter(room_id=instance.id).delete()
+        pairs = getattr(instance, '_cleared_pairs', [])
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        notify_participants_changed({room_id for _, room_id in pairs} if reverse else [instance.id])
+        notify_membership_changed(pairs, added=action == 'post_add')
@@ -1,3 +1,634 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext
+from .models import User, ChatRoom, Message, InboxEntry, Friendship
+from .utils.write_behind import MessageWriteBehind, flush_messages
+from .utils.friend_graph import get_friend_ids
+from .utils.typing_indicators import RoomTypingAggregator
+from .utils.message_store import create_message
+from .utils.message_status import mark_messages_as_seen
+from .utils.pagination import encode_cursor
+from .utils.message_search import PG_INDEX_NAME, SEARCH_CONFIG, parse_search_args, search_user_messages
+from .consumers import ChatConsumer, RoomSubscription
+from .protocol import JSON, MSGPACK, decode_frame, frame_event, msgpack_frame
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The buffer flushes through database_sync_to_async, which closes a connection left inside a
+# transaction (TestCase's) on PostgreSQL
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', password='password')
+        self.reader = User.objects.create_user(username='reader', password='password')
+        self.room, _ = ChatRoom.get_or_create_direct_chat(self.sender, self.reader)
+
+    def make_messages(self, count):
+        now = timezone.now()
+        return [
+            Message(room=self.room, sender=self.sender, content=f'message {i}', timestamp=now, status='Delivered')
+            for i in range(count)
+        ]
+
+    def test_flush_inserts_batch_and_updates_chat_list(self):
+        messages = self.make_messages(3)
+
+        self.assertEqual(flush_messages(messages), 3)
+
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 3)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, messages[-1].id)
+        self.assertEqual(InboxEntry.objects.get(user=self.reader, room=self.room).unread_count, 3)
+        self.assertEqual(InboxEntry.objects.get(user=self.sender, room=self.room).unread_count, 0)
+
+    def test_replaying_a_committed_batch_is_idempotent(self):
+        # e.g. the connection dropped after COMMIT and the batch is retried
+        messages = self.make_messages(2)
+        flush_messages(messages)
+
+        self.assertEqual(flush_messages(messages), 0)
+
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(InboxEntry.objects.get(user=self.reader, room=self.room).unread_count, 2)
+
+    async def test_failed_flush_keeps_messages_buffered_and_retries(self):
+        database = {'available': False}
+
+        def flaky(batch):
+            if not database['available']:
+                raise RuntimeError('database unavailable')
+            return flush_messages(batch)
+
+        buffer = MessageWriteBehind(batch_size=10, flush_interval=60, flush_function=flaky)
+        first = buffer.submit(self.room.id, self.sender.id, 'first')
+        buffer.submit(self.room.id, self.sender.id, 'second')
+
+        with self.assertLogs('chat.utils.write_behind', 'ERROR'):
+            self.assertEqual(await buffer.flush(), 0)
+        self.assertEqual([message.uid for message in buffer.pending][0], first.uid)
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 0)
+
+        database['available'] = True
+        self.assertEqual(await buffer.flush(), 2)
+        self.assertEqual(buffer.pending, [])
+        contents = [message.content async for message in Message.objects.filter(room=self.room).order_by('id')]
+        self.assertEqual(contents, ['first', 'second'])
+
+    async def test_message_failing_on_its_own_is_dropped(self):
+        def rejecting(batch):
+            # e.g. the room of the message was deleted
+            if any(message.content == 'orphan' for message in batch):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return flush_messages(batch)
+
+        buffer = MessageWriteBehind(batch_size=10, flush_interval=60, flush_function=rejecting)
+        for content in ('before', 'orphan', 'after'):
+            buffer.submit(self.room.id, self.sender.id, content)
+
+        with self.assertLogs('chat.utils.write_behind', 'ERROR'):
+            with self.assertLogs('chat.utils.write_behind.dead_letter', 'ERROR'):
+                self.assertEqual(await buffer.flush(), 2)
+        self.assertEqual(buffer.pending, [])
+        contents = [message.content async for message in Message.objects.filter(room=self.room).order_by('id')]
+        self.assertEqual(contents, ['before', 'after'])
+
+    async def test_full_buffer_refuses_messages(self):
+        buffer = MessageWriteBehind(batch_size=10, flush_interval=60, max_pending=2)
+        buffer.submit(self.room.id, self.sender.id, 'one')
+        buffer.submit(self.room.id, self.sender.id, 'two')
+
+        with self.assertLogs('chat.utils.write_behind', 'WARNING'):
+            self.assertIsNone(buffer.submit(self.room.id, self.sender.id, 'three'))
+        self.assertEqual(len(buffer.pending), 2)
+
+    async def test_full_batch_is_flushed_without_waiting_for_the_interval(self):
+        buffer = MessageWriteBehind(batch_size=2, flush_interval=60)
+        buffer.submit(self.room.id, self.sender.id, 'one')
+        buffer.submit(self.room.id, self.sender.id, 'two')
+
+        # let the scheduled flush run
+        for _ in range(10):
+            if not buffer.pending:
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(buffer.pending, [])
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 2)
+
+
+class TypingAggregatorTests(SimpleTestCase):
+    def make_aggregator(self):
+        frames = []
+
+        async def send(frame):
+            frames.append(frame)
+
+        return RoomTypingAggregator(send, interval=60), frames
+
+    async def flush(self, aggregator):
+        aggregator.timer.cancel()
+        await aggregator.flush()
+
+    async def test_stop_after_a_reported_start_is_sent_despite_flicker(self):
+        aggregator, frames = self.make_aggregator()
+        aggregator.add('u', True)
+        await self.flush(aggregator)
+
+        # stop, start and stop again within one interval
+        aggregator.add('u', False)
+        aggregator.add('u', True)
+        aggregator.add('u', False)
+        await self.flush(aggregator)
+
+        self.assertEqual(frames, [
+            {'type': 'typing', 'started': ['u'], 'stopped': []},
+            {'type': 'typing', 'started': [], 'stopped': ['u']},
+        ])
+
+    async def test_unreported_start_and_stop_send_nothing(self):
+        aggregator, frames = self.make_aggregator()
+        aggregator.add('u', True)
+        aggregator.add('u', False)
+        await self.flush(aggregator)
+
+        self.assertEqual(frames, [])
+
+    async def test_user_keeps_typing_while_another_tab_types(self):
+        aggregator, frames = self.make_aggregator()
+        aggregator.add('u', True)
+        aggregator.add('u', True)
+        await self.flush(aggregator)
+
+        aggregator.add('u', False)
+        await self.flush(aggregator)
+        aggregator.add('u', False)
+        await self.flush(aggregator)
+
+        self.assertEqual(frames, [
+            {'type': 'typing', 'started': ['u'], 'stopped': []},
+            {'type': 'typing', 'started': [], 'stopped': ['u']},
+        ])
+
+
+@skipIf(MSGPACK is None, 'msgpack is not installed')
+class MsgpackFrameTests(SimpleTestCase):
+    def test_malformed_frames_are_value_errors(self):
+        malformed = [
+            msgpack.packb({'t': [1]}),
+            msgpack.packb({'t': {}}),
+            msgpack.packb({'m': {'t': [1]}}),
+            # {[1]: 1}, an array as map key
+            b'\x81\x91\x01\x01',
+            # {1.5: 1}
+            b'\x81\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00\x01',
+            msgpack.packb({'t': 1}) + b'\x01',
+            msgpack.packb({'t': 1})[:-1],
+            msgpack.packb([1, 2]),
+        ]
+        for data in malformed:
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    decode_frame(bytes_data=data)
+
+    def test_broadcast_is_converted_from_its_json_encoding(self):
+        frame = {'type': 'message', 'room_id': 1, 'message': 'hi', 'timestamp': timezone.now()}
+        event = frame_event('chat_message', frame)
+
+        self.assertNotIn('bytes', event)
+        self.assertEqual(msgpack_frame(event['text']), MSGPACK.encode(frame))
+        self.assertEqual(decode_frame(bytes_data=msgpack_frame(event['text'])), JSON.decode(event['text']))
+
+
+class FrameSocket(ChatConsumer):
+    """Consumer whose socket keeps the frames it sends"""
+
+    def __init__(self, user, protocol=JSON):
+        super().__init__()
+        self.user = user
+        self.protocol = protocol
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent.append(self.protocol.decode(bytes_data if self.protocol.binary else text_data))
+
+
+class RoomFrameTests(SimpleTestCase):
+    async def test_message_that_is_not_a_string_gets_an_error_frame(self):
+        protocols = [JSON] + ([MSGPACK] if msgpack is not None else [])
+        for protocol in protocols:
+            for message in (5, [1], None, {'text': 'hi'}):
+                with self.subTest(protocol=protocol, message=message):
+                    socket = FrameSocket(User(id=1, username='sender'), protocol)
+                    subscription = RoomSubscription(1, False, {1}, lambda is_typing: None)
+
+                    await socket.handle_room_frame(subscription, {'type': 'message', 'message': message})
+
+                    self.assertEqual(socket.sent, [{'type': 'error', 'message': 'Invalid message format', 'room_id': 1}])
+
+
+class WriteBehindConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', password='password')
+        self.reader = User.objects.create_user(username='reader', password='password')
+        self.room, _ = ChatRoom.get_or_create_direct_chat(self.sender, self.reader)
+
+    async def connect(self, user, layer):
+        socket = FrameSocket(user)
+        socket.channel_layer = layer
+        socket.channel_name = await layer.new_channel()
+        socket.rooms = {}
+        subscription = await socket.join_room({
+            'room_id': self.room.id, 'is_group': False, 'participant_ids': {self.sender.id, self.reader.id}
+        })
+        return socket, subscription
+
+    async def deliver(self, socket, layer):
+        # Hand the socket every event waiting on its channel, like the consumer's receive loop does
+        while socket.channel_name in layer.channels and not layer.channels[socket.channel_name].empty():
+            await socket.dispatch(await layer.receive(socket.channel_name))
+
+    async def test_acknowledged_uid_is_mapped_to_its_id_once_stored(self):
+        layer = InMemoryChannelLayer()
+        buffer = MessageWriteBehind(batch_size=100, flush_interval=60, channel_layer=layer)
+        sender, subscription = await self.connect(self.sender, layer)
+        reader, _ = await self.connect(self.reader, layer)
+
+        with mock.patch('chat.consumers.get_write_behind', return_value=buffer):
+            await sender.handle_room_frame(subscription, {'type': 'message', 'message': 'hello'})
+        ack = sender.sent[0]
+        self.assertEqual(ack['type'], 'message_ack')
+        self.assertIsNone(ack['message_id'])
+
+        await buffer.flush()
+        await self.deliver(sender, layer)
+        await self.deliver(reader, layer)
+
+        message_id = await Message.objects.filter(room=self.room).values_list('id', flat=True).aget()
+        stored = {'type': 'messages_stored', 'room_id': self.room.id, 'message_ids': {ack['message_uid']: message_id}}
+        self.assertEqual(sender.sent[1:], [stored])
+        broadcast, = [frame for frame in reader.sent if frame['type'] == 'message']
+        self.assertEqual(broadcast['message_uid'], ack['message_uid'])
+        self.assertEqual(reader.sent[-1], stored)
+
+
+class FriendListQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='popular', password='password')
+
+    def add_friends(self, count, status='accepted'):
+        others = User.objects.bulk_create([
+            User(username=f'{status}_{Friendship.objects.count()}_{i}') for i in range(count)
+        ])
+        # Half the friendships were sent by the user, half received
+        Friendship.objects.bulk_create([
+            Friendship(requester=self.user, addressee=other, status=status) if i % 2
+            else Friendship(requester=other, addressee=self.user, status=status)
+            for i, other in enumerate(others)
+        ])
+
+    def count_queries(self, url):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_friend_list_query_count_does_not_grow_with_friends(self):
+        self.add_friends(3)
+        few, data = self.count_queries('/get-friends/')
+        self.assertEqual(len(data['friends']), 3)
+
+        self.add_friends(60)
+        many, data = self.count_queries('/get-friends/?limit=200')
+        self.assertEqual(len(data['friends']), 63)
+        self.assertEqual(many, few)
+        self.assertNotIn(self.user.id, [friend['id'] for friend in data['friends']])
+
+    def test_friend_requests_query_count_does_not_grow_with_requests(self):
+        self.add_friends(2, status='pending')
+        few, _ = self.count_queries('/get-friend-requests/')
+
+        self.add_friends(40, status='pending')
+        many, data = self.count_queries('/get-friend-requests/?limit=200')
+        # only the requests the user received
+        self.assertEqual(len(data['requests']), 21)
+        self.assertEqual(many, few)
+
+    def test_friend_pages_follow_the_cursor(self):
+        self.add_friends(5)
+        self.client.force_login(self.user)
+
+        seen, cursor = [], ''
+        while True:
+            data = self.client.get('/get-friends/', {'limit': 2, 'cursor': cursor}).json()
+            seen += [friend['friendship_id'] for friend in data['friends']]
+            if not data['has_more']:
+                break
+            cursor = data['next_cursor']
+
+        self.assertEqual(seen, sorted(Friendship.objects.values_list('id', flat=True), reverse=True))
+
+
+# The Redis cache shared by the workers, a locmem one stands in for it
+SHARED_FRIEND_GRAPH_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'friend_graph': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'friend-graph-tests'},
+}
+
+@override_settings(CACHES=SHARED_FRIEND_GRAPH_CACHES)
+class FriendGraphCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='password')
+        cls.friend = User.objects.create_user(username='friend', password='password')
+        cls.other = User.objects.create_user(username='other', password='password')
+        cls.friendship = Friendship.objects.create(requester=cls.user, addressee=cls.friend, status='accepted')
+        Friendship.objects.create(requester=cls.other, addressee=cls.user, status='accepted')
+
+    def setUp(self):
+        caches['friend_graph'].clear()
+
+    def test_friend_checks_are_answered_from_the_cached_set(self):
+        self.assertEqual(Friendship.get_friends(self.user), [self.friend, self.other])
+        with self.assertNumQueries(0):
+            self.assertTrue(Friendship.are_friends(self.user, self.friend))
+            self.assertFalse(Friendship.are_friends(self.user, self.user))
+
+    def test_block_invalidates_the_friend_sets_of_both_users(self):
+        self.assertTrue(Friendship.are_friends(self.user, self.friend))
+        self.assertTrue(Friendship.are_friends(self.friend, self.user))
+
+        self.client.force_login(self.friend)
+        response = self.client.post('/block-friend/', {'friendship_id': self.friendship.id}, content_type='application/json')
+        self.assertEqual(response.json()['status'], 'Blocked')
+
+        self.assertFalse(Friendship.are_friends(self.user, self.friend))
+        self.assertFalse(Friendship.are_friends(self.friend, self.user))
+        self.assertEqual(Friendship.get_friends(self.user), [self.other])
+
+    def test_removal_invalidates_the_friend_sets_of_both_users(self):
+        self.assertEqual(Friendship.get_friends(self.friend), [self.user])
+
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/remove-friend/', {'friendship_id': self.friendship.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(Friendship.get_friends(self.friend), [])
+        self.assertFalse(Friendship.are_friends(self.user, self.friend))
+
+    @override_settings(CACHES={'default': SHARED_FRIEND_GRAPH_CACHES['default']})
+    def test_without_a_shared_cache_friendships_are_checked_in_the_database(self):
+        self.assertIsNone(get_friend_ids(self.user.id))
+        with self.assertNumQueries(1):
+            self.assertTrue(Friendship.are_friends(self.user, self.friend))
+        self.friendship.delete()
+        self.assertFalse(Friendship.are_friends(self.user, self.friend))
+
+
+class DirectChatTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='password')
+        cls.bob = User.objects.create_user(username='bob', password='password')
+        cls.key = ChatRoom.direct_key_for(cls.alice, cls.bob)
+
+    def make_room(self, direct_key=None):
+        room = ChatRoom.objects.create(is_group=False, direct_key=direct_key)
+        room.participants.add(self.alice, self.bob)
+        return room
+
+    def lookup_missed_once(self):
+        # The room keyed by a concurrent request after the key lookup of this one
+        filter = ChatRoom.objects.filter
+        calls = []
+
+        def lookup(*args, **kwargs):
+            calls.append(kwargs)
+            return ChatRoom.objects.none() if len(calls) == 1 else filter(*args, **kwargs)
+
+        return mock.patch.object(ChatRoom.objects, 'filter', side_effect=lookup)
+
+    def test_oldest_legacy_unkeyed_room_is_reused_and_gets_its_key(self):
+        oldest = self.make_room()
+        self.make_room()
+
+        room, created = ChatRoom.get_or_create_direct_chat(self.bob, self.alice)
+
+        self.assertEqual((room, created), (oldest, False))
+        self.assertEqual(ChatRoom.objects.get(id=oldest.id).direct_key, self.key)
+        with self.assertNumQueries(1):
+            self.assertEqual(ChatRoom.get_or_create_direct_chat(self.alice, self.bob), (oldest, False))
+
+    def test_duplicate_key_while_keying_a_legacy_room_returns_the_keyed_room(self):
+        legacy = self.make_room()
+        keyed = self.make_room(self.key)
+
+        with self.lookup_missed_once():
+            room, created = ChatRoom.get_or_create_direct_chat(self.alice, self.bob)
+
+        self.assertEqual((room, created), (keyed, False))
+        self.assertIsNone(ChatRoom.objects.get(id=legacy.id).direct_key)
+
+    def test_duplicate_key_while_creating_returns_the_existing_room(self):
+        keyed = self.make_room(self.key)
+
+        with self.lookup_missed_once():
+            room, created = ChatRoom.get_or_create_direct_chat(self.alice, self.bob)
+
+        self.assertEqual((room, created), (keyed, False))
+        self.assertEqual(ChatRoom.objects.filter(is_group=False).count(), 1)
+
+
+@skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'full-text search runs on PostgreSQL and SQLite')
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='searcher', password='password')
+        cls.friend = User.objects.create_user(username='friend', password='password')
+        cls.stranger = User.objects.create_user(username='stranger', password='password')
+        cls.room, _ = ChatRoom.get_or_create_direct_chat(cls.user, cls.friend)
+        cls.other_room, _ = ChatRoom.get_or_create_direct_chat(cls.user, cls.stranger)
+        cls.foreign_room, _ = ChatRoom.get_or_create_direct_chat(cls.friend, cls.stranger)
+
+    def add(self, room, content, sender=None):
+        return create_message(room_id=room.id, sender=sender or self.friend, content=content)
+
+    def search(self, query, **kwargs):
+        return search_user_messages(self.user.id, query, **kwargs)
+
+    def test_more_relevant_messages_come_first(self):
+        once = self.add(self.room, 'the pyramid tour starts at nine, bring water')
+        twice = self.add(self.room, 'pyramid pyramid')
+        self.add(self.room, 'nothing to see here')
+
+        results, next_cursor, has_more = self.search('pyramid')
+
+        self.assertEqual([result['message_id'] for result in results], [twice.id, once.id])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+        self.assertEqual((next_cursor, has_more), (None, False))
+        self.assertEqual(results[1]['sender_username'], 'friend')
+        self.assertIsNotNone(results[1]['timestamp'].tzinfo)
+
+    def test_snippet_marks_the_match_and_escapes_the_content(self):
+        self.add(self.room, 'the sphinx <b>riddle</b> & friends')
+
+        results, _, _ = self.search('sphinx')
+
+        self.assertIn('<mark>sphinx</mark>', results[0]['snippet'])
+        self.assertIn('&lt;b&gt;', results[0]['snippet'])
+        self.assertIn('&amp;', results[0]['snippet'])
+
+    def test_only_rooms_of_the_user_are_searched(self):
+        mine = self.add(self.room, 'nile cruise')
+        other = self.add(self.other_room, 'nile boat', sender=self.stranger)
+        self.add(self.foreign_room, 'nile felucca', sender=self.stranger)
+
+        results, _, _ = self.search('nile')
+        self.assertEqual({result['message_id'] for result in results}, {mine.id, other.id})
+
+        results, _, _ = self.search('nile', room_id=self.other_room.id)
+        self.assertEqual([result['message_id'] for result in results], [other.id])
+
+        results, _, _ = self.search('nile', room_id=self.foreign_room.id)
+        self.assertEqual(results, [])
+
+    def test_pages_follow_the_rank_and_id_cursor(self):
+        # Equal ranks are ordered newest first, mixed ranks by relevance
+        messages = [self.add(self.room, 'karnak temple') for _ in range(4)] + [self.add(self.room, 'karnak karnak')]
+        expected = [message.id for message in messages[-1:] + messages[3::-1]]
+
+        seen, after = [], None
+        while True:
+            results, next_cursor, has_more = self.search('karnak', after=after, limit=2)
+            seen += [result['message_id'] for result in results]
+            if not has_more:
+                break
+            after = parse_search_args({'q': 'karnak', 'cursor': next_cursor})['after']
+
+        self.assertEqual(seen, expected)
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL GIN index')
+    def test_postgresql_search_uses_the_gin_index(self):
+        self.add(self.room, 'abu simbel')
+        with connection.cursor() as cursor:
+            # The table is too small for the planner to prefer the index on its own
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(
+                f"EXPLAIN SELECT id FROM {Message._meta.db_table} "
+                f"WHERE to_tsvector('{SEARCH_CONFIG}', content) @@ websearch_to_tsquery('{SEARCH_CONFIG}', %s)",
+                ['simbel']
+            )
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn(PG_INDEX_NAME, plan)
+
+
+class MessageHistoryViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user(username='sender', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.outsider = User.objects.create_user(username='outsider', password='password')
+        cls.room, _ = ChatRoom.get_or_create_direct_chat(cls.sender, cls.reader)
+        cls.message_ids = [
+            create_message(room_id=cls.room.id, sender=cls.sender, content=f'message {i}').id for i in range(5)
+        ]
+
+    def get_page(self, variant, **params):
+        return self.client.get(f'/{variant}/get-messages/{self.room.id}/', params)
+
+    def test_pages_follow_the_cursor_back_to_the_first_message(self):
+        self.client.force_login(self.reader)
+        for variant in ('sync', 'async'):
+            with self.subTest(variant=variant):
+                pages, cursor = [], ''
+                while True:
+                    data = self.get_page(variant, limit=2, cursor=cursor).json()
+                    pages.append([message['id'] for message in data['messages']])
+                    if not data['has_more']:
+                        break
+                    cursor = data['next_cursor']
+
+                # newest page first, each page in chronological order
+                ids = self.message_ids
+                self.assertEqual(pages, [ids[3:5], ids[1:3], ids[0:1]])
+
+    def test_newer_messages_after_an_id(self):
+        self.client.force_login(self.reader)
+        for variant in ('sync', 'async'):
+            with self.subTest(variant=variant):
+                data = self.get_page(variant, after_id=self.message_ids[1], limit=2).json()
+                self.assertEqual([message['id'] for message in data['messages']], self.message_ids[2:4])
+                self.assertTrue(data['has_more'])
+
+    def test_invalid_parameters_are_bad_requests(self):
+        self.client.force_login(self.reader)
+        invalid = [
+            ({'limit': 'x'}, 'Invalid limit'),
+            ({'limit': '0'}, 'Limit must be positive'),
+            ({'before_id': 'x'}, 'before_id and after_id must be integers'),
+            ({'before_id': '3', 'after_id': '1'}, 'Use either before_id or after_id, not both'),
+            ({'cursor': 'not a cursor'}, 'Invalid cursor'),
+            ({'cursor': encode_cursor(before=[1])}, 'Invalid cursor'),
+        ]
+        for variant in ('sync', 'async'):
+            for params, error in invalid:
+                with self.subTest(variant=variant, params=params):
+                    response = self.get_page(variant, **params)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json()['error'], error)
+
+    def test_non_participants_are_denied(self):
+        self.client.force_login(self.outsider)
+        for variant in ('sync', 'async'):
+            with self.subTest(variant=variant):
+                self.assertEqual(self.get_page(variant).status_code, 403)
+
+
+class MarkMessagesAsSeenTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user(username='sender', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.room, _ = ChatRoom.get_or_create_direct_chat(cls.sender, cls.reader)
+
+    def inbox(self):
+        return InboxEntry.objects.get(user=self.reader, room=self.room)
+
+    def test_watermark_and_unread_count_move_together(self):
+        first = create_message(room_id=self.room.id, sender=self.sender, content='first')
+        create_message(room_id=self.room.id, sender=self.reader, content='reply')
+        last = create_message(room_id=self.room.id, sender=self.sender, content='last')
+
+        self.assertEqual(mark_messages_as_seen(self.room.id, self.reader.id), last.id)
+        self.assertEqual((self.inbox().last_seen_message_id, self.inbox().unread_count), (last.id, 0))
+        self.assertEqual(Message.objects.get(id=first.id).status, 'Seen')
+        # nothing new to see
+        self.assertIsNone(mark_messages_as_seen(self.room.id, self.reader.id))
+
+    def test_message_saved_between_the_pointer_read_and_the_reset_stays_counted(self):
+        create_message(room_id=self.room.id, sender=self.sender, content='seen')
+        concurrent = []
+        select_for_update = InboxEntry.objects.select_for_update
+
+        def save_concurrent_message(*args, **kwargs):
+            # Another request commits a message while the reader's inbox row is being reset
+            concurrent.append(create_message(room_id=self.room.id, sender=self.sender, content='concurrent'))
+            return select_for_update(*args, **kwargs)
+
+        with mock.patch.object(InboxEntry.objects, 'select_for_update', side_effect=save_concurrent_message):
+            watermark = mark_messages_as_seen(self.room.id, self.reader.id)
+
+        inbox = self.inbox()
+        unread = Message.objects.filter(room=self.room, id__gt=inbox.last_seen_message_id).exclude(sender=self.reader)
+        self.assertEqual(inbox.unread_count, unread.count())
+        self.assertEqual(watermark, concurrent[0].id)
@@ -4,6 +4,18 @@ from .user_settings import user_profile
 from .auth import auth
 from . import views
 from django.views.generic import TemplateView
+from django.conf import settings
+
+def api_paths(route, view, async_view, name):
+    """
+    The route served by the sync view, or by its async variant with CHAT_ASYNC_VIEWS, plus both
+    variants under sync/ and async/ so they can be compared on the same server
+    """
+    return [
+        path(route, async_view if settings.CHAT_ASYNC_VIEWS else view, name=name),
+        path(f'sync/{route}', view, name=f'{name}_sync'),
+        path(f'async/{route}', async_view, name=f'{name}_async'),
+    ]
 
 urlpatterns = [
     # #the landing page URL
@@ -37,19 +49,22 @@ urlpatterns = [
     path('main-menu/', messages.main_menu, name='main_menu'),
 
     #Chat-related URLs
-    path('start-chat/', messages.start_chat, name='start_chat'),
-    path('send-message/', messages.send_message, name='send_message'),
-    path('get-messages/<int:chat_room_id>/', messages.get_messages, name='get_messages'),
+    *api_paths('start-chat/', messages.start_chat, messages.astart_chat, 'start_chat'),
+    *api_paths('send-message/', messages.send_message, messages.asend_message, 'send_message'),
+    *api_paths('get-messages/<int:chat_room_id>/', messages.get_messages, messages.aget_messages, 'get_messages'),
+    path('search-messages/', messages.search_messages, name='search_messages'),
+    path('get-room-presence/<int:chat_room_id>/', messages.get_room_presence, name='get_room_presence'),
 
     #add new friend URL
-    path('add-friend/', friends.add_friend, name='add_friend'),
-    path('search-user/', friends.search_user, name='search_user'),
-    path('accept-friend-request/', friends.accept_friend_request, name='accept_friend_request'),
-    path('decline-friend-request/', friends.decline_friend_request, name='decline_friend_request'),
-    path('get-friends/', friends.get_friends, name='get_friends'),
-    path('get-friend-requests/', friends.get_friend_requests, name='get_friend_requests'),
-    path('block-friend/', friends.block_friend, name='block_friend'),
-    path('remove-friend/', friends.remove_friend, name='remove_friend'),
+    *api_paths('add-friend/', friends.add_friend, friends.aadd_friend, 'add_friend'),
+    *api_paths('search-user/', friends.search_user, friends.asearch_user, 'search_user'),
+    *api_paths('autocomplete-users/', friends.autocomplete_users, friends.aautocomplete_users, 'autocomplete_users'),
+    *api_paths('accept-friend-request/', friends.accept_friend_request, friends.aaccept_friend_request, 'accept_friend_request'),
+    *api_paths('decline-friend-request/', friends.decline_friend_request, friends.adecline_friend_request, 'decline_friend_request'),
+    *api_paths('get-friends/', friends.get_friends, friends.aget_friends, 'get_friends'),
+    *api_paths('get-friend-requests/', friends.get_friend_requests, friends.aget_friend_requests, 'get_friend_requests'),
+    *api_paths('block-friend/', friends.block_friend, friends.ablock_friend, 'block_friend'),
+    *api_paths('remove-friend/', friends.remove_friend, friends.aremove_friend, 'remove_friend'),
 
     # Add this to your urlpatterns list
     # path('update-profile/', user_profile.update_profile, name='update_profile'),
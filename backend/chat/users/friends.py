@@ -3,333 +3,444 @@ from ..models import User, Friendship, ChatRoom, Message
 from django.contrib.auth.decorators import login_required
 from ..utils.user_info import get_user_photo
 from ..utils.get_user_latest_chat_rooms import get_user_latest_chat_rooms
-from django.http import JsonResponse
+from ..utils.fast_json import FastJsonResponse
+from ..utils.user_search import parse_user_search_args, search_users, asearch_users
+from ..utils.username_index import autocomplete_usernames, aautocomplete_usernames, AUTOCOMPLETE_SIZE, MAX_AUTOCOMPLETE_SIZE
+from ..utils.pagination import parse_limit
+from ..utils.friend_lists import (
+    parse_friend_page_args, get_friend_page, get_friend_request_page, aget_friend_page, aget_friend_request_page
+)
+from ..utils.request_validation import (
+    RequestError, read_json, parse_friend_id, parse_friendship_id, check_friend_request, toggle_block,
+    user_data, other_user
+)
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.db.models import Q
-import json
+
+# Every view has an async variant (a-prefixed) for ASGI servers, built on the async ORM and the
+# same validation helpers (utils/request_validation.py) so both answer the same responses.
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def search_user(request):
     try:
-        data = json.loads(request.body)
-        user_name = data.get('name', '')
+        args = parse_user_search_args(read_json(request))
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
 
-        if not user_name:
-            return JsonResponse({'error': 'Name is required!'}, status=400)
+    try:
+        #a page of users matching the search, prefix matches first, friends first in the page
+        users_list, next_cursor, has_more = search_users(request.user.id, **args)
 
-        #get all users matching the search not with the current user
-        users = User.objects.filter(
-            username__icontains=user_name
-        ).exclude(id=request.user.id)
+        return FastJsonResponse({
+            'users': users_list,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        }, status=200)
 
-        #get all friendships for the current user
-        friendships = Friendship.objects.filter(
-            Q(requester=request.user) | Q(addressee=request.user)
-        )
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def asearch_user(request):
+    try:
+        args = parse_user_search_args(read_json(request))
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+
+    try:
+        user = await request.auser()
+        users_list, next_cursor, has_more = await asearch_users(user.id, **args)
+
+        return FastJsonResponse({
+            'users': users_list,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        }, status=200)
 
-        #create a dictionary to store friendship status for each user
-        friendship_status = {}
-        for friendship in friendships:
-            if friendship.requester == request.user:
-                friend_id = friendship.addressee.id
-            else:
-                friend_id = friendship.requester.id
-            friendship_status[friend_id] = friendship.status
-
-        # Categorize users by friendship status to sort them
-        accepted_friends = []
-        pending_friends = []
-        blocked_friends = []
-        other_users = []
-
-        for user in users:
-            #save each user data
-            user_data = {
-                'id': user.id, 
-                'name': user.username, 
-                'email': user.email,
-                'friendship_status': friendship_status.get(user.id, 'none')
-            }
-            
-            #categorize them to sort them
-            status = friendship_status.get(user.id, 'none')
-            if status == 'accepted':
-                accepted_friends.append(user_data)
-            elif status == 'pending':
-                pending_friends.append(user_data)
-            elif status == 'blocked':
-                blocked_friends.append(user_data)
-            else:
-                other_users.append(user_data)
-
-        #combine all users in the desired order
-        users_list = accepted_friends + pending_friends + blocked_friends + other_users
-
-        return JsonResponse({'users': users_list}, status=200)
-    
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+def _autocomplete_args(request):
+    prefix = request.GET.get('q', '').strip()
+    try:
+        limit = parse_limit(request.GET.get('limit'), AUTOCOMPLETE_SIZE, MAX_AUTOCOMPLETE_SIZE)
+    except ValueError:
+        raise RequestError('Invalid limit')
+    return prefix, limit
+
+@login_required
+@require_http_methods(["GET"])
+def autocomplete_users(request):
+    """Usernames starting with ?q=, answered from the in-memory index while the user types"""
+    try:
+        prefix, limit = _autocomplete_args(request)
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    if not prefix:
+        return FastJsonResponse({'users': []}, status=200)
+
+    return FastJsonResponse({'users': autocomplete_usernames(request.user.id, prefix, limit)}, status=200)
+
+@login_required
+@require_http_methods(["GET"])
+async def aautocomplete_users(request):
+    try:
+        prefix, limit = _autocomplete_args(request)
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    if not prefix:
+        return FastJsonResponse({'users': []}, status=200)
+
+    user = await request.auser()
+    return FastJsonResponse({'users': await aautocomplete_usernames(user.id, prefix, limit)}, status=200)
+
+def _friend_request_sent(friendship, friend):
+    return FastJsonResponse({
+        'message': 'Friend request sent successfully',
+        'friendship_id': friendship.id,
+        'friend': user_data(friend)
+    }, status=200)
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def add_friend(request):
     try:
-        data = json.loads(request.body)
-        friend_id = data.get('friend_id')
+        friend_id = parse_friend_id(read_json(request))
 
-        if not friend_id:
-            return JsonResponse({'error': 'Friend ID is required'}, status=400)
-            
         try:
             friend = User.objects.get(id=friend_id)
         except User.DoesNotExist:
-            return JsonResponse({'error': 'User Not Found'}, status=404)
+            return FastJsonResponse({'error': 'User Not Found'}, status=404)
 
-        if request.user == friend:
-            return JsonResponse({'error': 'Cannot add your self as a friend'}, status=400)
-        
         existing_friendship = Friendship.objects.filter(
             Q(requester=request.user, addressee=friend) |
             Q(requester=friend, addressee=request.user)
         ).first()
+        check_friend_request(request.user, friend, existing_friendship)
 
-        if existing_friendship:
-            if existing_friendship.status == 'accepted':
-                return JsonResponse({'error': 'Already friends'}, status=400)
-            elif existing_friendship.status == 'pending':
-                return JsonResponse({'error': 'Friend request already sent'}, status=400)
-            elif existing_friendship.status == 'blocked':
-                return JsonResponse({'error': 'Cannot send friend request'}, status=400)
-        
         # Create friendship request
         friendship = Friendship.objects.create(
             requester=request.user,
             addressee=friend,
             status='pending'
         )
+        return _friend_request_sent(friendship, friend)
 
-        return JsonResponse({
-            'message': 'Friend request sent successfully',
-            'friendship_id': friendship.id,
-            'friend': {
-                'id': friend.id,
-                'name': friend.username,
-                'email': friend.email
-            }
-        }, status=200)
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def aadd_friend(request):
+    try:
+        friend_id = parse_friend_id(read_json(request))
+        user = await request.auser()
+
+        try:
+            friend = await User.objects.aget(id=friend_id)
+        except User.DoesNotExist:
+            return FastJsonResponse({'error': 'User Not Found'}, status=404)
 
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        existing_friendship = await Friendship.objects.filter(
+            Q(requester=user, addressee=friend) |
+            Q(requester=friend, addressee=user)
+        ).afirst()
+        check_friend_request(user, friend, existing_friendship)
+
+        friendship = await Friendship.objects.acreate(
+            requester=user,
+            addressee=friend,
+            status='pending'
+        )
+        return _friend_request_sent(friendship, friend)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
-    
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+def _pending_request(friendship_id, user):
+    return Friendship.objects.select_related('requester').filter(
+        id=friendship_id,
+        addressee=user,
+        status='pending'
+    )
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def accept_friend_request(request):
     try:
-        data = json.loads(request.body)
-        friendship_id = data.get('friendship_id')
-        
-        if not friendship_id:
-            return JsonResponse({'error': 'Friendship ID is required'}, status=400)
-        
+        friendship_id = parse_friendship_id(read_json(request))
+
         try:
-            friendship = Friendship.objects.get(
-                id=friendship_id,
-                addressee=request.user,
-                status='pending'
-            )
+            friendship = _pending_request(friendship_id, request.user).get()
         except Friendship.DoesNotExist:
-            return JsonResponse({'error': 'Friend request not found'}, status=404)
-        
+            return FastJsonResponse({'error': 'Friend request not found'}, status=404)
+
         friendship.status = 'accepted'
         friendship.save()
-        
-        return JsonResponse({
+
+        return FastJsonResponse({
             'message': 'Friend request accepted',
-            'friend': {
-                'id': friendship.requester.id,
-                'name': friendship.requester.username,
-                'email': friendship.requester.email
-            }
+            'friend': user_data(friendship.requester)
         }, status=200)
-        
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def aaccept_friend_request(request):
+    try:
+        friendship_id = parse_friendship_id(read_json(request))
+        user = await request.auser()
+
+        try:
+            friendship = await _pending_request(friendship_id, user).aget()
+        except Friendship.DoesNotExist:
+            return FastJsonResponse({'error': 'Friend request not found'}, status=404)
+
+        friendship.status = 'accepted'
+        await friendship.asave()
+
+        return FastJsonResponse({
+            'message': 'Friend request accepted',
+            'friend': user_data(friendship.requester)
+        }, status=200)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
 
 @login_required
 def get_friends(request):
-    """Get user's friends list with friendship details"""
+    """
+    Get one page of the user's friends with friendship details, newest friendship first.
+    Query parameters: limit, and the opaque cursor returned as next_cursor by the previous page.
+    """
     try:
-        friendships = Friendship.objects.filter(
-            Q(requester=request.user) | Q(addressee=request.user),
-            status__in=['accepted', 'Blocked']
-        )
-        
-        friends_list = []
-        for friendship in friendships:
-            # Get the other user (friend)
-            friend = friendship.addressee if friendship.requester == request.user else friendship.requester
-            friends_list.append({
-                'id': friend.id,
-                'name': friend.username,
-                'email': friend.email,
-                'photo_path': getattr(friend, 'user_photo_path', ''),
-                'friendship_id': friendship.id,
-                'status': friendship.status
-            })
-        
-        return JsonResponse({
+        page_args = parse_friend_page_args(request.GET)
+    except ValueError as e:
+        return FastJsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    try:
+        friends_list, next_cursor, has_more = get_friend_page(request.user.id, **page_args)
+
+        return FastJsonResponse({
             'success': True,
-            'friends': friends_list
+            'friends': friends_list,
+            'next_cursor': next_cursor,
+            'has_more': has_more
         }, status=200)
     except Exception as e:
-        return JsonResponse({
+        return FastJsonResponse({
             'success': False,
             'error': str(e)
         }, status=500)
 
 @login_required
-def get_friend_requests(request):
-    """Get pending friend requests"""
-    pending_requests = Friendship.get_pending_requests(request.user)
-    requests_list = []
-    
-    for req in pending_requests:
-        requests_list.append({
-            'id': req.id,
-            'username': req.requester.username,
-            'user_photo_path': getattr(req.requester, 'user_photo_path', ''),
-            'created_at': req.created_at.isoformat(),
-            'friendship_id': req.id
-        })
-    
-    return JsonResponse({
+async def aget_friends(request):
+    try:
+        page_args = parse_friend_page_args(request.GET)
+    except ValueError as e:
+        return FastJsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    try:
+        user = await request.auser()
+        friends_list, next_cursor, has_more = await aget_friend_page(user.id, **page_args)
+
+        return FastJsonResponse({
+            'success': True,
+            'friends': friends_list,
+            'next_cursor': next_cursor,
+            'has_more': has_more
+        }, status=200)
+    except Exception as e:
+        return FastJsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+def _friend_requests_response(requests_list, next_cursor, has_more):
+    return FastJsonResponse({
         'success': True,
         'requests': requests_list,
-        'friend_requests': requests_list  # Keep both formats for compatibility
+        'friend_requests': requests_list,  # Keep both formats for compatibility
+        'next_cursor': next_cursor,
+        'has_more': has_more
     }, status=200)
 
+@login_required
+def get_friend_requests(request):
+    """Get one page of pending friend requests, paginated like get_friends"""
+    try:
+        page_args = parse_friend_page_args(request.GET)
+    except ValueError as e:
+        return FastJsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    return _friend_requests_response(*get_friend_request_page(request.user.id, **page_args))
+
+@login_required
+async def aget_friend_requests(request):
+    try:
+        page_args = parse_friend_page_args(request.GET)
+    except ValueError as e:
+        return FastJsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    user = await request.auser()
+    return _friend_requests_response(*await aget_friend_request_page(user.id, **page_args))
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def decline_friend_request(request):
     try:
-        data = json.loads(request.body)
-        friendship_id = data.get('friendship_id')
-        
-        if not friendship_id:
-            return JsonResponse({'error': 'Friendship ID is required'}, status=400)
-        
+        friendship_id = parse_friendship_id(read_json(request))
+
         try:
-            friendship = Friendship.objects.get(
-                id=friendship_id,
-                addressee=request.user,
-                status='pending'
-            )
+            friendship = _pending_request(friendship_id, request.user).get()
         except Friendship.DoesNotExist:
-            return JsonResponse({'error': 'Friend request not found'}, status=404)
-        
+            return FastJsonResponse({'error': 'Friend request not found'}, status=404)
+
         # Delete the friendship request
-        requester_name = friendship.requester.username
         friendship.delete()
-        
-        return JsonResponse({
-            'message': f'Friend request from {requester_name} declined',
+
+        return FastJsonResponse({
+            'message': f'Friend request from {friendship.requester.username} declined',
+        }, status=200)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def adecline_friend_request(request):
+    try:
+        friendship_id = parse_friendship_id(read_json(request))
+        user = await request.auser()
+
+        try:
+            friendship = await _pending_request(friendship_id, user).aget()
+        except Friendship.DoesNotExist:
+            return FastJsonResponse({'error': 'Friend request not found'}, status=404)
+
+        await friendship.adelete()
+
+        return FastJsonResponse({
+            'message': f'Friend request from {friendship.requester.username} declined',
         }, status=200)
-        
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+def _listed_friendship(friendship_id, user):
+    return Friendship.objects.select_related('requester', 'addressee').filter(
+        Q(id=friendship_id) &
+        (Q(requester=user) | Q(addressee=user)),
+        status__in=['accepted', 'Blocked']
+    )
+
+def _friendship_changed(message, friendship, user, status=None):
+    data = {'message': message, 'friend': user_data(other_user(friendship, user))}
+    if status is not None:
+        data['status'] = status
+    return FastJsonResponse(data, status=200)
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def block_friend(request):
     try:
-        data = json.loads(request.body)
-        friendship_id = data.get('friendship_id')
-        
-        if not friendship_id:
-            return JsonResponse({'error': 'Friendship ID is required'}, status=400)
-        
+        friendship_id = parse_friendship_id(read_json(request))
+
         try:
-            friendship = Friendship.objects.get(
-                Q(id=friendship_id) & 
-                (Q(requester=request.user) | Q(addressee=request.user)),
-                status__in=['accepted', 'Blocked']
-            )
+            friendship = _listed_friendship(friendship_id, request.user).get()
         except Friendship.DoesNotExist:
-            return JsonResponse({'error': 'Friendship not found'}, status=404)
-        
-        if friendship.status == 'accepted':
-            friendship.status = 'Blocked'
-            message = 'Friend blocked successfully'
-        elif friendship.status == 'Blocked':
-            friendship.status = 'accepted'
-            message = 'Friend unblocked successfully'
-        else:
-            return JsonResponse({'error': 'Invalid friendship status'}, status=404)
+            return FastJsonResponse({'error': 'Friendship not found'}, status=404)
 
+        message = toggle_block(friendship)
         friendship.save()
-        
-        # Get the other user (friend)
-        other_user = friendship.addressee if friendship.requester == request.user else friendship.requester
-        
-        return JsonResponse({
-            'message': message,
-            'status': friendship.status,
-            'friend': {
-                'id': other_user.id,
-                'name': other_user.username,
-                'email': other_user.email
-            }
-        }, status=200)
-        
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+        return _friendship_changed(message, friendship, request.user, status=friendship.status)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def ablock_friend(request):
+    try:
+        friendship_id = parse_friendship_id(read_json(request))
+        user = await request.auser()
+
+        try:
+            friendship = await _listed_friendship(friendship_id, user).aget()
+        except Friendship.DoesNotExist:
+            return FastJsonResponse({'error': 'Friendship not found'}, status=404)
+
+        message = toggle_block(friendship)
+        await friendship.asave()
+
+        return _friendship_changed(message, friendship, user, status=friendship.status)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def remove_friend(request):
     try:
-        data = json.loads(request.body)
-        friendship_id = data.get('friendship_id')
-        
-        if not friendship_id:
-            return JsonResponse({'error': 'Friendship ID is required'}, status=400)
-        
+        friendship_id = parse_friendship_id(read_json(request))
+
         try:
-            friendship = Friendship.objects.get(
-                Q(id=friendship_id) & 
-                (Q(requester=request.user) | Q(addressee=request.user)),
-                status__in=['accepted', 'Blocked']
-            )
+            friendship = _listed_friendship(friendship_id, request.user).get()
         except Friendship.DoesNotExist:
-            return JsonResponse({'error': 'Friendship not found'}, status=404)
-        
-        # Get the other user before deleting
-        other_user = friendship.addressee if friendship.requester == request.user else friendship.requester
-        
+            return FastJsonResponse({'error': 'Friendship not found'}, status=404)
+
         friendship.delete()
-        
-        return JsonResponse({
-            'message': 'Friendship removed successfully',
-            'friend': {
-                'id': other_user.id,
-                'name': other_user.username,
-                'email': other_user.email
-            }
-        }, status=200)
-        
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+        return _friendship_changed('Friendship removed successfully', friendship, request.user)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def aremove_friend(request):
+    try:
+        friendship_id = parse_friendship_id(read_json(request))
+        user = await request.auser()
+
+        try:
+            friendship = await _listed_friendship(friendship_id, user).aget()
+        except Friendship.DoesNotExist:
+            return FastJsonResponse({'error': 'Friendship not found'}, status=404)
+
+        await friendship.adelete()
+
+        return _friendship_changed('Friendship removed successfully', friendship, user)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
@@ -1,14 +1,20 @@
 from django.shortcuts import render, redirect
-from ..models import User, Friendship, ChatRoom, Message
+from ..models import User, Friendship, ChatRoom, InboxEntry
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from ..utils.user_info import get_user_photo
 from ..utils.get_user_latest_chat_rooms import get_user_latest_chat_rooms
-from django.http import JsonResponse
+from ..utils.message_store import create_message
+from ..utils.message_history import get_message_page, aget_message_page, parse_message_page_args
+from ..utils.message_status import get_read_watermarks, aget_read_watermarks
+from ..utils.presence import get_room_roster
+from ..utils.message_search import search_user_messages, parse_search_args
+from ..utils.fast_json import FastJsonResponse
+from ..utils.request_validation import RequestError, read_json, parse_start_chat, check_start_chat, parse_send_message
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from django.db.models import Q, Max
-import json
+from django.db.models import Q, Prefetch
 
 #the Main Page route
 @login_required
@@ -16,30 +22,33 @@ def main_menu(request):
     if not request.user.is_authenticated:
         return redirect('login')
     
-    # Get chat rooms where the user is a participant, ordered by latest message
-    user_chat_rooms = ChatRoom.objects.filter(
-        participants=request.user
+    # Get the user's inbox, ordered by latest activity.
+    # Unread counts and the last message are maintained on write, so the whole list costs two
+    # queries (one range scan over the user's inbox rows joined with room, last message and
+    # sender, plus one participants prefetch)
+    inbox_entries = InboxEntry.objects.filter(
+        user=request.user
+    ).select_related(
+        'room__last_message__sender'
     ).prefetch_related(
-        'participants', 
-        'messages__sender'
-    ).annotate(
-        latest_message_time=Max('messages__timestamp')
-    ).order_by('-latest_message_time')
+        Prefetch('room__participants', queryset=User.objects.only('id', 'username', 'user_photo_path'))
+    ).order_by('-last_activity_at')
     
     # Prepare chat room data with other user info and last message
     user_latest_chat_rooms = []
-    for chat_room in user_chat_rooms:
+    for inbox_entry in inbox_entries:
+        chat_room = inbox_entry.room
+        last_message = chat_room.last_message
         if not chat_room.is_group:
             # For direct chats, get the other participant
-            other_users = chat_room.participants.exclude(id=request.user.id)
-            if other_users.exists():
-                other_user = other_users.first()
+            other_users = [user for user in chat_room.participants.all() if user.id != request.user.id]
+            if other_users:
+                other_user = other_users[0]
                 
                 # Get the last message
-                last_message = chat_room.messages.order_by('-timestamp').first()
                 last_message_content = ""
                 if last_message:
-                    if last_message.sender == request.user:
+                    if last_message.sender_id == request.user.id:
                         last_message_content = f"You: {last_message.content}"
                     else:
                         last_message_content = last_message.content
@@ -50,14 +59,13 @@ def main_menu(request):
                     'other_user_name': other_user.username,  # Changed from first_name + last_name
                     'other_user_photo': other_user.user_photo_path if other_user.user_photo_path else None,
                     'last_message': last_message_content,
-                    'unread_count': 0  # You can implement unread count logic here
+                    'unread_count': inbox_entry.unread_count
                 })
         else:
             # For group chats, use the group name
-            last_message = chat_room.messages.order_by('-timestamp').first()
             last_message_content = ""
             if last_message:
-                if last_message.sender == request.user:
+                if last_message.sender_id == request.user.id:
                     last_message_content = f"You: {last_message.content}"
                 else:
                     last_message_content = f"{last_message.sender.username}: {last_message.content}"
@@ -67,123 +75,237 @@ def main_menu(request):
                 'other_user_name': chat_room.name or f"Group Chat {chat_room.id}",
                 'other_user_photo': None,  # Groups don't have photos for now
                 'last_message': last_message_content,
-                'unread_count': 0
+                'unread_count': inbox_entry.unread_count
             })
     
     return render(request, 'main_menu.html', {
         'user_latest_chat_rooms': user_latest_chat_rooms
     })
 
+def _chat_ready(chat_room, created):
+    return FastJsonResponse({
+        'success': True,
+        'chat_room_id': chat_room.id,
+        'message': 'Chat room created successfully' if created else 'Chat room ready'
+    }, status=201 if created else 200)
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def start_chat(request):
     """Start or get existing chat room between two users"""
     try:
-        data = json.loads(request.body)
-        user_id = data.get('user_id')
+        user_id = parse_start_chat(read_json(request))
 
-        if not user_id:
-            return JsonResponse({'error': 'User ID is required'}, status=400)
-            
         try:
             other_user = User.objects.get(id=user_id)
         except User.DoesNotExist:
-            return JsonResponse({'error': 'User not found'}, status=404)
+            return FastJsonResponse({'error': 'User not found'}, status=404)
 
-        if request.user == other_user:
-            return JsonResponse({'error': 'Cannot start chat with yourself'}, status=400)
+        check_start_chat(request.user, other_user)
 
         # Get or create chat room (removed friendship requirement)
-        chat_room, created = ChatRoom.get_or_create_direct_chat(request.user, other_user)
+        return _chat_ready(*ChatRoom.get_or_create_direct_chat(request.user, other_user))
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
 
-        return JsonResponse({
-            'success': True,
-            'chat_room_id': chat_room.id,
-            'message': 'Chat room created successfully' if created else 'Chat room ready'
-        }, status=201 if created else 200)
+@csrf_exempt
+@require_http_methods(["POST"])
+async def astart_chat(request):
+    """start_chat() on the async ORM, for ASGI servers"""
+    try:
+        user_id = parse_start_chat(read_json(request))
+        user = await request.auser()
 
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        try:
+            other_user = await User.objects.aget(id=user_id)
+        except User.DoesNotExist:
+            return FastJsonResponse({'error': 'User not found'}, status=404)
+
+        check_start_chat(user, other_user)
+
+        return _chat_ready(*await ChatRoom.aget_or_create_direct_chat(user, other_user))
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+def _message_sent(message):
+    return FastJsonResponse({
+        'success': True,
+        'message_id': message.id,
+        'timestamp': message.timestamp
+    }, status=201)
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def send_message(request):
     """Send a message to a chat room"""
     try:
-        data = json.loads(request.body)
-        room_id = data.get('room_id')
-        content = data.get('message')
+        room_id, content = parse_send_message(read_json(request))
 
-        if not room_id or not content:
-            return JsonResponse({'error': 'Room ID and message are required'}, status=400)
-            
         try:
             chat_room = ChatRoom.objects.get(id=room_id)
         except ChatRoom.DoesNotExist:
-            return JsonResponse({'error': 'Chat room not found'}, status=404)
+            return FastJsonResponse({'error': 'Chat room not found'}, status=404)
 
         # Check if user is a participant
         if not chat_room.participants.filter(id=request.user.id).exists():
-            return JsonResponse({'error': 'Access denied'}, status=403)
+            return FastJsonResponse({'error': 'Access denied'}, status=403)
 
         # Create the message
-        message = Message.objects.create(
-            room=chat_room,
+        message = create_message(
+            room_id=chat_room.id,
             sender=request.user,
-            content=content.strip()
+            content=content
         )
+        return _message_sent(message)
 
-        return JsonResponse({
-            'success': True,
-            'message_id': message.id,
-            'timestamp': message.timestamp.isoformat()
-        }, status=201)
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return FastJsonResponse({'error': str(e)}, status=500)
 
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+@csrf_exempt
+@require_http_methods(["POST"])
+async def asend_message(request):
+    """send_message() on the async ORM, for ASGI servers"""
+    try:
+        room_id, content = parse_send_message(read_json(request))
+        user = await request.auser()
+
+        if not await ChatRoom.objects.filter(id=room_id).aexists():
+            return FastJsonResponse({'error': 'Chat room not found'}, status=404)
+
+        if not await ChatRoom.participants.through.objects.filter(chatroom_id=room_id, user_id=user.id).aexists():
+            return FastJsonResponse({'error': 'Access denied'}, status=403)
+
+        # The message and the chat list are written in one transaction, which the async ORM has not
+        message = await sync_to_async(create_message)(room_id=room_id, sender=user, content=content)
+        return _message_sent(message)
+
+    except RequestError as e:
+        return FastJsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
+
+def _error(message, status):
+    return FastJsonResponse({
+        'success': False,
+        'error': message
+    }, status=status)
+
+def _message_page(messages_data, next_cursor, has_more, read_watermarks):
+    return FastJsonResponse({
+        'success': True,
+        'messages': messages_data,
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+        # a message was seen by every user whose watermark is >= its id
+        'read_watermarks': read_watermarks
+    }, status=200)
 
 @login_required
 def get_messages(request, chat_room_id):
-    """Get messages for a specific chat room"""
+    """
+    Get a page of messages for a specific chat room
+
+    Query parameters: before_id (older messages), after_id (newer messages), limit, or the
+    opaque cursor returned as next_cursor by the previous page. No cursor returns the latest page.
+    """
     try:
         chat_room = ChatRoom.objects.get(id=chat_room_id)
         
         # Check if user is a participant
         if not chat_room.participants.filter(id=request.user.id).exists():
-            return JsonResponse({
-                'success': False,
-                'error': 'Access denied'
-            }, status=403)
-        
-        messages = Message.objects.filter(room=chat_room).order_by('timestamp')
-        
-        messages_data = []
-        for message in messages:
-            messages_data.append({
-                'id': message.id,
-                'content': message.content,
-                'sender_id': message.sender.id,
-                'sender_username': message.sender.username,
-                'timestamp': message.timestamp.isoformat(),
-                'status': getattr(message, 'status', 'sent')
-            })
-        
-        return JsonResponse({
-            'success': True,
-            'messages': messages_data
-        }, status=200)
+            return _error('Access denied', 403)
+
+        try:
+            page_args = parse_message_page_args(request.GET)
+        except ValueError as e:
+            return _error(str(e), 400)
+
+        return _message_page(
+            *get_message_page(chat_room.id, **page_args),
+            get_read_watermarks(chat_room.id)
+        )
         
     except ChatRoom.DoesNotExist:
-        return JsonResponse({
+        return _error('Chat room not found', 404)
+    except Exception as e:
+        return _error(str(e), 500)
+
+@login_required
+async def aget_messages(request, chat_room_id):
+    """get_messages() on the async ORM, for ASGI servers"""
+    try:
+        user = await request.auser()
+        if not await ChatRoom.objects.filter(id=chat_room_id).aexists():
+            return _error('Chat room not found', 404)
+
+        if not await ChatRoom.participants.through.objects.filter(chatroom_id=chat_room_id, user_id=user.id).aexists():
+            return _error('Access denied', 403)
+
+        try:
+            page_args = parse_message_page_args(request.GET)
+        except ValueError as e:
+            return _error(str(e), 400)
+
+        return _message_page(
+            *await aget_message_page(chat_room_id, **page_args),
+            await aget_read_watermarks(chat_room_id)
+        )
+
+    except Exception as e:
+        return _error(str(e), 500)
+
+@login_required
+async def get_room_presence(request, chat_room_id):
+    """Get the users online in a chat room, served from the presence store"""
+    user = await request.auser()
+
+    # Check if user is a participant
+    if not await ChatRoom.participants.through.objects.filter(chatroom_id=chat_room_id, user_id=user.id).aexists():
+        return FastJsonResponse({
+            'success': False,
+            'error': 'Access denied'
+        }, status=403)
+
+    return FastJsonResponse({
+        'success': True,
+        'online_users': await get_room_roster(chat_room_id)
+    }, status=200)
+
+@login_required
+def search_messages(request):
+    """
+    Full-text search over the messages of the user's chat rooms
+
+    Query parameters: q, room_id (search one room only), limit, and the opaque cursor returned as
+    next_cursor by the previous page. Results are ordered by relevance, then newest first.
+    """
+    try:
+        search_args = parse_search_args(request.GET)
+    except ValueError as e:
+        return FastJsonResponse({
             'success': False,
-            'error': 'Chat room not found'
-        }, status=404)
+            'error': str(e)
+        }, status=400)
+
+    try:
+        results, next_cursor, has_more = search_user_messages(request.user.id, **search_args)
     except Exception as e:
-        return JsonResponse({
+        return FastJsonResponse({
             'success': False,
             'error': str(e)
         }, status=500)
+
+    return FastJsonResponse({
+        'success': True,
+        'results': results,
+        'next_cursor': next_cursor,
+        'has_more': has_more
+    }, status=200)
@@ -0,0 +1,58 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from ..models import ChatRoom
+from ..protocol import frame_event
+
+def get_room_group_name(room_id):
+    """Channel layer group of the sockets open on a chat room"""
+    return f'chat_{room_id}'
+
+def get_user_group_name(user_id):
+    """Channel layer group of the multiplexed sockets of a user"""
+    return f'user_{user_id}'
+
+def notify_participants_changed(room_ids):
+    """
+    Tell the sockets of the given rooms their participants changed, so they refresh the
+    membership they cached at connect. Sent once the surrounding transaction commits.
+    """
+    room_ids = list(room_ids)
+
+    def send():
+        participants = {room_id: [] for room_id in room_ids}
+        for user_id, room_id in ChatRoom.participants.through.objects.filter(
+            chatroom_id__in=room_ids
+        ).values_list('user_id', 'chatroom_id'):
+            participants[room_id].append(user_id)
+
+        channel_layer = get_channel_layer()
+        for room_id, participant_ids in participants.items():
+            async_to_sync(channel_layer.group_send)(
+                get_room_group_name(room_id),
+                {
+                    'type': 'participants_changed',
+                    'room_id': room_id,
+                    'participant_ids': participant_ids
+                }
+            )
+
+    transaction.on_commit(send)
+
+def notify_membership_changed(pairs, added):
+    """
+    Tell the multiplexed sockets of each user in the (user_id, room_id) pairs that they were
+    added to or removed from the room. Sent once the surrounding transaction commits.
+    """
+    pairs = list(pairs)
+    event_type = 'room_added' if added else 'room_removed'
+
+    def send():
+        channel_layer = get_channel_layer()
+        for user_id, room_id in pairs:
+            async_to_sync(channel_layer.group_send)(
+                get_user_group_name(user_id),
+                frame_event(event_type, {'type': event_type, 'room_id': room_id})
+            )
+
+    transaction.on_commit(send)
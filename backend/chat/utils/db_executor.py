@@ -0,0 +1,45 @@
+"""
+Dedicated thread pool for the database work of the WebSocket consumers that can't go through the
+async ORM (transactions, select_for_update).
+
+channels' database_sync_to_async is thread sensitive by default: outside of a request every call
+of the process is queued on one shared thread, so a slow query holds up every other socket. Jobs
+sent here run on up to settings.CHAT_DB_EXECUTOR['MAX_WORKERS'] threads of their own, each keeping
+its database connection between jobs (within CONN_MAX_AGE), which bounds the connections a worker
+process opens for its sockets.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+
+def get_db_executor():
+    """The process-wide executor sized by settings.CHAT_DB_EXECUTOR"""
+    global _executor
+    if _executor is None:
+        config = getattr(settings, 'CHAT_DB_EXECUTOR', {})
+        _executor = ThreadPoolExecutor(
+            max_workers=config.get('MAX_WORKERS', 8),
+            thread_name_prefix='chat-db'
+        )
+    return _executor
+
+def _run_job(function, *args, **kwargs):
+    # Same connection handling as database_sync_to_async: drop connections that expired or broke
+    close_old_connections()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+async def run_in_db_executor(function, *args, **kwargs):
+    """Run a sync database function on the executor and wait for its result"""
+    # Context variables follow the job, like they do through sync_to_async
+    context = contextvars.copy_context()
+    job = functools.partial(context.run, _run_job, function, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(get_db_executor(), job)
@@ -0,0 +1,60 @@
+"""
+Fast JSON serialization for the chat views and sockets.
+
+orjson is used when it is installed (detected at import) and the stdlib encoder otherwise. Both
+produce the same output: datetimes as full isoformat() strings, so views and frames can hand over
+datetime objects instead of formatting them one by one in Python; non-string dict keys (e.g. user
+ids) become strings; UUIDs, Decimals and lazy translations are encoded like DjangoJSONEncoder does.
+"""
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class FastJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder with datetimes kept to the microsecond, as orjson writes them"""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+_encoder = FastJSONEncoder()
+
+def stdlib_dumps_bytes(obj):
+    return json.dumps(obj, cls=FastJSONEncoder).encode()
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def orjson_dumps_bytes(obj):
+        # types orjson does not know natively go through the Django encoder
+        return orjson.dumps(obj, default=_encoder.default, option=orjson.OPT_NON_STR_KEYS)
+
+    dumps_bytes = orjson_dumps_bytes
+    loads = orjson.loads
+else:
+    BACKEND = 'json'
+    dumps_bytes = stdlib_dumps_bytes
+    loads = json.loads
+
+def dumps(obj):
+    """Serialize to a str, e.g. for a WebSocket text frame"""
+    return dumps_bytes(obj).decode()
+
+class FastJsonResponse(HttpResponse):
+    """JsonResponse serialized with the fast backend"""
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                'In order to allow non-dict objects to be serialized set the safe parameter to False.'
+            )
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps_bytes(data), **kwargs)
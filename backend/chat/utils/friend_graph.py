@@ -0,0 +1,59 @@
+"""
+Cached friend graph.
+
+The ids of a user's accepted friends are kept as a frozenset in the "friend_graph" cache, shared
+by every worker (Redis, see settings.CHAT_FRIEND_GRAPH), so membership checks are set lookups and
+friend lists are one bulk user fetch. The sets of both users of a friendship are dropped whenever
+it is saved or deleted (see signals.py), right away and again once the transaction commits, so a
+set read concurrently from the old rows does not outlive the change. Changes made with
+QuerySet.update() or bulk_create() send no signals and are only seen when the sets expire after
+TTL seconds.
+
+Without the shared cache nothing is cached: a cache private to each process could only be
+invalidated in the worker that made the change, the others would keep answering from a stale set.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from ..models import Friendship
+
+CACHE_ALIAS = 'friend_graph'
+
+def _cache_key(user_id):
+    return f'chat:friend_ids:{user_id}'
+
+def get_friend_graph_cache():
+    """The shared cache of the friend sets, None when it is not configured"""
+    if CACHE_ALIAS not in settings.CACHES:
+        return None
+    return caches[CACHE_ALIAS]
+
+def get_friend_ids(user_id):
+    """The ids of the user's accepted friends from the shared cache, None when there is no shared cache"""
+    cache = get_friend_graph_cache()
+    if cache is None:
+        return None
+
+    key = _cache_key(user_id)
+    friend_ids = cache.get(key)
+    if friend_ids is None:
+        rows = Friendship.objects.filter(
+            Q(requester_id=user_id) | Q(addressee_id=user_id),
+            status='accepted'
+        ).order_by().values_list('requester_id', 'addressee_id')
+        friend_ids = frozenset(
+            addressee_id if requester_id == user_id else requester_id
+            for requester_id, addressee_id in rows
+        )
+        cache.set(key, friend_ids, getattr(settings, 'CHAT_FRIEND_GRAPH', {}).get('TTL', 3600))
+    return friend_ids
+
+def invalidate_friend_ids(*user_ids):
+    """Drop the cached friend sets of the users, now and once the transaction commits"""
+    cache = get_friend_graph_cache()
+    if cache is None:
+        return
+    keys = [_cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,103 @@
+from django.db.models import Q
+from ..models import Friendship
+from .pagination import encode_cursor, decode_cursor, parse_limit
+
+FRIENDS_PAGE_SIZE = 50
+MAX_FRIENDS_PAGE_SIZE = 200
+# 'Blocked' is what block_friend writes
+LISTED_FRIEND_STATUSES = ['accepted', 'Blocked']
+
+def parse_friend_page_args(params):
+    """Read cursor / limit from request parameters"""
+    before_id = None
+    if params.get('cursor'):
+        position = decode_cursor(params['cursor'])
+        try:
+            before_id = int(position['before'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+
+    return {
+        'before_id': before_id,
+        'limit': parse_limit(params.get('limit'), FRIENDS_PAGE_SIZE, MAX_FRIENDS_PAGE_SIZE),
+    }
+
+def get_friend_page(user_id, before_id=None, limit=FRIENDS_PAGE_SIZE):
+    """
+    One page of the user's friends. Both users of each friendship are read through joins in the
+    same query, so a page costs one query whatever its size.
+    """
+    rows = list(_friend_rows(user_id, before_id, limit))
+    return _friend_page(rows, user_id, limit)
+
+async def aget_friend_page(user_id, before_id=None, limit=FRIENDS_PAGE_SIZE):
+    """get_friend_page() through the async ORM"""
+    rows = [row async for row in _friend_rows(user_id, before_id, limit)]
+    return _friend_page(rows, user_id, limit)
+
+def get_friend_request_page(user_id, before_id=None, limit=FRIENDS_PAGE_SIZE):
+    """One page of the pending friend requests the user received, in one query"""
+    rows = list(_friend_request_rows(user_id, before_id, limit))
+    return _friend_request_page(rows, limit)
+
+async def aget_friend_request_page(user_id, before_id=None, limit=FRIENDS_PAGE_SIZE):
+    """get_friend_request_page() through the async ORM"""
+    rows = [row async for row in _friend_request_rows(user_id, before_id, limit)]
+    return _friend_request_page(rows, limit)
+
+def _page_rows(friendships, before_id, limit, fields):
+    # Newest friendship first, keyset on the friendship id, one extra row tells us if there is more
+    if before_id is not None:
+        friendships = friendships.filter(id__lt=before_id)
+    return friendships.order_by('-id').values(*fields)[:limit + 1]
+
+def _page(rows, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(before=rows[-1]['id']) if has_more else None
+    return rows, next_cursor, has_more
+
+def _friend_rows(user_id, before_id, limit):
+    friendships = Friendship.objects.filter(
+        Q(requester_id=user_id) | Q(addressee_id=user_id),
+        status__in=LISTED_FRIEND_STATUSES
+    )
+    return _page_rows(friendships, before_id, limit, [
+        'id', 'status', 'requester_id',
+        'requester__username', 'requester__email', 'requester__user_photo_path',
+        'addressee_id',
+        'addressee__username', 'addressee__email', 'addressee__user_photo_path',
+    ])
+
+def _friend_page(rows, user_id, limit):
+    rows, next_cursor, has_more = _page(rows, limit)
+    friends_list = []
+    for row in rows:
+        # the other user of the friendship
+        side = 'addressee' if row['requester_id'] == user_id else 'requester'
+        friends_list.append({
+            'id': row[f'{side}_id'],
+            'name': row[f'{side}__username'],
+            'email': row[f'{side}__email'],
+            'photo_path': row[f'{side}__user_photo_path'] or '',
+            'friendship_id': row['id'],
+            'status': row['status']
+        })
+    return friends_list, next_cursor, has_more
+
+def _friend_request_rows(user_id, before_id, limit):
+    friendships = Friendship.objects.filter(addressee_id=user_id, status='pending')
+    return _page_rows(friendships, before_id, limit, [
+        'id', 'requester__username', 'requester__user_photo_path', 'created_at',
+    ])
+
+def _friend_request_page(rows, limit):
+    rows, next_cursor, has_more = _page(rows, limit)
+    requests_list = [{
+        'id': row['id'],
+        'username': row['requester__username'],
+        'user_photo_path': row['requester__user_photo_path'] or '',
+        'created_at': row['created_at'],
+        'friendship_id': row['id']
+    } for row in rows]
+    return requests_list, next_cursor, has_more
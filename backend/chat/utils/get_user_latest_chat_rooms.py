@@ -1,5 +1,5 @@
-from django.db.models import Max
-from ..models import User, ChatRoom, Message
+from django.db.models import F, Prefetch
+from ..models import User, ChatRoom
 
 def get_user_latest_chat_rooms(user_id):
     if not user_id:
@@ -8,30 +8,32 @@ def get_user_latest_chat_rooms(user_id):
     try:
         user = User.objects.get(id=user_id)
         
+        # The last message is denormalized on the room, so this is one query plus one prefetch
         chat_rooms = ChatRoom.objects.filter(
             participants=user
-        ).annotate(
-            latest_message_time=Max('messages__timestamp')
-        ).order_by('-latest_message_time', '-created_at')
+        ).select_related(
+            'last_message'
+        ).prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id', 'username'))
+        ).order_by(F('last_message_at').desc(nulls_last=True), '-created_at')
         
         # Enhanced chat room data with proper names and latest messages
         enhanced_chat_rooms = []
         for room in chat_rooms:
             # Get the other participant's name for direct chats
             if not room.is_group:
-                other_participants = room.participants.exclude(id=user_id)
-                if other_participants.exists():
-                    room.name = other_participants.first().username
+                other_participants = [participant for participant in room.participants.all() if participant.id != user.id]
+                if other_participants:
+                    room.name = other_participants[0].username
                 else:
                     room.name = f"Chat {room.id}"
             
             # Get the latest message
-            latest_message = room.messages.order_by('-timestamp').first()
-            if latest_message:
-                room.last_message = latest_message.content
-                room.last_message_time = latest_message.timestamp
+            if room.last_message:
+                room.last_message_content = room.last_message.content
+                room.last_message_time = room.last_message_at
             else:
-                room.last_message = "No messages yet"
+                room.last_message_content = "No messages yet"
                 room.last_message_time = room.created_at
             
             enhanced_chat_rooms.append(room)
@@ -40,4 +42,3 @@ def get_user_latest_chat_rooms(user_id):
     
     except User.DoesNotExist:
         return []
-
@@ -0,0 +1,149 @@
+"""
+Live chat list updates.
+
+Whenever a room's chat list data changes (a new message, messages read) the personal group of each
+affected user gets a compact frame with the new state of the room in their chat list:
+
+    {"type": "inbox_update", "rooms": [{"room_id": 7, "unread_count": 3, "last_message_at": "...",
+                                        "last_message": "...", "last_sender": "..."}]}
+
+Changes are coalesced per process over INTERVAL seconds: however many messages a busy group chat
+receives in that window, each of its participants gets at most one frame per worker, built from a
+single query over the inbox rows. Changes are only queued once their transaction commits.
+"""
+import asyncio
+import logging
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from ..models import InboxEntry
+from ..protocol import frame_event
+from .channel_groups import get_user_group_name
+
+logger = logging.getLogger(__name__)
+
+# Characters of the last message sent in an update
+PREVIEW_LENGTH = 100
+
+def build_inbox_updates(room_ids, user_rooms):
+    """
+    Room deltas grouped by user, {user_id: [delta, ...]}, for every participant of room_ids and
+    for the (user_id, room_id) pairs of user_rooms, read in one query
+    """
+    rows = InboxEntry.objects.filter(
+        room_id__in=set(room_ids) | {room_id for _, room_id in user_rooms}
+    ).values_list(
+        'user_id', 'room_id', 'unread_count', 'room__last_message_at',
+        'room__last_message__content', 'room__last_message__sender__username'
+    )
+
+    updates = {}
+    for user_id, room_id, unread_count, last_message_at, content, sender in rows:
+        if room_id not in room_ids and (user_id, room_id) not in user_rooms:
+            continue
+        updates.setdefault(user_id, []).append({
+            'room_id': room_id,
+            'unread_count': unread_count,
+            'last_message_at': last_message_at,
+            'last_message': content[:PREVIEW_LENGTH] if content else None,
+            'last_sender': sender
+        })
+    return updates
+
+async def send_inbox_updates(updates):
+    """Send one inbox_update frame to the personal group of each user"""
+    channel_layer = get_channel_layer()
+    for user_id, rooms in updates.items():
+        await channel_layer.group_send(
+            get_user_group_name(user_id),
+            frame_event('inbox_update', {'type': 'inbox_update', 'rooms': rooms})
+        )
+
+class InboxNotifier:
+    """
+    Collects the rooms changed in this process and sends the updates once per interval.
+    Changes come from request threads and database threads alike, so it uses a timer thread.
+    The frames are sent on the server's event loop once a socket has registered it (the in-memory
+    channel layer only delivers on its own loop, channels_redis keeps its connections per loop).
+    """
+
+    def __init__(self, interval, send=send_inbox_updates):
+        self.interval = interval
+        self.send = send
+        self.loop = None
+        self.lock = threading.Lock()
+        # rooms whose every participant is notified
+        self.rooms = set()
+        # (user_id, room_id) changes that only concern one user, e.g. they read the room
+        self.user_rooms = set()
+        self.timer = None
+
+    def room_changed(self, room_id):
+        with self.lock:
+            self.rooms.add(room_id)
+            self._schedule()
+
+    def user_room_changed(self, user_id, room_id):
+        with self.lock:
+            self.user_rooms.add((user_id, room_id))
+            self._schedule()
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self._run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _run(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread has its own database connection
+            connection.close()
+
+    def flush(self):
+        """Send the pending updates now, returns how many users were notified"""
+        with self.lock:
+            room_ids, user_rooms = self.rooms, self.user_rooms
+            self.rooms, self.user_rooms, self.timer = set(), set(), None
+        if not room_ids and not user_rooms:
+            return 0
+
+        try:
+            updates = build_inbox_updates(room_ids, user_rooms)
+            if self.loop is not None and self.loop.is_running():
+                asyncio.run_coroutine_threadsafe(self.send(updates), self.loop).result()
+            else:
+                async_to_sync(self.send)(updates)
+        except Exception:
+            logger.exception("Failed to send inbox updates for %d rooms", len(room_ids) + len(user_rooms))
+            return 0
+        return len(updates)
+
+_notifier = None
+
+def get_inbox_notifier():
+    """
+    The process-wide notifier configured by settings.CHAT_INBOX_NOTIFICATIONS. Called from the
+    server's event loop, it registers that loop for sending.
+    """
+    global _notifier
+    if _notifier is None:
+        config = getattr(settings, 'CHAT_INBOX_NOTIFICATIONS', {})
+        _notifier = InboxNotifier(config.get('INTERVAL', 1.0))
+    try:
+        _notifier.loop = asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    return _notifier
+
+def notify_room_changed(room_id):
+    """Queue a chat list update for every participant of the room, once the transaction commits"""
+    transaction.on_commit(lambda: get_inbox_notifier().room_changed(room_id))
+
+def notify_user_room_changed(user_id, room_id):
+    """Queue a chat list update of one room for one user, once the transaction commits"""
+    transaction.on_commit(lambda: get_inbox_notifier().user_room_changed(user_id, room_id))
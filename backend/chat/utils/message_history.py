@@ -0,0 +1,87 @@
+from ..models import Message
+from .pagination import encode_cursor, decode_cursor, parse_limit
+
+MESSAGES_PAGE_SIZE = 50
+MAX_MESSAGES_PAGE_SIZE = 200
+
+def parse_message_page_args(params):
+    """Read before_id / after_id / cursor / limit from request parameters"""
+    before_id = params.get('before_id')
+    after_id = params.get('after_id')
+    cursor = params.get('cursor')
+
+    if cursor:
+        position = decode_cursor(cursor)
+        before_id = position.get('before')
+        after_id = position.get('after')
+
+    if before_id not in (None, '') and after_id not in (None, ''):
+        raise ValueError('Use either before_id or after_id, not both')
+
+    try:
+        before_id = int(before_id) if before_id not in (None, '') else None
+        after_id = int(after_id) if after_id not in (None, '') else None
+    except (TypeError, ValueError):
+        # a tampered cursor can hold any JSON value
+        raise ValueError('Invalid cursor' if cursor else 'before_id and after_id must be integers')
+
+    return {
+        'before_id': before_id,
+        'after_id': after_id,
+        'limit': parse_limit(params.get('limit'), MESSAGES_PAGE_SIZE, MAX_MESSAGES_PAGE_SIZE),
+    }
+
+def get_message_page(room_id, before_id=None, after_id=None, limit=MESSAGES_PAGE_SIZE):
+    """
+    Get one page of a room's messages using the (room, id) index.
+
+    Without a cursor the latest page is returned. Messages are always in chronological order and
+    next_cursor continues in the same direction (older for before_id, newer for after_id).
+    """
+    rows = list(_message_page_rows(room_id, before_id, after_id, limit))
+    return _message_page(rows, after_id, limit)
+
+async def aget_message_page(room_id, before_id=None, after_id=None, limit=MESSAGES_PAGE_SIZE):
+    """get_message_page() through the async ORM"""
+    rows = [row async for row in _message_page_rows(room_id, before_id, after_id, limit)]
+    return _message_page(rows, after_id, limit)
+
+def _message_page_rows(room_id, before_id, after_id, limit):
+    messages = Message.objects.filter(room_id=room_id)
+
+    if after_id is not None:
+        messages = messages.filter(id__gt=after_id).order_by('id')
+    else:
+        if before_id is not None:
+            messages = messages.filter(id__lt=before_id)
+        messages = messages.order_by('-id')
+
+    # Sender data comes from the same query through a join, one extra row tells us if there is more
+    return messages.values(
+        'id', 'content', 'sender_id', 'sender__username', 'timestamp', 'status'
+    )[:limit + 1]
+
+def _message_page(rows, after_id, limit):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+
+    next_cursor = None
+    if has_more:
+        if after_id is not None:
+            next_cursor = encode_cursor(after=rows[-1]['id'])
+        else:
+            next_cursor = encode_cursor(before=rows[0]['id'])
+
+    messages_data = [{
+        'id': row['id'],
+        'content': row['content'],
+        'sender_id': row['sender_id'],
+        'sender_username': row['sender__username'],
+        # datetimes are written by the JSON encoder (utils/fast_json.py)
+        'timestamp': row['timestamp'],
+        'status': row['status']
+    } for row in rows]
+
+    return messages_data, next_cursor, has_more
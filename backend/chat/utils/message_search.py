@@ -0,0 +1,243 @@
+"""
+Full-text search over the messages of the rooms a user participates in.
+
+PostgreSQL: a GIN index on to_tsvector(SEARCH_CONFIG, content), maintained by PostgreSQL itself on
+every insert and update. SQLite (local/dev): an FTS5 external-content table kept in sync by
+triggers, which also indexes the room as a token so a search intersects the word's matches with the
+user's rooms instead of filtering every match of a common word. This app has no migration files, so
+both are created by create_search_index() after migrate (see signals.py). Other databases fall back
+to an unindexed icontains scan without ranking.
+
+Results are ordered by relevance, then newest first, and paginated with a (rank, id) keyset
+cursor. Snippets are HTML-escaped with the matched words wrapped in <mark>.
+"""
+import html
+import re
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+from ..models import Message, ChatRoom, User
+from .pagination import encode_cursor, decode_cursor, parse_limit
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# Text search configuration of PostgreSQL: no stemming or stop words, chats mix languages
+SEARCH_CONFIG = 'simple'
+PG_INDEX_NAME = 'message_content_search_idx'
+# Control characters wrapped around matches by the database, turned into <mark> after escaping
+MARK_START, MARK_END = '\x02', '\x03'
+# Stand-ins for < and > while PostgreSQL builds the snippet, its parser drops anything that looks
+# like an HTML tag from the headline
+LT, GT = '\x04', '\x05'
+SNIPPET_WORDS = 16
+
+def fts_table_name():
+    return f'{Message._meta.db_table}_fts'
+
+def create_search_index(connection):
+    """Create the full-text index of Message.content for the connection's database, if missing"""
+    quote = connection.ops.quote_name
+    table = quote(Message._meta.db_table)
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(PG_INDEX_NAME)} ON {table} "
+                f"USING GIN (to_tsvector('{SEARCH_CONFIG}', content))"
+            )
+
+        elif connection.vendor == 'sqlite':
+            name = fts_table_name()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [name])
+            if cursor.fetchone():
+                return
+            fts, source = quote(name), quote(name + '_source')
+            # The indexed columns as FTS5 reads them back: the text and a room token
+            cursor.execute(f"CREATE VIEW {source} AS SELECT id, content, 'r' || room_id AS room FROM {table}")
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5(content, room, content={source}, "
+                f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+            )
+            # Keep the index in step with every insert, edit and delete
+            insert = f"INSERT INTO {fts}(rowid, content, room) VALUES (new.id, new.content, 'r' || new.room_id);"
+            delete = (
+                f"INSERT INTO {fts}({fts}, rowid, content, room) "
+                f"VALUES ('delete', old.id, old.content, 'r' || old.room_id);"
+            )
+            cursor.execute(f"CREATE TRIGGER {quote(name + '_ai')} AFTER INSERT ON {table} BEGIN {insert} END")
+            cursor.execute(f"CREATE TRIGGER {quote(name + '_ad')} AFTER DELETE ON {table} BEGIN {delete} END")
+            cursor.execute(
+                f"CREATE TRIGGER {quote(name + '_au')} AFTER UPDATE OF content, room_id ON {table} "
+                f"BEGIN {delete} {insert} END"
+            )
+            # Index the messages that already exist
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def parse_search_args(params):
+    """Read q / room_id / cursor / limit from request parameters"""
+    query = (params.get('q') or '').strip()
+    if not re.search(r'\w', query):
+        raise ValueError('A search query is required')
+
+    after = None
+    if params.get('cursor'):
+        position = decode_cursor(params['cursor'])
+        try:
+            after = (float(position['rank']), int(position['id']))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+
+    room_id = params.get('room_id')
+    if room_id not in (None, ''):
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid room_id')
+    else:
+        room_id = None
+
+    return {
+        'query': query,
+        'room_id': room_id,
+        'after': after,
+        'limit': parse_limit(params.get('limit'), SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE),
+    }
+
+def search_user_messages(user_id, query, room_id=None, after=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Search the messages of every room the user participates in (or of one of them).
+    Returns (results, next_cursor, has_more), after is the (rank, id) of the previous page's last hit.
+    """
+    if connection.vendor == 'postgresql':
+        rows = _search_postgresql(user_id, query, room_id, after, limit + 1)
+    elif connection.vendor == 'sqlite':
+        rows = _search_sqlite(user_id, query, room_id, after, limit + 1)
+    else:
+        rows = _search_fallback(user_id, query, room_id, after, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = [{
+        'message_id': message_id,
+        'room_id': message_room_id,
+        'sender_id': sender_id,
+        'sender_username': sender_username,
+        'timestamp': _to_datetime(timestamp),
+        'rank': rank,
+        'snippet': html.escape(snippet.replace(LT, '<').replace(GT, '>')).replace(
+            MARK_START, '<mark>'
+        ).replace(MARK_END, '</mark>')
+    } for message_id, message_room_id, sender_id, sender_username, timestamp, rank, snippet in rows]
+
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(rank=results[-1]['rank'], id=results[-1]['message_id'])
+    return results, next_cursor, has_more
+
+def _tables():
+    quote = connection.ops.quote_name
+    return (
+        quote(Message._meta.db_table),
+        quote(ChatRoom.participants.through._meta.db_table),
+        quote(User._meta.db_table)
+    )
+
+def _search_postgresql(user_id, query, room_id, after, limit):
+    message_table, participants_table, user_table = _tables()
+    filters, params = '', [user_id, query]
+    if room_id is not None:
+        filters += ' AND m.room_id = %s'
+        params.append(room_id)
+    params += [LT + GT, f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={SNIPPET_WORDS}, MinWords=5, MaxFragments=2']
+    page_filter = ''
+    if after is not None:
+        page_filter = 'WHERE score < %s OR (score = %s AND id < %s)'
+        params += [after[0], after[0], after[1]]
+    params.append(limit)
+
+    # The GIN index finds the matches, only the returned page pays for ts_headline. ts_rank is a
+    # real, read as double precision so the rank of the cursor compares equal to it.
+    sql = f"""
+        WITH hits AS (
+            SELECT m.id, m.room_id, m.sender_id, m.timestamp, m.content, q.query,
+                   ts_rank(to_tsvector('{SEARCH_CONFIG}', m.content), q.query)::double precision AS score
+            FROM {message_table} m
+            JOIN {participants_table} p ON p.chatroom_id = m.room_id AND p.user_id = %s
+            CROSS JOIN websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS q(query)
+            WHERE to_tsvector('{SEARCH_CONFIG}', m.content) @@ q.query{filters}
+        )
+        SELECT h.id, h.room_id, h.sender_id, u.username, h.timestamp, h.score,
+               ts_headline('{SEARCH_CONFIG}', translate(h.content, '<>', %s), h.query, %s)
+        FROM (SELECT * FROM hits {page_filter} ORDER BY score DESC, id DESC LIMIT %s) h
+        JOIN {user_table} u ON u.id = h.sender_id
+        ORDER BY h.score DESC, h.id DESC
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+def _search_sqlite(user_id, query, room_id, after, limit):
+    message_table, participants_table, user_table = _tables()
+    fts = connection.ops.quote_name(fts_table_name())
+
+    room_ids = ChatRoom.participants.through.objects.filter(user_id=user_id).values_list('chatroom_id', flat=True)
+    if room_id is not None:
+        room_ids = room_ids.filter(chatroom_id=room_id)
+    room_ids = list(room_ids)
+    if not room_ids:
+        return []
+
+    # Every word must match in the text of one of the user's rooms. Words are quoted so FTS5
+    # operators typed by the user are taken literally.
+    words = ' '.join('"' + word.replace('"', '""') + '"' for word in re.findall(r'\w+', query))
+    rooms = ' OR '.join(f'r{room}' for room in room_ids)
+    match = f'room : ({rooms}) AND content : ({words})'
+
+    # the room column is only there to filter, it does not count in the relevance
+    score = f'-bm25({fts}, 1.0, 0.0)'
+    filters, params = '', [match]
+    if after is not None:
+        filters += f' AND ({score} < %s OR ({score} = %s AND m.id < %s))'
+        params += [after[0], after[0], after[1]]
+    params.append(limit)
+
+    sql = f"""
+        SELECT m.id, m.room_id, m.sender_id, u.username, m.timestamp, {score} AS score,
+               snippet({fts}, 0, char(2), char(3), '…', {SNIPPET_WORDS})
+        FROM {fts}
+        JOIN {message_table} m ON m.id = {fts}.rowid
+        JOIN {user_table} u ON u.id = m.sender_id
+        WHERE {fts} MATCH %s{filters}
+        ORDER BY score DESC, m.id DESC
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+def _search_fallback(user_id, query, room_id, after, limit):
+    messages = Message.objects.filter(
+        room__participants__id=user_id,
+        content__icontains=query
+    )
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+    if after is not None:
+        messages = messages.filter(id__lt=after[1])
+    rows = messages.order_by('-id').values_list(
+        'id', 'room_id', 'sender_id', 'sender__username', 'timestamp', 'content'
+    )[:limit]
+    return [
+        (message_id, message_room_id, sender_id, username, timestamp, 0.0, content[:200])
+        for message_id, message_room_id, sender_id, username, timestamp, content in rows
+    ]
+
+def _to_datetime(value):
+    # Raw SQLite rows hold what Django stored: naive datetimes in UTC
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value is not None and value.tzinfo is None and settings.USE_TZ:
+        value = value.replace(tzinfo=dt_timezone.utc)
+    return value
@@ -1,63 +1,60 @@
+from django.db import transaction
 from django.utils import timezone
-from ..models import Message, RoomPresence, ChatRoom, User
-
-def update_message_status_to_delivered(message_id):
-    """Update message status to delivered when saved to database"""
-    try:
-        message = Message.objects.get(id=message_id)
-        if message.status == 'Pending':
-            message.status = 'Delivered'
-            message.delivered_at = timezone.now()
-            message.save()
-            return True
-    except Message.DoesNotExist:
-        pass
-    return False
+from ..models import Message, RoomPresence, ChatRoom, InboxEntry
+from .inbox_notifications import notify_user_room_changed
 
 def mark_messages_as_seen(room_id, user_id):
-    """Mark all delivered messages in a room as seen by a specific user"""
-    try:
-        room = ChatRoom.objects.get(id=room_id)
-        user = User.objects.get(id=user_id)
-        
-        # Get all delivered messages in the room that the user hasn't seen
-        messages_to_mark = Message.objects.filter(
-            room=room,
-            status='Delivered'
-        ).exclude(sender=user).exclude(seen_by=user)
-        
-        seen_message_ids = []
-        for message in messages_to_mark:
-            message.status = 'Seen'
-            message.seen_at = timezone.now()
-            message.seen_by.add(user)
-            message.save()
-            seen_message_ids.append(message.id)
-            
-        return seen_message_ids
-    except (ChatRoom.DoesNotExist, User.DoesNotExist):
-        return []
+    """
+    Move the user's read watermark in a room up to the room's latest message.
+    Returns the new watermark, or None if there was nothing new to see.
+    """
+    with transaction.atomic():
+        # Lock the inbox row before reading the room's pointer. A message saved concurrently either
+        # committed before the lock, and the pointer read below includes it, or waits on the lock
+        # to bump unread_count after the reset, so no message ends up unread but not counted.
+        previous_watermark = InboxEntry.objects.select_for_update().filter(
+            user_id=user_id,
+            room_id=room_id
+        ).values_list('last_seen_message_id', flat=True).first()
+        if previous_watermark is None:
+            return None
 
-def update_user_presence(user_id, room_id, is_online=True):
-    """Update user presence in a room"""
-    try:
-        room = ChatRoom.objects.get(id=room_id)
-        user = User.objects.get(id=user_id)
-        
-        presence, created = RoomPresence.objects.get_or_create(
-            user=user,
-            room=room,
-            defaults={'is_online': is_online}
+        # The room keeps a pointer to its newest message, so the watermark costs no scan
+        latest_message_id = ChatRoom.objects.filter(id=room_id).values_list('last_message_id', flat=True).first()
+        if not latest_message_id or previous_watermark >= latest_message_id:
+            return None
+
+        InboxEntry.objects.filter(user_id=user_id, room_id=room_id).update(
+            last_seen_message_id=latest_message_id,
+            unread_count=0
         )
-        
-        if not created:
-            presence.is_online = is_online
-            presence.last_seen = timezone.now()
-            presence.save()
-            
-        return presence
-    except (ChatRoom.DoesNotExist, User.DoesNotExist):
-        return None
+
+        # Keep the per-message status for the messages the watermark just passed over
+        # (a range on the (room, id) index, no per-reader rows)
+        Message.objects.filter(
+            room_id=room_id,
+            id__gt=previous_watermark,
+            id__lte=latest_message_id,
+            status='Delivered'
+        ).exclude(sender_id=user_id).update(status='Seen', seen_at=timezone.now())
+
+        # The user's other devices clear the unread badge
+        notify_user_room_changed(user_id, room_id)
+
+    return latest_message_id
+
+def get_read_watermarks(room_id):
+    """Get {user_id: last seen message id} for every participant of a room"""
+    return dict(InboxEntry.objects.filter(room_id=room_id).values_list('user_id', 'last_seen_message_id'))
+
+async def aget_read_watermarks(room_id):
+    """get_read_watermarks() through the async ORM"""
+    return {
+        user_id: last_seen_message_id
+        async for user_id, last_seen_message_id in InboxEntry.objects.filter(
+            room_id=room_id
+        ).values_list('user_id', 'last_seen_message_id')
+    }
 
 def get_online_users_in_room(room_id):
     """Get list of users currently online in a room"""
@@ -71,3 +68,14 @@ def get_online_users_in_room(room_id):
         return list(online_users)
     except ChatRoom.DoesNotExist:
         return []
+
+async def aget_online_users_in_room(room_id):
+    """get_online_users_in_room() through the async ORM"""
+    if not await ChatRoom.objects.filter(id=room_id).aexists():
+        return []
+    return [
+        username async for username in RoomPresence.objects.filter(
+            room_id=room_id,
+            is_online=True
+        ).values_list('user__username', flat=True)
+    ]
@@ -0,0 +1,59 @@
+from django.db import transaction
+from django.db.models import Q, F, Case, When
+from django.db.models.functions import Now
+from ..models import ChatRoom, Message, InboxEntry
+from .inbox_notifications import notify_room_changed
+
+def create_message(room_id, sender, content):
+    """
+    Save a new message in its final 'Delivered' state and update the denormalized chat list data
+    in the same transaction.
+
+    timestamp and delivered_at are both set by the database in the INSERT and timestamp comes back
+    through RETURNING, so there is no second fetch/save to mark the message delivered.
+    """
+    with transaction.atomic():
+        message = Message.objects.create(
+            room_id=room_id,
+            sender=sender,
+            content=content,
+            status='Delivered',
+            delivered_at=Now()
+        )
+        if not hasattr(message.timestamp, 'isoformat'):
+            # Backends without INSERT ... RETURNING need one read to get the database values
+            message.refresh_from_db(fields=['timestamp'])
+        # Both come from the same statement clock
+        message.delivered_at = message.timestamp
+
+        update_chat_list(room_id, message, {sender.id: 1})
+    return message
+
+def update_chat_list(room_id, last_message, sender_counts):
+    """
+    Record new messages of a room in the denormalized chat list data: the room's last message
+    pointer and every participant's inbox row. sender_counts maps sender id -> new messages sent.
+    Must run in the transaction that inserted the messages.
+    """
+    # Only move the pointer forward, a slower concurrent writer must not overwrite a newer message
+    ChatRoom.objects.filter(
+        Q(last_message__isnull=True) | Q(last_message_id__lt=last_message.id),
+        id=room_id
+    ).update(
+        last_message=last_message,
+        last_message_at=last_message.timestamp
+    )
+
+    # One statement bumps everyone's unread count by the messages they did not send themselves
+    total = sum(sender_counts.values())
+    InboxEntry.objects.filter(room_id=room_id).update(
+        unread_count=Case(
+            *[When(user_id=sender_id, then=F('unread_count') + (total - count))
+              for sender_id, count in sender_counts.items()],
+            default=F('unread_count') + total
+        ),
+        last_activity_at=last_message.timestamp
+    )
+
+    # Push the new state to the participants' chat lists once this commits
+    notify_room_changed(room_id)
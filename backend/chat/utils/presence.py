@@ -0,0 +1,241 @@
+"""
+Ephemeral room presence.
+
+Who is online in a room lives in a TTL store instead of RoomPresence rows: every open socket is an
+entry that expires TTL seconds after its last heartbeat frame, so a stalled client goes offline even
+while its connection stays open, and when a worker crashes its entries simply expire. The worker
+re-writes the entries of its sockets from their last heartbeat on every tick, which restores them
+if the store lost them without extending them. RoomPresence.last_seen / is_online are written to the database in batches every
+PERSIST_INTERVAL seconds.
+
+The "memory" store only sees the sockets of its own process (single node), the "redis" store is
+shared by every worker (multi-node).
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DataError, IntegrityError
+from django.utils import timezone
+from ..models import RoomPresence
+from .message_status import aget_online_users_in_room
+
+logger = logging.getLogger(__name__)
+
+def _member(user_id, username, channel_name):
+    # Usernames can't contain "|" so the member string splits back unambiguously
+    return f'{user_id}|{username}|{channel_name}'
+
+def _parse_member(member):
+    user_id, username, channel_name = member.split('|', 2)
+    return int(user_id), username, channel_name
+
+class InMemoryPresenceStore:
+    """Presence entries of this process only"""
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def refresh(self, room_id, members, expires_at):
+        room = self.rooms.setdefault(room_id, {})
+        for member in members:
+            room[member] = expires_at
+
+    async def remove(self, room_id, member):
+        room = self.rooms.get(room_id, {})
+        removed = room.pop(member, None) is not None
+        if not room:
+            self.rooms.pop(room_id, None)
+        return removed
+
+    async def members(self, room_id, now):
+        return [member for member, expires_at in self.rooms.get(room_id, {}).items() if expires_at > now]
+
+    async def pop_expired(self, now):
+        expired = []
+        for room_id, room in list(self.rooms.items()):
+            for member, expires_at in list(room.items()):
+                if expires_at <= now:
+                    del room[member]
+                    expired.append((room_id, member, expires_at))
+            if not room:
+                del self.rooms[room_id]
+        return expired
+
+class RedisPresenceStore:
+    """Presence entries shared by all workers: one sorted set per room scored by expiry time"""
+
+    def __init__(self, url, prefix='presence'):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.rooms_key = f'{prefix}:rooms'
+
+    def room_key(self, room_id):
+        return f'{self.prefix}:room:{room_id}'
+
+    async def refresh(self, room_id, members, expires_at):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.room_key(room_id), {member: expires_at for member in members})
+        pipe.sadd(self.rooms_key, room_id)
+        await pipe.execute()
+
+    async def remove(self, room_id, member):
+        return bool(await self.redis.zrem(self.room_key(room_id), member))
+
+    async def members(self, room_id, now):
+        return await self.redis.zrangebyscore(self.room_key(room_id), f'({now}', '+inf')
+
+    async def pop_expired(self, now):
+        expired = []
+        for room_id in await self.redis.smembers(self.rooms_key):
+            key = self.room_key(room_id)
+            for member, expires_at in await self.redis.zrangebyscore(key, '-inf', now, withscores=True):
+                # ZREM tells which worker claimed the entry, so each expiry is handled once
+                if await self.redis.zrem(key, member):
+                    expired.append((int(room_id), member, expires_at))
+            if not await self.redis.zcard(key):
+                await self.redis.srem(self.rooms_key, room_id)
+        return expired
+
+async def apersist_presence(changes):
+    """Write {(user_id, room_id): (is_online, last_seen)} to RoomPresence in one upsert, through the async ORM"""
+    await RoomPresence.objects.abulk_create(
+        [
+            RoomPresence(user_id=user_id, room_id=room_id, is_online=is_online, last_seen=last_seen)
+            for (user_id, room_id), (is_online, last_seen) in changes.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['user', 'room'],
+        update_fields=['is_online', 'last_seen']
+    )
+
+class PresenceTracker:
+    """Presence API used by the consumers, plus the periodic refresh / expiry / persistence loop"""
+
+    def __init__(self, store, ttl, persist_interval):
+        self.store = store
+        self.ttl = ttl
+        self.persist_interval = persist_interval
+        # sockets held by this process: room_id -> {member: time of its last heartbeat}
+        self.local = {}
+        # (user_id, room_id) -> (is_online, last_seen) waiting to be written to the database
+        self.dirty = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def join(self, room_id, user_id, username, channel_name):
+        self.start()
+        member = _member(user_id, username, channel_name)
+        now = time.time()
+        self.local.setdefault(room_id, {})[member] = now
+        await self.store.refresh(room_id, [member], now + self.ttl)
+        self.dirty[(user_id, room_id)] = (True, timezone.now())
+
+    async def heartbeat(self, room_id, user_id, username, channel_name):
+        member = _member(user_id, username, channel_name)
+        now = time.time()
+        room = self.local.get(room_id)
+        if room is not None and member in room:
+            if room[member] + self.ttl <= now:
+                # Expired since, the tick already marked the user offline
+                self.dirty[(user_id, room_id)] = (True, timezone.now())
+            room[member] = now
+        await self.store.refresh(room_id, [member], now + self.ttl)
+
+    async def leave(self, room_id, user_id, username, channel_name):
+        member = _member(user_id, username, channel_name)
+        self.local.get(room_id, {}).pop(member, None)
+        if not self.local.get(room_id):
+            self.local.pop(room_id, None)
+        await self.store.remove(room_id, member)
+        # Another tab of the same user keeps them online
+        self.dirty[(user_id, room_id)] = (user_id in await self.online_user_ids(room_id), timezone.now())
+
+    async def online_users(self, room_id):
+        """Usernames online in a room, each listed once however many sockets they have open"""
+        usernames = {_parse_member(member)[1] for member in await self.store.members(room_id, time.time())}
+        return sorted(usernames)
+
+    async def online_user_ids(self, room_id):
+        return {_parse_member(member)[0] for member in await self.store.members(room_id, time.time())}
+
+    async def tick(self):
+        """Refresh local sockets, expire stale entries and persist the changes"""
+        now = time.time()
+        for room_id, members in list(self.local.items()):
+            # Only sockets that sent a heartbeat within the TTL, at the expiry their heartbeat gave them
+            for member, last_heartbeat in members.items():
+                if last_heartbeat + self.ttl > now:
+                    await self.store.refresh(room_id, [member], last_heartbeat + self.ttl)
+
+        for room_id, member, expired_at in await self.store.pop_expired(time.time()):
+            user_id = _parse_member(member)[0]
+            if user_id not in await self.online_user_ids(room_id):
+                last_seen = datetime.fromtimestamp(expired_at - self.ttl, tz=dt_timezone.utc)
+                self.dirty[(user_id, room_id)] = (False, last_seen)
+
+        if self.dirty:
+            changes, self.dirty = self.dirty, {}
+            try:
+                await apersist_presence(changes)
+            except (DataError, IntegrityError):
+                # e.g. a room or user was deleted, write the rows one by one to drop the failing ones
+                await self.persist_one_by_one(changes)
+            except Exception:
+                logger.exception("Failed to persist presence of %d users", len(changes))
+                self.keep_dirty(changes)
+
+    async def persist_one_by_one(self, changes):
+        for position, (key, change) in enumerate(changes.items()):
+            try:
+                await apersist_presence({key: change})
+            except (DataError, IntegrityError):
+                logger.warning("Dropping presence of user %s in room %s, it can't be written", *key, exc_info=True)
+            except Exception:
+                logger.exception("Failed to persist presence of %d users", len(changes) - position)
+                self.keep_dirty(dict(list(changes.items())[position:]))
+                return
+
+    def keep_dirty(self, changes):
+        # Keep them for the next tick unless newer changes arrived meanwhile
+        self.dirty = {**changes, **self.dirty}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(min(self.persist_interval, self.ttl / 3))
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Presence tick failed")
+
+_tracker = None
+
+def get_presence_tracker():
+    """The process-wide presence tracker configured by settings.CHAT_PRESENCE"""
+    global _tracker
+    if _tracker is None:
+        config = getattr(settings, 'CHAT_PRESENCE', {})
+        if config.get('BACKEND', 'memory') == 'redis':
+            store = RedisPresenceStore(config['REDIS_URL'])
+        else:
+            store = InMemoryPresenceStore()
+        _tracker = PresenceTracker(store, config.get('TTL', 60), config.get('PERSIST_INTERVAL', 30))
+    return _tracker
+
+async def get_room_roster(room_id):
+    """
+    Usernames online in a room, from the presence store. Falls back to the last persisted
+    RoomPresence rows if the store can't be reached.
+    """
+    try:
+        return await get_presence_tracker().online_users(room_id)
+    except Exception:
+        logger.exception("Presence store unavailable, reading the roster from the database")
+        return await aget_online_users_in_room(room_id)
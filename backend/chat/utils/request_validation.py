@@ -0,0 +1,78 @@
+"""
+Request validation shared by the sync views and their async variants, so both answer the same
+errors. Every check raises RequestError with the message and status code of the response.
+"""
+import json
+
+class RequestError(Exception):
+    """A request the API rejects, answered with {'error': message} and status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def read_json(request):
+    """The JSON body of the request"""
+    try:
+        return json.loads(request.body)
+    except json.JSONDecodeError:
+        raise RequestError('Invalid JSON')
+
+def required(data, name, message):
+    """A field of the body that must be set"""
+    value = data.get(name)
+    if not value:
+        raise RequestError(message)
+    return value
+
+def parse_start_chat(data):
+    return required(data, 'user_id', 'User ID is required')
+
+def check_start_chat(user, other_user):
+    if user.id == other_user.id:
+        raise RequestError('Cannot start chat with yourself')
+
+def parse_send_message(data):
+    """(room_id, content) of a new message"""
+    room_id, content = data.get('room_id'), data.get('message')
+    if not room_id or not content:
+        raise RequestError('Room ID and message are required')
+    return room_id, content.strip()
+
+def parse_friend_id(data):
+    return required(data, 'friend_id', 'Friend ID is required')
+
+def parse_friendship_id(data):
+    return required(data, 'friendship_id', 'Friendship ID is required')
+
+def check_friend_request(user, friend, existing_friendship):
+    """Whether user may send a friend request to friend, given their friendship if they have one"""
+    if user.id == friend.id:
+        raise RequestError('Cannot add your self as a friend')
+    if existing_friendship:
+        status = existing_friendship.status.lower()
+        if status == 'accepted':
+            raise RequestError('Already friends')
+        elif status == 'pending':
+            raise RequestError('Friend request already sent')
+        elif status == 'blocked':
+            raise RequestError('Cannot send friend request')
+
+def toggle_block(friendship):
+    """Block an accepted friendship or unblock a blocked one, returns the response message"""
+    if friendship.status == 'accepted':
+        friendship.status = 'Blocked'
+        return 'Friend blocked successfully'
+    elif friendship.status == 'Blocked':
+        friendship.status = 'accepted'
+        return 'Friend unblocked successfully'
+    raise RequestError('Invalid friendship status', status=404)
+
+def user_data(user):
+    """A user as the friend endpoints return them"""
+    return {'id': user.id, 'name': user.username, 'email': user.email}
+
+def other_user(friendship, user):
+    """The user of the friendship that is not user"""
+    return friendship.addressee if friendship.requester_id == user.id else friendship.requester
@@ -0,0 +1,112 @@
+"""
+Server-side coalescing of typing indicators.
+
+Clients may send a `typing` frame on every keystroke. Each connection runs a TypingState that only
+reports edges (started / stopped typing), swallows stop-start flicker shorter than the debounce
+window and stops automatically when frames stop coming. The edges of every connection in a room
+are then merged by a RoomTypingAggregator into at most one channel-layer event per interval.
+"""
+import asyncio
+from collections import Counter
+
+# Seconds a stop is held back, a new start within it cancels both
+TYPING_DEBOUNCE = 1.0
+# Seconds without any typing frame after which the user is considered stopped
+TYPING_TIMEOUT = 5.0
+# Seconds between two typing events of the same room
+TYPING_INTERVAL = 0.5
+
+# Process-wide counters: frames received from sockets, edges detected, events sent to the channel layer
+typing_stats = Counter()
+
+class TypingState:
+    """Typing state machine of one connection, calls on_change(is_typing) on edges only"""
+
+    def __init__(self, on_change, debounce=TYPING_DEBOUNCE, timeout=TYPING_TIMEOUT):
+        self.on_change = on_change
+        self.debounce = debounce
+        self.timeout = timeout
+        self.is_typing = False
+        self.timer = None
+
+    def update(self, is_typing):
+        typing_stats['frames'] += 1
+        self._cancel_timer()
+        loop = asyncio.get_running_loop()
+
+        if is_typing:
+            # Automatic stop if the client goes quiet without saying so
+            self.timer = loop.call_later(self.timeout, self.stop)
+            if not self.is_typing:
+                self._set(True)
+        elif self.is_typing:
+            self.timer = loop.call_later(self.debounce, self.stop)
+
+    def stop(self):
+        """Stop right away, e.g. when the message is sent or the socket closes"""
+        self._cancel_timer()
+        if self.is_typing:
+            self._set(False)
+
+    def _set(self, is_typing):
+        self.is_typing = is_typing
+        typing_stats['edges'] += 1
+        self.on_change(is_typing)
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+class RoomTypingAggregator:
+    """
+    Merges the typing edges of a room and hands the changes to send() at most once per interval.
+    A user is typing while any of their sockets is, and a flush only reports the users whose state
+    differs from what the room was last told, so a start and stop within one interval that were
+    never reported send nothing.
+    """
+
+    def __init__(self, send, interval=TYPING_INTERVAL, key=None):
+        self.send = send
+        self.key = key
+        self.interval = interval
+        # username -> number of sockets of this process the user is typing on
+        self.typing = Counter()
+        # usernames the room was last told are typing
+        self.reported = set()
+        self.timer = None
+
+    def add(self, username, is_typing):
+        if is_typing:
+            self.typing[username] += 1
+        elif self.typing[username] > 1:
+            self.typing[username] -= 1
+        else:
+            self.typing.pop(username, None)
+
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.interval, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def flush(self):
+        self.timer = None
+        typing = set(self.typing)
+        started, stopped = sorted(typing - self.reported), sorted(self.reported - typing)
+        self.reported = typing
+        # Idle aggregators are dropped once nobody types, the next edge of the room creates a new one
+        if not typing and _aggregators.get(self.key) is self:
+            del _aggregators[self.key]
+        if not started and not stopped:
+            return
+        typing_stats['events'] += 1
+        await self.send({'type': 'typing', 'started': started, 'stopped': stopped})
+
+_aggregators = {}
+
+def get_room_typing_aggregator(room_group_name, send):
+    """The aggregator of a room in this process, created on first use, send(frame) is awaited on flush"""
+    aggregator = _aggregators.get(room_group_name)
+    if aggregator is None:
+        aggregator = _aggregators[room_group_name] = RoomTypingAggregator(send, key=room_group_name)
+    return aggregator
@@ -0,0 +1,160 @@
+"""
+Username search for adding friends.
+
+Users whose username starts with the query come first, then the ones that contain it elsewhere,
+each group in username order, paginated with a (phase, username) keyset cursor. PostgreSQL serves
+the prefix phase from a text_pattern_ops index and the contains phase from a pg_trgm GIN index,
+both on UPPER(username) as Django's case-insensitive lookups compare it. SQLite (local/dev) gets a
+NOCASE index for the prefix phase, the contains phase stays a scan there. This app has no migration
+files, so the indexes are created by create_user_search_index() after migrate (see signals.py).
+"""
+from django.db.models import Q
+from ..models import User, Friendship
+from .pagination import encode_cursor, decode_cursor, parse_limit
+
+USER_SEARCH_PAGE_SIZE = 20
+MAX_USER_SEARCH_PAGE_SIZE = 50
+PREFIX, CONTAINS = 'prefix', 'contains'
+PG_PREFIX_INDEX_NAME = 'user_username_prefix_idx'
+PG_TRIGRAM_INDEX_NAME = 'user_username_trgm_idx'
+SQLITE_INDEX_NAME = 'user_username_nocase_idx'
+# Friends first inside a page, like the unpaginated search used to sort the whole list
+STATUS_ORDER = {'accepted': 0, 'pending': 1, 'blocked': 2}
+
+def create_user_search_index(connection):
+    """Create the username search indexes for the connection's database, if missing"""
+    quote = connection.ops.quote_name
+    table = quote(User._meta.db_table)
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(PG_PREFIX_INDEX_NAME)} ON {table} "
+                f"(UPPER(username::text) text_pattern_ops)"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(PG_TRIGRAM_INDEX_NAME)} ON {table} "
+                f"USING GIN (UPPER(username::text) gin_trgm_ops)"
+            )
+
+        elif connection.vendor == 'sqlite':
+            # LIKE is case-insensitive in SQLite, it can only range-scan an index with the same collation
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {quote(SQLITE_INDEX_NAME)} ON {table} (username COLLATE NOCASE)"
+            )
+
+def parse_user_search_args(data):
+    """Read name / cursor / limit from the request body"""
+    query = (data.get('name') or '').strip()
+    if not query:
+        raise ValueError('Name is required!')
+
+    after = None
+    if data.get('cursor'):
+        position = decode_cursor(data['cursor'])
+        if position.get('phase') not in (PREFIX, CONTAINS) or not isinstance(position.get('username'), str):
+            raise ValueError('Invalid cursor')
+        after = (position['phase'], position['username'])
+
+    return {
+        'query': query,
+        'after': after,
+        'limit': parse_limit(data.get('limit'), USER_SEARCH_PAGE_SIZE, MAX_USER_SEARCH_PAGE_SIZE),
+    }
+
+def search_users(user_id, query, after=None, limit=USER_SEARCH_PAGE_SIZE):
+    """
+    Search other users by username, with the caller's friendship status with each of them.
+    Returns (results, next_cursor, has_more), after is the (phase, username) of the previous page's last user.
+    """
+    phase, last_username = after or (PREFIX, None)
+    found = []
+
+    if phase == PREFIX:
+        found += [(PREFIX, id, username) for id, username in _prefix_matches(user_id, query, last_username, limit)]
+        last_username = None
+
+    if len(found) <= limit:
+        found += [
+            (CONTAINS, id, username)
+            for id, username in _contains_matches(user_id, query, last_username, limit + 1 - len(found))
+        ]
+
+    statuses = get_friendship_statuses(user_id, [id for _, id, _ in found[:limit]])
+    return _search_results(found, statuses, limit)
+
+async def asearch_users(user_id, query, after=None, limit=USER_SEARCH_PAGE_SIZE):
+    """search_users() through the async ORM"""
+    phase, last_username = after or (PREFIX, None)
+    found = []
+
+    if phase == PREFIX:
+        found += [
+            (PREFIX, id, username) async for id, username in _prefix_matches(user_id, query, last_username, limit)
+        ]
+        last_username = None
+
+    if len(found) <= limit:
+        found += [
+            (CONTAINS, id, username)
+            async for id, username in _contains_matches(user_id, query, last_username, limit + 1 - len(found))
+        ]
+
+    statuses = await aget_friendship_statuses(user_id, [id for _, id, _ in found[:limit]])
+    return _search_results(found, statuses, limit)
+
+def _prefix_matches(user_id, query, last_username, count):
+    matches = User.objects.exclude(id=user_id).filter(username__istartswith=query)
+    if last_username is not None:
+        matches = matches.filter(username__gt=last_username)
+    return matches.order_by('username').values_list('id', 'username')[:count + 1]
+
+def _contains_matches(user_id, query, last_username, count):
+    # The users that contain the query past its start fill the page
+    matches = User.objects.exclude(id=user_id).filter(
+        username__icontains=query
+    ).exclude(username__istartswith=query)
+    if last_username is not None:
+        matches = matches.filter(username__gt=last_username)
+    return matches.order_by('username').values_list('id', 'username')[:count]
+
+def _search_results(found, statuses, limit):
+    has_more = len(found) > limit
+    found = found[:limit]
+
+    results = [
+        {'id': id, 'name': username, 'friendship_status': statuses.get(id, 'none')}
+        for _, id, username in found
+    ]
+    results.sort(key=lambda result: STATUS_ORDER.get(result['friendship_status'].lower(), len(STATUS_ORDER)))
+
+    next_cursor = None
+    if has_more:
+        phase, _, username = found[-1]
+        next_cursor = encode_cursor(phase=phase, username=username)
+    return results, next_cursor, has_more
+
+def get_friendship_statuses(user_id, other_ids):
+    """Status of the friendship between the user and each of other_ids that has one, in one query"""
+    if not other_ids:
+        return {}
+    return {
+        addressee_id if requester_id == user_id else requester_id: status
+        for requester_id, addressee_id, status in _friendship_status_rows(user_id, other_ids)
+    }
+
+async def aget_friendship_statuses(user_id, other_ids):
+    """get_friendship_statuses() through the async ORM"""
+    if not other_ids:
+        return {}
+    return {
+        addressee_id if requester_id == user_id else requester_id: status
+        async for requester_id, addressee_id, status in _friendship_status_rows(user_id, other_ids)
+    }
+
+def _friendship_status_rows(user_id, other_ids):
+    return Friendship.objects.filter(
+        Q(requester_id=user_id, addressee_id__in=other_ids) |
+        Q(addressee_id=user_id, requester_id__in=other_ids)
+    ).values_list('requester_id', 'addressee_id', 'status')
@@ -0,0 +1,190 @@
+"""
+In-process prefix index of usernames for the add-friend autocomplete.
+
+Every username is held in a list sorted case-insensitively, next to an array of the user ids, so
+a prefix query is a bisect plus a short forward scan and never touches the database. The index is
+built in a background thread on the first autocomplete request of a process (queries go to the
+database until it is ready, Django discourages queries at startup), kept in step with the users
+created, renamed and deleted in this process by the User signals, and rebuilt every MAX_AGE
+seconds to pick up the changes made by other workers. When there are more than MAX_USERS users the
+index is not built at all and autocomplete keeps using the database.
+"""
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection, transaction
+from ..models import User
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_SIZE = 10
+MAX_AUTOCOMPLETE_SIZE = 20
+
+def _key(username):
+    return username.lower()
+
+class UsernameIndex:
+    """Usernames sorted by _key and the id of each, in two parallel arrays"""
+
+    def __init__(self, max_users, max_age):
+        self.max_users = max_users
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.usernames = []
+        self.ids = array('q')
+        self.built_at = None
+        self.building = False
+        self.too_large = False
+        # changes seen while a build is loading, replayed on the new arrays
+        self.pending = []
+
+    @property
+    def ready(self):
+        return self.built_at is not None and not self.too_large
+
+    def ensure_fresh(self):
+        """Start a background build if the index was never built or is older than max_age"""
+        with self.lock:
+            if self.building or (self.built_at is not None and time.monotonic() - self.built_at < self.max_age):
+                return
+            self.building = True
+        thread = threading.Thread(target=self._run_build, daemon=True)
+        thread.start()
+
+    def _run_build(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Failed to build the username index")
+            with self.lock:
+                self.building = False
+        finally:
+            # The build thread has its own database connection
+            connection.close()
+
+    def build(self):
+        """Load every username, returns False when there are more users than the index may hold"""
+        with self.lock:
+            self.building = True
+            self.pending = []
+
+        if User.objects.count() > self.max_users:
+            with self.lock:
+                self.usernames, self.ids = [], array('q')
+                self.too_large, self.building, self.built_at = True, False, time.monotonic()
+            return False
+
+        rows = sorted(
+            User.objects.order_by().values_list('username', 'id').iterator(chunk_size=10000),
+            key=lambda row: _key(row[0])
+        )
+        usernames = [username for username, _ in rows]
+        ids = array('q', [user_id for _, user_id in rows])
+        del rows
+
+        with self.lock:
+            self.usernames, self.ids = usernames, ids
+            for change in self.pending:
+                self._apply(*change)
+            self.pending = []
+            self.too_large, self.building, self.built_at = False, False, time.monotonic()
+        return True
+
+    def put(self, user_id, username, created=False):
+        """Add a user, or move them if their username changed"""
+        with self.lock:
+            if not self.too_large:
+                self._apply(user_id, username, created)
+            if self.building:
+                self.pending.append((user_id, username, False))
+
+    def remove(self, user_id):
+        with self.lock:
+            if not self.too_large:
+                self._apply(user_id, None, False)
+            if self.building:
+                self.pending.append((user_id, None, False))
+
+    def _apply(self, user_id, username, created):
+        if username is not None:
+            position = bisect_left(self.usernames, _key(username), key=_key)
+            # Most saves don't touch the username, they are found in place
+            while position < len(self.usernames) and _key(self.usernames[position]) == _key(username):
+                if self.ids[position] == user_id and self.usernames[position] == username:
+                    return
+                position += 1
+        if not created:
+            # A renamed or deleted user: a linear search of the ids, which are not sorted
+            try:
+                old = self.ids.index(user_id)
+            except ValueError:
+                pass
+            else:
+                del self.usernames[old]
+                del self.ids[old]
+        if username is not None:
+            position = bisect_left(self.usernames, _key(username), key=_key)
+            self.usernames.insert(position, username)
+            self.ids.insert(position, user_id)
+
+    def search(self, prefix, limit=AUTOCOMPLETE_SIZE, exclude_id=None):
+        """The first limit users whose username starts with prefix, case-insensitively, in index order"""
+        key = _key(prefix)
+        results = []
+        with self.lock:
+            usernames, ids = self.usernames, self.ids
+            position = bisect_left(usernames, key, key=_key)
+            while position < len(usernames) and len(results) < limit:
+                username = usernames[position]
+                if not _key(username).startswith(key):
+                    break
+                if ids[position] != exclude_id:
+                    results.append({'id': ids[position], 'name': username})
+                position += 1
+        return results
+
+_index = None
+
+def get_username_index():
+    """The process-wide index configured by settings.CHAT_USERNAME_INDEX"""
+    global _index
+    if _index is None:
+        config = getattr(settings, 'CHAT_USERNAME_INDEX', {})
+        _index = UsernameIndex(config.get('MAX_USERS', 2_000_000), config.get('MAX_AGE', 600))
+    return _index
+
+def autocomplete_usernames(user_id, prefix, limit=AUTOCOMPLETE_SIZE):
+    """Users whose username starts with prefix, other than user_id, from the index once it is built"""
+    index = get_username_index()
+    index.ensure_fresh()
+    if index.ready:
+        return index.search(prefix, limit, exclude_id=user_id)
+
+    return [{'id': id, 'name': username} for id, username in _database_matches(user_id, prefix, limit)]
+
+async def aautocomplete_usernames(user_id, prefix, limit=AUTOCOMPLETE_SIZE):
+    """autocomplete_usernames() with the database fallback through the async ORM"""
+    index = get_username_index()
+    index.ensure_fresh()
+    if index.ready:
+        return index.search(prefix, limit, exclude_id=user_id)
+
+    return [{'id': id, 'name': username} async for id, username in _database_matches(user_id, prefix, limit)]
+
+def _database_matches(user_id, prefix, limit):
+    users = User.objects.filter(username__istartswith=prefix).exclude(id=user_id)
+    return users.order_by('username').values_list('id', 'username')[:limit]
+
+def notify_username_saved(user_id, username, created):
+    """Update this process's index once the transaction commits, if it serves autocomplete"""
+    if _index is not None:
+        transaction.on_commit(lambda: _index.put(user_id, username, created))
+
+def notify_user_deleted(user_id):
+    """Drop a deleted user from this process's index once the transaction commits"""
+    if _index is not None:
+        transaction.on_commit(lambda: _index.remove(user_id))
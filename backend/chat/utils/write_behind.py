@@ -0,0 +1,213 @@
+"""
+Write-behind batching of inbound chat messages.
+
+With settings.CHAT_WRITE_BEHIND['ENABLED'] the consumer does not wait for the INSERT: the message
+gets a server-assigned uid and timestamp, is acknowledged and broadcast right away, and is inserted
+with bulk_create together with the other messages received in the same window. The acknowledgement
+and the broadcast carry the uid only: once the batch is committed every room of the batch gets a
+"messages_stored" frame mapping the uids of its messages to their database ids.
+
+Durability guarantees:
+- A batch is flushed when it reaches BATCH_SIZE messages or FLUSH_INTERVAL seconds after its first
+  message, whichever comes first. Only messages acknowledged inside that window are at risk.
+- A worker restart loses the messages still in its buffer unless they can be written on the way
+  out: on a clean stop (SIGTERM, deploy) the buffer is flushed when the process exits, if that
+  flush fails, or the process is killed or crashes, the buffered messages are lost. Nothing else
+  is: every flushed batch is committed in a single transaction together with the chat list data.
+- If a flush fails the batch is retried message by message. A message that fails on its own with a
+  data error (e.g. its room or sender was deleted) is logged to the "chat.utils.write_behind.dead_letter"
+  logger and dropped, so it can't hold up the messages behind it. Any other error (database down,
+  deadlock...) puts the remaining messages back at the front of the buffer to be retried, keeping
+  the original order.
+- At most MAX_PENDING messages are buffered, new messages are refused while the buffer is full
+  (the sender gets an error instead of an acknowledgement).
+- Retrying is idempotent: rows are matched by uid, so a batch that was committed but reported as
+  failed (e.g. the connection dropped after COMMIT) is not inserted or counted as unread twice.
+"""
+import asyncio
+import atexit
+import logging
+from collections import Counter, defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction, DataError, IntegrityError
+from django.utils import timezone
+from ..models import Message
+from ..protocol import frame_event
+from .channel_groups import get_room_group_name
+from .message_store import update_chat_list
+
+logger = logging.getLogger(__name__)
+dead_letter_logger = logging.getLogger(__name__ + '.dead_letter')
+
+# Errors a message gets on its own however often it is retried
+PERMANENT_ERRORS = (DataError, IntegrityError)
+
+def flush_messages(messages):
+    """
+    Insert a batch of buffered messages and update the chat list data, safe to retry. Every
+    message of the batch gets its database id, including the ones an earlier attempt stored.
+    """
+    with transaction.atomic():
+        uids = [message.uid for message in messages]
+        stored = dict(Message.objects.filter(uid__in=uids).values_list('uid', 'id'))
+        for message in messages:
+            message.id = stored.get(message.uid)
+        new_messages = [message for message in messages if message.uid not in stored]
+        if not new_messages:
+            return 0
+
+        Message.objects.bulk_create(new_messages, ignore_conflicts=True)
+        # ignore_conflicts does not hand back primary keys on every backend
+        ids = dict(Message.objects.filter(uid__in=[message.uid for message in new_messages]).values_list('uid', 'id'))
+        for message in new_messages:
+            message.id = ids[message.uid]
+
+        by_room = defaultdict(list)
+        for message in new_messages:
+            by_room[message.room_id].append(message)
+        for room_id, room_messages in by_room.items():
+            update_chat_list(
+                room_id,
+                max(room_messages, key=lambda message: message.id),
+                Counter(message.sender_id for message in room_messages)
+            )
+    return len(new_messages)
+
+class MessageWriteBehind:
+    """Per-process buffer of messages waiting to be inserted"""
+
+    def __init__(self, batch_size, flush_interval, max_pending=10000, flush_function=flush_messages,
+                 channel_layer=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.sync_flush_function = flush_function
+        self.flush_function = database_sync_to_async(flush_function)
+        self.channel_layer = channel_layer
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.timer = None
+
+    def submit(self, room_id, sender_id, content):
+        """
+        Buffer a message and return it with its uid and timestamp, it has no database id yet.
+        Returns None if the buffer is full.
+        """
+        if len(self.pending) >= self.max_pending:
+            logger.warning("Write-behind buffer full (%d messages), refusing a message", len(self.pending))
+            return None
+
+        now = timezone.now()
+        message = Message(
+            room_id=room_id,
+            sender_id=sender_id,
+            content=content,
+            timestamp=now,
+            status='Delivered',
+            delivered_at=now
+        )
+        self.pending.append(message)
+
+        if len(self.pending) >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+            )
+        return message
+
+    async def flush(self):
+        """Insert everything buffered so far, one batch at a time, returns how many rows were inserted"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        inserted = 0
+        async with self.lock:
+            while self.pending:
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                try:
+                    inserted += await self.flush_function(batch)
+                except Exception:
+                    logger.exception("Failed to flush %d chat messages, retrying them one by one", len(batch))
+                else:
+                    await self.announce(batch)
+                    continue
+
+                for position, message in enumerate(batch):
+                    try:
+                        inserted += await self.flush_function([message])
+                        await self.announce([message])
+                    except PERMANENT_ERRORS:
+                        _dead_letter(message)
+                    except Exception:
+                        logger.exception("Failed to flush chat messages, retrying")
+                        # Put the rest back in front, newer messages stay behind it
+                        self.pending[:0] = batch[position:]
+                        self.timer = asyncio.get_running_loop().call_later(
+                            self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+                        )
+                        return inserted
+        return inserted
+
+    async def announce(self, messages):
+        """Tell the rooms of committed messages the database ids of their uids"""
+        channel_layer = self.channel_layer or get_channel_layer()
+        by_room = defaultdict(dict)
+        for message in messages:
+            by_room[message.room_id][str(message.uid)] = message.id
+        for room_id, message_ids in by_room.items():
+            try:
+                await channel_layer.group_send(get_room_group_name(room_id), frame_event('messages_stored', {
+                    'type': 'messages_stored',
+                    'room_id': room_id,
+                    'message_ids': message_ids
+                }))
+            except Exception:
+                # The messages are stored, clients still know them by uid
+                logger.exception("Failed to send the stored message ids of room %s", room_id)
+
+    def flush_on_exit(self):
+        """Insert what is still buffered when the process stops, the event loop is gone by then"""
+        if not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        try:
+            for start in range(0, len(messages), self.batch_size):
+                batch = messages[start:start + self.batch_size]
+                try:
+                    self.sync_flush_function(batch)
+                except PERMANENT_ERRORS:
+                    for message in batch:
+                        try:
+                            self.sync_flush_function([message])
+                        except PERMANENT_ERRORS:
+                            _dead_letter(message)
+        except Exception:
+            logger.exception("Failed to flush the write-behind buffer on exit, %d messages lost", len(messages) - start)
+
+def _dead_letter(message):
+    dead_letter_logger.error(
+        "Dropping chat message %s from user %s in room %s sent at %s: %r",
+        message.uid, message.sender_id, message.room_id, message.timestamp.isoformat(), message.content,
+        exc_info=True
+    )
+
+_write_behind = None
+
+def get_write_behind():
+    """The process-wide write-behind buffer, or None when the mode is disabled"""
+    global _write_behind
+    config = getattr(settings, 'CHAT_WRITE_BEHIND', {})
+    if not config.get('ENABLED'):
+        return None
+    if _write_behind is None:
+        _write_behind = MessageWriteBehind(
+            config.get('BATCH_SIZE', 200), config.get('FLUSH_INTERVAL', 0.05), config.get('MAX_PENDING', 10000)
+        )
+        atexit.register(_write_behind.flush_on_exit)
+    return _write_behind
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -229,8 +229,103 @@ SOCIALACCOUNT_PROVIDERS = {
     }
 }
 
-CHANNEL_LAYERS = {
+# Channel layer used by the chat consumers.
+# "memory" only reaches sockets inside the same process, so it is limited to one ASGI worker.
+# "redis" shares groups between every worker; each host in CHANNEL_REDIS_HOSTS is a shard and
+# channels/groups are spread over them by consistent hashing (any Redis-protocol server works,
+# e.g. a local stand-in for development).
+CHANNEL_LAYER_BACKEND = config('CHANNEL_LAYER_BACKEND', default='memory')
+
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": config('CHANNEL_REDIS_HOSTS', default='redis://127.0.0.1:6379/0', cast=Csv()),
+                "prefix": config('CHANNEL_REDIS_PREFIX', default='imhotep'),
+                # max queued messages per channel before sends to it are dropped
+                "capacity": config('CHANNEL_LAYER_CAPACITY', default=1000, cast=int),
+                # seconds an undelivered message is kept
+                "expiry": config('CHANNEL_LAYER_EXPIRY', default=60, cast=int),
+                # seconds a channel stays in a group without being re-added
+                "group_expiry": config('CHANNEL_LAYER_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": config('CHANNEL_LAYER_CAPACITY', default=1000, cast=int),
+                "expiry": config('CHANNEL_LAYER_EXPIRY', default=60, cast=int),
+                "group_expiry": config('CHANNEL_LAYER_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+
+# Friend id sets of Friendship.are_friends / get_friends, see chat/utils/friend_graph.py. They are
+# only cached with "redis", shared by every worker so a block or removal is seen by all of them at
+# once; with "none" every check queries the database. Sets expire TTL seconds after they are read.
+CHAT_FRIEND_GRAPH = {
+    'BACKEND': config('CHAT_FRIEND_GRAPH_BACKEND', default='none'),
+    'REDIS_URL': config('CHAT_FRIEND_GRAPH_REDIS_URL', default='redis://127.0.0.1:6379/2'),
+    'TTL': config('CHAT_FRIEND_GRAPH_TTL', default=3600, cast=int),
+}
+
+CACHES = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
     },
-}
\ No newline at end of file
+}
+
+if CHAT_FRIEND_GRAPH['BACKEND'] == 'redis':
+    CACHES["friend_graph"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": CHAT_FRIEND_GRAPH['REDIS_URL'],
+        "KEY_PREFIX": config('CHANNEL_REDIS_PREFIX', default='imhotep'),
+    }
+
+# Serve the chat and friends HTTP API with the async view variants. Under an ASGI server (daphne)
+# sync views each hold a thread of the sync executor for the whole request.
+CHAT_ASYNC_VIEWS = config('CHAT_ASYNC_VIEWS', default=False, cast=bool)
+
+# Threads the WebSocket consumers run their transactional database writes on (sending a message,
+# marking a room as seen), see chat/utils/db_executor.py. Each thread holds one database connection.
+CHAT_DB_EXECUTOR = {
+    'MAX_WORKERS': config('CHAT_DB_EXECUTOR_MAX_WORKERS', default=8, cast=int),
+}
+
+# Write-behind mode for inbound chat messages: messages are acknowledged and broadcast as soon as
+# they are received and inserted in micro-batches of up to BATCH_SIZE messages, at most
+# FLUSH_INTERVAL seconds later. At most MAX_PENDING messages are buffered, more are refused. The
+# buffer is flushed when a worker stops cleanly, messages still buffered when it is killed or
+# crashes are lost, see chat/utils/write_behind.py for the exact guarantees.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': config('CHAT_WRITE_BEHIND', default=False, cast=bool),
+    'BATCH_SIZE': config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=200, cast=int),
+    'FLUSH_INTERVAL': config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', default=0.05, cast=float),
+    'MAX_PENDING': config('CHAT_WRITE_BEHIND_MAX_PENDING', default=10000, cast=int),
+}
+
+# Room presence is kept in a TTL store: "memory" for a single process, "redis" to share it between
+# workers. Entries expire TTL seconds after the last heartbeat and last_seen is written to the
+# database every PERSIST_INTERVAL seconds.
+CHAT_PRESENCE = {
+    'BACKEND': config('CHAT_PRESENCE_BACKEND', default='memory'),
+    'REDIS_URL': config('CHAT_PRESENCE_REDIS_URL', default='redis://127.0.0.1:6379/1'),
+    'TTL': config('CHAT_PRESENCE_TTL', default=60, cast=int),
+    'PERSIST_INTERVAL': config('CHAT_PRESENCE_PERSIST_INTERVAL', default=30, cast=int),
+}
+# Live chat list updates pushed to each user's personal group (the multiplexed ws/chat/ socket).
+# Changes are coalesced so every user gets at most one update per INTERVAL seconds per worker.
+CHAT_INBOX_NOTIFICATIONS = {
+    'INTERVAL': config('CHAT_INBOX_NOTIFICATIONS_INTERVAL', default=1.0, cast=float),
+}
+# Username autocomplete is answered from an in-process index of every username (about 75 MB per
+# million users and worker, three times that while it is rebuilt every MAX_AGE seconds). Above
+# MAX_USERS users it is not built and autocomplete queries the database.
+CHAT_USERNAME_INDEX = {
+    'MAX_USERS': config('CHAT_USERNAME_INDEX_MAX_USERS', default=2000000, cast=int),
+    'MAX_AGE': config('CHAT_USERNAME_INDEX_MAX_AGE', default=600, cast=int),
+}